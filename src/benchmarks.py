@@ -0,0 +1,388 @@
+"""
+Benchmarks of the data pipeline hot paths.
+
+    python benchmarks.py preprocessing
+    python benchmarks.py scheduler --cores 4 8 16 32 64
+    python benchmarks.py ensemble --rows 1000000
+    python benchmarks.py suite --sizes 10000 100000 1000000
+    python benchmarks.py backfill
+    python benchmarks.py quantile
+
+preprocessing: compares the schema-driven preprocessing_nhanes -> create_targets -> rename_columns stages against
+the original chained combine_first code (reference_pipeline) on the full 1999-2014 compiled frame,
+checking both give the same data.
+scheduler: training wall-clock for each core budget given to dinh_2019_train_models.schedule_training.
+ensemble: rows per second of utils.WeightedEnsemble and ensemble_inference.BatchEnsemble scoring a synthetic
+NHANES-shaped batch, with models fitted on a synthetic training set.
+suite: the hot paths of the data pipeline and training on synthetic data (synthetic_data), so it runs offline without the CDC files:
+compile_data (on a synthetic raw_data tree, float64 and compact dtypes), preprocessing_nhanes -> create_targets -> rename_columns,
+ConvertToCategory + MissingValueCategoryAs999, the fit of each model family and the ensemble predict_proba.
+Each run is appended to a history CSV, and a benchmark is flagged as a regression when it takes more than
+`--threshold` longer than the median of its last runs on the same machine (the exit code is then 1).
+backfill: nhanes_data_backfill.scrape_nhanes_xpt_files against a local HTTP stand-in of the CDC website, offline.
+Some pages and files fail a few times (retried), one component page always fails (skipped, the other downloads
+go on), the requests are checked to be spaced by the rate limit, and a second run downloads nothing.
+quantile: quantile_search.QuantileSearch against RandomizedSearchCV fitting the same XGBoost candidates with the same
+number of trees on the same folds.
+"""
+
+import os
+import sys
+import time
+import platform
+import tempfile
+import argparse
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from utils import compile_data
+from dinh_2019_create_clean_data_file import preprocessing_nhanes, create_targets, rename_columns
+from synthetic_data import synthetic_clean_data, synthetic_raw_data, CDCStandIn
+from reference_pipeline import reference_preprocessing_nhanes, reference_create_targets, reference_rename_columns
+
+load_dotenv()
+
+PROC_DATA_PATH = os.getenv("PROC_DATA_PATH")
+MODEL_RESULTS_PATH = os.getenv("MODEL_RESULTS_PATH")
+
+
+def measure(function, repeats=5, trace_memory=True):
+    # Best wall-clock time of `repeats` runs and peak memory allocated by one more run (None without trace_memory)
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        output = function()
+        times.append(time.perf_counter() - start_time)
+
+    if not trace_memory:
+        return output, min(times), None
+
+    tracemalloc.start()
+    function()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return output, min(times), peak_memory
+
+
+def benchmark_preprocessing(repeats=5):
+    dinh_2019_variables = pd.read_excel(PROC_DATA_PATH + "dinh_2019_variables_doc.xlsx")["NHANES Name"].unique()
+    raw_df = compile_data(variable_list=dinh_2019_variables, print_statemets=False)
+    print(f"Compiled frame: {raw_df.shape[0]} rows x {raw_df.shape[1]} columns")
+
+    reference_df, reference_time, reference_memory = measure(
+        lambda: raw_df.pipe(reference_preprocessing_nhanes).pipe(reference_create_targets).pipe(reference_rename_columns),
+        repeats)
+    new_df, new_time, new_memory = measure(
+        lambda: raw_df.pipe(preprocessing_nhanes).pipe(create_targets).pipe(rename_columns),
+        repeats)
+
+    pd.testing.assert_frame_equal(reference_df, new_df)
+
+    print(f"{'':<28}{'Time (ms)':>12}{'Peak memory (MB)':>20}")
+    print(f"{'chained combine_first':<28}{reference_time * 1e3:>12.1f}{reference_memory / 1e6:>20.1f}")
+    print(f"{'harmonisation spec':<28}{new_time * 1e3:>12.1f}{new_memory / 1e6:>20.1f}")
+    print(f"Speed-up: {reference_time / new_time:.1f}x, same output")
+
+
+def benchmark_scheduler(core_counts, targets, families):
+    # Wall-clock of the scheduled training for each core budget, and its scaling from the smallest one.
+    # The models and ensembles go to a temporary folder, not to the registry of MODEL_RESULTS_PATH
+    from dinh_2019_train_models import load_training_data, schedule_training
+
+    # A budget over the cores of the machine would only measure oversubscription
+    available_cores = [n_cores for n_cores in core_counts if n_cores <= os.cpu_count()]
+    if len(available_cores) < len(core_counts):
+        print(f"Skipping the budgets over the {os.cpu_count()} cores of this machine: "
+              f"{sorted(set(core_counts) - set(available_cores))}")
+    if not available_cores:
+        return {}
+
+    df = load_training_data()
+
+    wall_times = {}
+    for n_cores in available_cores:
+        with tempfile.TemporaryDirectory() as results_path:
+            start_time = time.perf_counter()
+            schedule_training(df, targets, families, n_cores, results_path=results_path)
+            wall_times[n_cores] = time.perf_counter() - start_time
+
+    base_cores = available_cores[0]
+    print(f"{'Cores':>6}{'Time (s)':>12}{'Speed-up':>10}{'Efficiency':>12}")
+    for n_cores, wall_time in wall_times.items():
+        speed_up = wall_times[base_cores] / wall_time
+        print(f"{n_cores:>6}{wall_time:>12.1f}{speed_up:>9.1f}x{100 * speed_up * base_cores / n_cores:>11.0f}%")
+    return wall_times
+
+
+# Fixed hyperparameters of each model family in the benchmarks, single threaded
+benchmark_params = {
+    'logistic_regression': {},
+    'random_forest': {'n_estimators': 100, 'max_depth': 8, 'n_jobs': 1},
+    'xgb': {'n_estimators': 100, 'max_depth': 4, 'learning_rate': 0.1, 'n_jobs': 1},
+    'support_vector_machine': {'nystroem__n_components': 200, 'nystroem__gamma': 0.01},
+}
+# Model families of the benchmarked ensembles
+ensemble_families = ['logistic_regression', 'random_forest', 'xgb']
+
+
+def benchmark_pipeline(family):
+    from sklearn.base import clone
+    from sklearn.pipeline import Pipeline
+    from dinh_2019_train_models import create_preprocessor, model_family_search_space
+
+    estimator = clone(model_family_search_space(family)['estimator'][0]).set_params(**benchmark_params[family])
+    return Pipeline([('preprocessor', create_preprocessor()), ('estimator', estimator)])
+
+
+def fit_benchmark_pipelines(train_df, target='Diabetes_Case_I'):
+    from dinh_2019_train_models import categorical_vars, numerical_vars
+
+    return [benchmark_pipeline(family).fit(train_df[categorical_vars + numerical_vars], train_df[target])
+            for family in ensemble_families]
+
+
+def benchmark_ensemble(n_rows, n_train_rows=20_000, chunk_size=100_000):
+    # Throughput of the ensemble of the three model families on n_rows synthetic rows, fitted on n_train_rows
+    from utils import WeightedEnsemble
+    from ensemble_inference import BatchEnsemble
+
+    pipelines = fit_benchmark_pipelines(synthetic_clean_data(n_train_rows, seed=0))
+    weights = [0.85, 0.88, 0.9]
+
+    df = synthetic_clean_data(n_rows, seed=1)
+    print(f"Synthetic batch: {df.shape[0]} rows x {df.shape[1]} columns")
+
+    # As ensemble_metrics used to do it: predict, then predict_proba again
+    reference = WeightedEnsemble(pipelines, np.array(weights) / sum(weights))
+    reference_probas, reference_time, reference_memory = measure(
+        lambda: (reference.predict(df), reference.predict_proba(df))[1], repeats=1)
+
+    ensemble = BatchEnsemble.from_models(pipelines, weights, chunk_size=chunk_size)
+    probas, new_time, new_memory = measure(lambda: ensemble.predict_proba(df), repeats=1)
+
+    # The models score float32 instead of float64 values
+    print(f"Largest probability difference: {np.abs(probas - reference_probas).max():.2e}")
+
+    print(f"{'':<28}{'Rows / second':>16}{'Peak memory (MB)':>20}")
+    print(f"{'WeightedEnsemble':<28}{n_rows / reference_time:>16,.0f}{reference_memory / 1e6:>20.1f}")
+    print(f"{'BatchEnsemble':<28}{n_rows / new_time:>16,.0f}{new_memory / 1e6:>20.1f}")
+    print(f"Speed-up: {reference_time / new_time:.1f}x")
+
+    with tempfile.TemporaryDirectory() as directory:
+        ensemble.save(os.path.join(directory, "ensemble.pkl"))
+        print(f"Serving artifact: {os.path.getsize(os.path.join(directory, 'ensemble.pkl')) / 1e6:.1f} MB")
+
+
+def benchmark_quantile_search(n_rows=60_000, n_iter=10, cv=5, n_estimators=200, n_jobs=1):
+    """
+    QuantileSearch against RandomizedSearchCV with the same work: the candidates of the "quantile" XGBoost search space
+    with a fixed number of trees (no early stopping), the same CV folds and the same booster
+    (CategoricalXGBClassifier, tree_method='hist', n_jobs threads). Only the quantization differs: once per fold,
+    or once per fit of the Pipeline.
+    """
+    from sklearn.base import clone
+    from sklearn.pipeline import Pipeline
+    from sklearn.model_selection import RandomizedSearchCV, StratifiedKFold
+    from quantile_search import QuantileSearch
+    from dinh_2019_train_models import (create_preprocessor, model_family_search_space, categorical_vars, numerical_vars,
+                                        stratified_split, downsample, SEED)
+
+    X_train, _, y_train, _ = stratified_split(downsample(synthetic_clean_data(n_rows, seed=0)), 'Diabetes_Case_I')
+    feature_types = ['c'] * len(categorical_vars) + ['q'] * len(numerical_vars)
+    space = model_family_search_space('xgb', 'quantile')
+    estimator = clone(space['estimator'][0]).set_params(n_estimators=n_estimators, early_stopping_rounds=None, n_jobs=n_jobs,
+                                                 enable_categorical=True, feature_types=feature_types)
+    space = {**space, 'estimator': [estimator]}
+    pipeline = Pipeline([('preprocessor', create_preprocessor()), ('estimator', estimator)])
+    print(f"{len(X_train)} training rows, {n_iter} candidates x {cv} folds, {n_estimators} trees, {n_jobs} thread(s)")
+
+    folds = StratifiedKFold(cv, shuffle=True, random_state=SEED)
+    searches = {
+        'RandomizedSearchCV': RandomizedSearchCV(pipeline, space, n_iter=n_iter, cv=folds, scoring='roc_auc',
+                                                 random_state=SEED, n_jobs=1),
+        'QuantileSearch': QuantileSearch(pipeline, space, n_iter=n_iter, cv=cv),
+    }
+    print(f"{'':<22}{'Wall (s)':>10}{'Fit / candidate (s)':>22}{'CV AUC':>10}")
+    wall_times = {}
+    for name, search in searches.items():
+        start_time = time.perf_counter()
+        search.fit(X_train, y_train)
+        wall_times[name] = time.perf_counter() - start_time
+        print(f"{name:<22}{wall_times[name]:>10.1f}{np.mean(search.cv_results_['mean_fit_time']):>22.3f}{search.best_score_:>10.4f}")
+    print(f"QuantileSearch quantizes a fold in {searches['QuantileSearch'].quantize_time_:.2f} s, preprocessor fit included")
+    print(f"Speed-up: {wall_times['RandomizedSearchCV'] / wall_times['QuantileSearch']:.2f}x")
+    return wall_times
+
+
+def suite_benchmarks(n_rows, directory):
+    """
+    (name, function) of the suite at n_rows synthetic rows. The data each benchmark needs is created here,
+    outside of the timed functions.
+    """
+    from utils import ConvertToCategory, MissingValueCategoryAs999, WeightedEnsemble
+    from ensemble_inference import BatchEnsemble
+    from dinh_2019_train_models import categorical_vars, numerical_vars
+
+    raw_path, proc_path = os.path.join(directory, "raw", ""), os.path.join(directory, "proc", "")
+    variables = synthetic_raw_data(n_rows, raw_path, proc_path)
+
+    def run_compile_data(compact_dtypes=False):
+        return compile_data(variables, raw_path, proc_path, print_statemets=False, compact_dtypes=compact_dtypes)
+
+    raw_df = run_compile_data()
+    clean_df = synthetic_clean_data(n_rows)
+    X, y = clean_df[categorical_vars + numerical_vars], clean_df['Diabetes_Case_I']
+    categorical_transformers = [ConvertToCategory(categorical_vars), MissingValueCategoryAs999(categorical_vars)]
+    pipelines = fit_benchmark_pipelines(synthetic_clean_data(20_000, seed=1))
+    weights = [0.85, 0.88, 0.9]
+
+    benchmarks = [
+        ('compile_data', run_compile_data),
+        ('compile_data_compact', lambda: run_compile_data(compact_dtypes=True)),
+        ('preprocessing', lambda: raw_df.pipe(preprocessing_nhanes).pipe(create_targets).pipe(rename_columns)),
+        ('categorical_transformers', lambda: categorical_transformers[1].transform(categorical_transformers[0].transform(X))),
+    ]
+    benchmarks += [(f'fit_{family}', lambda family=family: benchmark_pipeline(family).fit(X, y)) for family in benchmark_params]
+    benchmarks += [
+        ('WeightedEnsemble.predict_proba', lambda: WeightedEnsemble(pipelines, weights).predict_proba(X)),
+        ('BatchEnsemble.predict_proba', lambda: BatchEnsemble.from_models(pipelines, weights).predict_proba(X)),
+    ]
+    return benchmarks
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def benchmark_backfill(requests_per_second=20, workers=4):
+    import pyreadstat
+    from nhanes_data_backfill import scrape_nhanes_xpt_files
+
+    year = "2005-2006"
+    files = {"Demographics": ["DEMO_D"], "Dietary": ["DSBI", "DR1TOT_D"], "Examination": ["BMX_D", "BPX_D"],
+             "Laboratory": ["GLU_D"], "Questionnaire": ["DIQ_D", "MCQ_D"]}
+    with tempfile.TemporaryDirectory() as directory:
+        xpt_path, raw_path = os.path.join(directory, "xpt"), os.path.join(directory, "raw")
+        os.makedirs(xpt_path)
+        rng = np.random.default_rng(0)
+        for name in sum(files.values(), []):
+            pyreadstat.write_xport(pd.DataFrame({'SEQN': np.arange(100.0), 'VALUE': rng.random(100)}),
+                                   os.path.join(xpt_path, name + ".XPT"), table_name=name[:8])
+
+        flaky = {"/Nchs/Nhanes/2005-2006/BMX_D.XPT": 2,
+                 "/nchs/nhanes/search/datapage.aspx?Component=Examination&CycleBeginYear=2005": 1}
+        stand_in = CDCStandIn(xpt_path, year, files, flaky, failing=["Laboratory"])
+        try:
+            start_time = time.perf_counter()
+            scrape_nhanes_xpt_files(year, raw_path, workers, requests_per_second, stand_in.url, retries=3, backoff_factor=0.01)
+            first_run = time.perf_counter() - start_time
+            first_requests = list(stand_in.requests)
+            scrape_nhanes_xpt_files(year, raw_path, workers, requests_per_second, stand_in.url, retries=3, backoff_factor=0.01)
+            second_requests = stand_in.requests[len(first_requests):]
+        finally:
+            stand_in.close()
+
+        downloaded = {file[:-len(".parquet")] for _, _, names in os.walk(raw_path) for file in names if file.endswith(".parquet")}
+
+    expected = set(sum(files.values(), [])) - set(files["Laboratory"])
+    times = np.array(sorted(request_time for request_time, _, _ in first_requests))
+    laboratory_requests = sum("Component=Laboratory" in query for _, _, query in first_requests)
+    bmx_requests = sum(path.endswith("BMX_D.XPT") for _, path, _ in first_requests)
+    second_downloads = sum(path.endswith(".XPT") for _, path, _ in second_requests)
+
+    print(f"First run: {len(first_requests)} requests in {first_run:.2f} s, {len(downloaded)} files downloaded")
+    print(f"Laboratory page: {laboratory_requests} requests (1 + 3 retries), then skipped")
+    print(f"BMX_D.XPT: {bmx_requests} requests (2 failures retried)")
+    print(f"Shortest interval between two requests: {np.diff(times).min() * 1e3:.1f} ms "
+          f"(rate limit {1e3 / requests_per_second:.1f} ms)")
+    print(f"Second run: {second_downloads} files downloaded again")
+
+    # The rate limit spaces the requests, a few ms of timer resolution aside
+    if (downloaded != expected or laboratory_requests != 4 or bmx_requests != 3 or second_downloads != 0
+            or np.diff(times).min() < 0.9 / requests_per_second):
+        raise AssertionError("The backfill didn't retry, skip or rate limit the requests as expected")
+    print("Retries, skipped page, rate limit and resume as expected")
+
+
+def flag_regressions(results, history, threshold, last_runs=5, min_seconds=0.05):
+    # Time of each benchmark against the median of its last runs on the same machine, slowdowns under min_seconds are noise
+    regressions = []
+    for result in results:
+        previous = history[(history['benchmark'] == result['benchmark']) & (history['rows'] == result['rows']) &
+                           (history['machine'] == result['machine'])].tail(last_runs)
+        if previous.empty:
+            result['baseline_seconds'] = np.nan
+            continue
+        result['baseline_seconds'] = previous['seconds'].median()
+        slowdown = result['seconds'] - result['baseline_seconds']
+        if slowdown > result['baseline_seconds'] * threshold and slowdown > min_seconds:
+            regressions.append(result)
+    return regressions
+
+
+def benchmark_suite(sizes, repeats=3, trace_memory=False, threshold=0.2,
+                    history_path=os.path.join(MODEL_RESULTS_PATH or ".", "benchmark_history.csv")):
+    machine = f"{platform.node()} ({os.cpu_count()} cores)"
+    run = {'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"), 'commit': git_commit(), 'machine': machine}
+
+    results = []
+    for n_rows in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            for name, function in suite_benchmarks(n_rows, directory):
+                # The largest sizes are too slow to repeat
+                _, seconds, peak_memory = measure(function, repeats if n_rows < 1_000_000 else 1, trace_memory)
+                results.append({**run, 'benchmark': name, 'rows': n_rows, 'seconds': seconds,
+                                'rows_per_second': n_rows / seconds,
+                                'peak_memory_mb': peak_memory / 1e6 if peak_memory is not None else np.nan})
+                print(f"{name:<34}{n_rows:>10}{seconds:>12.3f} s{n_rows / seconds:>16,.0f} rows/s")
+
+    history = pd.read_csv(history_path) if os.path.exists(history_path) else pd.DataFrame(columns=list(results[0]))
+    regressions = flag_regressions(results, history, threshold)
+
+    pd.concat([history, pd.DataFrame(results).drop(columns='baseline_seconds')], ignore_index=True).to_csv(history_path, index=False)
+    print(f"Results added to {history_path}")
+
+    for result in regressions:
+        print(f"REGRESSION {result['benchmark']} at {result['rows']} rows: {result['seconds']:.3f} s, "
+              f"{result['seconds'] / result['baseline_seconds'] - 1:+.0%} over the median of its last runs "
+              f"({result['baseline_seconds']:.3f} s)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the data pipeline")
+    parser.add_argument("benchmark", choices=["preprocessing", "scheduler", "ensemble", "suite", "backfill", "quantile"])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--cores", type=int, nargs="+", default=[4, 8, 16, 32, 64], help="Core budgets of the scheduler benchmark")
+    parser.add_argument("--targets", nargs="+", default=['Diabetes_Case_I', 'Diabetes_Case_II', 'CVD'])
+    parser.add_argument("--families", nargs="+", default=['logistic_regression', 'random_forest', 'xgb'])
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Rows scored by the ensemble benchmark")
+    parser.add_argument("--chunk-size", type=int, default=100_000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="Rows of the suite benchmarks")
+    parser.add_argument("--memory", action="store_true", help="Also trace the peak memory of the suite benchmarks")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown flagged as a regression by the suite")
+    args = parser.parse_args()
+
+    if args.benchmark == "preprocessing":
+        benchmark_preprocessing(args.repeats)
+    elif args.benchmark == "scheduler":
+        benchmark_scheduler(args.cores, args.targets, args.families)
+    elif args.benchmark == "ensemble":
+        benchmark_ensemble(args.rows, chunk_size=args.chunk_size)
+    elif args.benchmark == "suite":
+        regressions = benchmark_suite(args.sizes, args.repeats, args.memory, args.threshold)
+        sys.exit(1 if regressions else 0)
+    elif args.benchmark == "backfill":
+        benchmark_backfill()
+    elif args.benchmark == "quantile":
+        benchmark_quantile_search()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Command line of the Dinh et al. (2019) models: train, evaluate and predict.
+
+Only argparse and dotenv are imported to parse the command line. pandas, scikit-learn, XGBoost and the training
+module are imported by the subcommand that runs, so `--help` or a wrong argument doesn't pay for them.
+The downsampling of the clean data and the train / test split are seeded (SEED of the .env, or --seed), so
+`evaluate --seed N` scores the saved models of `train --seed N` on the same test sets they were trained for.
+
+    python dinh_2019.py train --targets CVD --families logistic_regression xgb
+    python dinh_2019.py evaluate --targets CVD
+    python dinh_2019.py predict --input new_participants.parquet --output predictions.csv
+"""
+
+import os
+import argparse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Read as they are: without a .env, --help still works and --seed has no default
+SEED = os.getenv("SEED")
+PROC_DATA_PATH = os.getenv("PROC_DATA_PATH")
+MODEL_RESULTS_PATH = os.getenv("MODEL_RESULTS_PATH")
+
+TARGETS = ['Diabetes_Case_I', 'Diabetes_Case_II', 'CVD']
+FAMILIES = ['logistic_regression', 'support_vector_machine', 'random_forest', 'xgb']
+
+
+def results_file(folder, file_name):
+    # File of a folder of the .env, of the current folder without it
+    return os.path.join(folder or ".", file_name)
+
+
+CLEAN_DATA_FILE = results_file(PROC_DATA_PATH, "Dinh_2019_clean_data.parquet")
+
+
+def train(args):
+    from dinh_2019_train_models import train
+    from training_profiler import TrainingProfiler
+
+    profiler = TrainingProfiler(args.profile or args.profile_hook is not None, args.profile_hook, args.profile_stage,
+                                MODEL_RESULTS_PATH)
+    searches = {'xgb': args.xgb_search} if args.xgb_search else None
+    table_metrics = train(args.targets, args.families, args.data, args.seed, args.cores, args.parallel_jobs, profiler,
+                          searches, args.explain)
+    print(table_metrics)
+    print(table_metrics.attrs["comparisons"])
+
+
+def evaluate(args):
+    from dinh_2019_train_models import evaluate
+
+    table_metrics = evaluate(args.targets, args.data, args.seed)
+    table_metrics.to_csv(args.output, index=False)
+    root, extension = os.path.splitext(args.output)
+    table_metrics.attrs["comparisons"].to_csv(root + "_comparisons" + (extension or ".csv"), index=False)
+    print(table_metrics)
+    print(table_metrics.attrs["comparisons"])
+
+
+def predict(args):
+    import pandas as pd
+    from dinh_2019_train_models import load_clean_data
+    from ensemble_inference import load_ensemble
+    from model_registry import load_model
+
+    df = load_clean_data(args.input)
+    predictions = pd.DataFrame({'SEQN': df['SEQN']}) if 'SEQN' in df else pd.DataFrame(index=df.index)
+    for target in args.targets:
+        # The AUC weighted ensemble of the target, or one model of the registry
+        if args.model:
+            predictions[target] = load_model(target, args.model).predict_proba(df)[:, 1]
+        else:
+            predictions[target] = load_ensemble(results_file(MODEL_RESULTS_PATH, f'dinh_ensemble_{target}.pkl')).predict_proba(df)
+
+    if args.output.endswith(".parquet"):
+        predictions.to_parquet(args.output, index=False)
+    else:
+        predictions.to_csv(args.output, index=False)
+    print(f"--> {len(predictions)} predictions saved as {args.output}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Train, evaluate and use the Dinh et al. (2019) models")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # Arguments shared by the subcommands
+    targets = argparse.ArgumentParser(add_help=False)
+    targets.add_argument("--targets", nargs="+", choices=TARGETS, default=TARGETS)
+    data = argparse.ArgumentParser(add_help=False)
+    data.add_argument("--data", default=CLEAN_DATA_FILE, help="Clean data file (parquet, feather or csv)")
+    data.add_argument("--seed", type=int, default=SEED, required=SEED is None,
+                      help="Seed of the downsampling and train / test split, SEED of the .env by default")
+
+    train_parser = subparsers.add_parser("train", parents=[targets, data],
+                                         help="Fit the models of the targets and families, save them and their results")
+    train_parser.add_argument("--families", nargs="+", choices=FAMILIES, default=FAMILIES)
+    train_parser.add_argument("--cores", type=int, default=os.cpu_count(), help="Cores shared by all the training jobs")
+    train_parser.add_argument("--parallel-jobs", type=int, default=None,
+                              help="(target, model) jobs running at the same time, by default one per model family")
+    train_parser.add_argument("--profile", action="store_true",
+                              help="Write the time and peak memory of each stage next to dinh_2019_results.csv")
+    train_parser.add_argument("--profile-hook", choices=["cprofile", "py-spy"], default=None,
+                              help="Run --profile-stage under cProfile or py-spy")
+    train_parser.add_argument("--profile-stage", default="search", help="Stage run under --profile-hook")
+    train_parser.add_argument("--xgb-search", choices=["random", "halving", "quantile"], default=None,
+                              help="Search of the XGBoost models (halving by default), quantile shares one quantized matrix per CV fold")
+    train_parser.add_argument("--explain", action="store_true",
+                              help="Write the global feature importances of each model on its test set to dinh_2019_importances.csv")
+    train_parser.set_defaults(run=train)
+
+    evaluate_parser = subparsers.add_parser("evaluate", parents=[targets, data],
+                                            help="Metrics of the saved models and ensembles on their test sets")
+    evaluate_parser.add_argument("--output", default=results_file(MODEL_RESULTS_PATH, "dinh_2019_evaluation.csv"))
+    evaluate_parser.set_defaults(run=evaluate)
+
+    predict_parser = subparsers.add_parser("predict", parents=[targets],
+                                           help="Probabilities of the targets for the participants of a clean data file")
+    predict_parser.add_argument("--input", default=CLEAN_DATA_FILE, help="Clean data file (parquet, feather or csv)")
+    predict_parser.add_argument("--model", default=None,
+                                help="Model of the registry (e.g. LogisticRegression), the AUC weighted ensemble by default")
+    predict_parser.add_argument("--output", default=results_file(MODEL_RESULTS_PATH, "dinh_2019_predictions.csv"))
+    predict_parser.set_defaults(run=predict)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,106 +1,172 @@
-from utils import create_intake_new_column, compile_data
+from utils import harmonise, compile_data, compact_dtype_plan, compact_to_pandas
+from nhanes_query import NHANESQuery
+from nhanes_file_index import update_file_index
+from stage_cache import StageCache, hash_key, hash_file
 import pandas as pd
 import numpy as np
-from glob import glob
+import os
+import argparse
 from dotenv import load_dotenv
 
 load_dotenv()
 
+RAW_DATA_PATH = os.getenv("RAW_DATA_PATH")
 PROC_DATA_PATH = os.getenv("PROC_DATA_PATH")
 
+# Raw variables compared with thresholds in create_targets, read as float64 with the compact dtypes:
+# in float32, a glucose of 5.6 is 5.5999999 and would fall out of the 5.6 <= Glucose < 7.0 range
+FLOAT64_VARIABLES = ['LBXGLUSI', 'LBDGLUSI']
 
-def preprocessing_nhanes(data):
-    df = data.copy()
-
-    # These are numerical variables that have coded categorical answers "Don't know" and "Refused" as numerical
-    df['ALQ130'] = df['ALQ130'].replace([77, 99, 777, 999], np.nan)
-    df['WHD140'] = df['WHD140'].replace([7777, 77777, 9999, 99999], np.nan)
+# These are numerical variables that have coded categorical answers "Don't know" and "Refused" as numerical
+SENTINEL_CODES = {
+    'ALQ130': [77, 99, 777, 999],
+    'WHD140': [7777, 77777, 9999, 99999],
+}
 
+HARMONISATION_SPEC = [
     # Create new columns
-    df['Alcohol_Intake'] = create_intake_new_column(df, 'DRXTALCO', 'DR1TALCO', 'DR2TALCO')
-    df['Caffeine_Intake'] = create_intake_new_column(df, 'DRXTCAFF', 'DR1TCAFF', 'DR2TCAFF')
-    df['Calcium_Intake'] = create_intake_new_column(df, 'DRXTCALC', 'DR1TCALC', 'DR2TCALC')
-    df['Carbohydrate_Intake'] = create_intake_new_column(df, 'DRXTCARB', 'DR1TCARB', 'DR2TCARB')
-    df['Fiber_Intake'] = create_intake_new_column(df, 'DRXTFIBE', 'DR1TFIBE', 'DR2TFIBE')
-    df['Kcal_Intake'] = create_intake_new_column(df, 'DRXTKCAL', 'DR1TKCAL', 'DR2TKCAL')
-    df['Sodium_Intake'] = create_intake_new_column(df, 'DRDTSODI', 'DR1TSODI', 'DR2TSODI')
-
+    ('Alcohol_Intake', ['DRXTALCO', 'DR1TALCO', 'DR2TALCO'], 'mean_of_days'),
+    ('Caffeine_Intake', ['DRXTCAFF', 'DR1TCAFF', 'DR2TCAFF'], 'mean_of_days'),
+    ('Calcium_Intake', ['DRXTCALC', 'DR1TCALC', 'DR2TCALC'], 'mean_of_days'),
+    ('Carbohydrate_Intake', ['DRXTCARB', 'DR1TCARB', 'DR2TCARB'], 'mean_of_days'),
+    ('Fiber_Intake', ['DRXTFIBE', 'DR1TFIBE', 'DR2TFIBE'], 'mean_of_days'),
+    ('Kcal_Intake', ['DRXTKCAL', 'DR1TKCAL', 'DR2TKCAL'], 'mean_of_days'),
+    ('Sodium_Intake', ['DRDTSODI', 'DR1TSODI', 'DR2TSODI'], 'mean_of_days'),
     # Combine same variables
-    df['Relative_Had_Diabetes'] = df['MCQ250A'].combine_first(df['MCQ300C']).combine_first(df['MCQ300c'])
-    df['Told_CHF'] = df['MCQ160B'].combine_first(df['MCQ160b'])
-    df['Told_CHD'] = df['MCQ160C'].combine_first(df['MCQ160c'])
-    df['Told_HA'] = df['MCQ160E'].combine_first(df['MCQ160e'])
-    df['Told_stroke'] = df['MCQ160F'].combine_first(df['MCQ160f'])
-    df['Pregnant'] = df['SEQ060'].combine_first(df['RHQ141']).combine_first(df['RHD143'])
-    df['HDL_Cholesterol'] = df['LBDHDLSI'].combine_first(df['LBDHDDSI'])
-    df['Glucose'] = df['LBXGLUSI'].combine_first(df['LBDGLUSI'])
+    ('Relative_Had_Diabetes', ['MCQ250A', 'MCQ300C', 'MCQ300c'], 'coalesce'),
+    ('Told_CHF', ['MCQ160B', 'MCQ160b'], 'coalesce'),
+    ('Told_CHD', ['MCQ160C', 'MCQ160c'], 'coalesce'),
+    ('Told_HA', ['MCQ160E', 'MCQ160e'], 'coalesce'),
+    ('Told_stroke', ['MCQ160F', 'MCQ160f'], 'coalesce'),
+    ('Pregnant', ['SEQ060', 'RHQ141', 'RHD143'], 'coalesce'),
+    ('HDL_Cholesterol', ['LBDHDLSI', 'LBDHDDSI'], 'coalesce'),
+    ('Glucose', ['LBXGLUSI', 'LBDGLUSI'], 'coalesce'),
     # Choosing the last blood reading
-    df['Diastolic_Blood_Pressure'] = df['BPXDI4'].combine_first(df['BPXDI3']).combine_first(df['BPXDI2']).combine_first(df['BPXDI1'])
-    df['Systolic_Blood_Pressure'] = df['BPXSY4'].combine_first(df['BPXSY3']).combine_first(df['BPXSY2']).combine_first(df['BPXSY1'])
+    ('Diastolic_Blood_Pressure', ['BPXDI4', 'BPXDI3', 'BPXDI2', 'BPXDI1'], 'coalesce'),
+    ('Systolic_Blood_Pressure', ['BPXSY4', 'BPXSY3', 'BPXSY2', 'BPXSY1'], 'coalesce'),
+]
+
+
+# Clean data names of the NHANES variables that are not harmonised
+RENAME_COLUMNS = { 'ALQ130': 'Alcohol_consumption', 'BMXARMC': 'Arm_circumference', 'BMXARML': 'Arm_length', 'BMXBMI': 'Body_mass_index', 'BMXHT': 'Height', 'BMXLEG': 'Leg_length', 'BMXWAIST': 'Waist_circumference', 'BMXWT': 'Weight', 'BPQ080': 'Told_High_Cholesterol', 'BPXPLS': 'Pulse', 'HSD010': 'General_health', 'HUQ010': 'Health_status', 'INDHHIN2': 'Household_income', 'LBXSCLSI': 'Chloride', 'LBXSNASI': 'Sodium', 'LBDLDLSI': 'LDL_cholesterol', 'LBDLYMNO': 'Lymphocytes', 'LBDSBUSI': 'Blood_urea_nitrogen', 'LBDSTRSI': 'Triglycerides', 'LBDTCSI': 'Total_cholesterol', 'LBXMCVSI': 'Mean_cell_volume', 'LBXSASSI': 'Aspartate_aminotransferase_AST', 'LBXSGTSI': 'Gamma_glutamyl_transferase', 'LBXSOSSI': 'Osmolality', 'LBXWBCSI': 'White_blood_cell_count', 'RIDAGEYR': 'Age', 'RIDRETH1': 'Race_ethnicity', 'WHD140': 'Self_reported_greatest_weight', 'YEAR': 'Survey_year'
+}
+
+
+def preprocessing_nhanes(data):
+    harmonised = harmonise(data, HARMONISATION_SPEC, SENTINEL_CODES)
 
     # Filter data
-    cond_1 = (df['Pregnant'].isna()) | (df['Pregnant'] != 1)
-    cond_2 =(df['RIDAGEYR'] >= 20)
-    df = df[cond_1 & cond_2]
+    cond_1 = np.isnan(harmonised['Pregnant']) | (harmonised['Pregnant'] != 1)
+    cond_2 = data['RIDAGEYR'].to_numpy(dtype=np.float64, na_value=np.nan) >= 20
+    rows = cond_1 & cond_2
 
     # Delete old columns that are not needed
-    columns_to_drop = ['DRXTALCO', 'DR1TALCO', 'DR2TALCO', 'DRXTCAFF', 'DR1TCAFF', 'DR2TCAFF',
-                    'DRXTCALC', 'DR1TCALC', 'DR2TCALC', 'DRXTCARB', 'DR1TCARB', 'DR2TCARB',
-                    'DRXTFIBE', 'DR1TFIBE', 'DR2TFIBE', 'DRXTKCAL', 'DR1TKCAL', 'DR2TKCAL',
-                    'DRDTSODI', 'DR1TSODI', 'DR2TSODI', 'MCQ250A', 'MCQ300C', 'MCQ300c',
-                    'MCQ160B', 'MCQ160b', 'MCQ160C', 'MCQ160c', 'MCQ160E', 'MCQ160e',
-                    'MCQ160F', 'MCQ160f', 'SEQ060', 'RHQ141', 'RHD143',
-                    'LBDHDLSI', 'LBDHDDSI', 'LBXGLUSI', 'LBDGLUSI',
-                    'BPXDI4', 'BPXDI3', 'BPXDI2', 'BPXDI1',
-                    'BPXSY4', 'BPXSY3', 'BPXSY2', 'BPXSY1', 'Pregnant']
-
-    df = df.drop(columns=columns_to_drop)
+    columns_to_drop = {col for _, cols, _ in HARMONISATION_SPEC for col in cols} | {'Pregnant'}
 
-    return df
+    # Kept rows and columns, with the new columns added by assign (no chained assignment on a slice of `data`)
+    df = data.loc[rows, [col for col in data.columns if col not in columns_to_drop]]
+    return df.assign(**{col: values[rows] for col, values in harmonised.items() if col not in columns_to_drop})
 
 
 def create_targets(data):
-    df = data.copy()
+    # DIQ010 may be a nullable integer column (compact dtypes), where a missing answer isn't 1
+    diq010 = data['DIQ010'].to_numpy(dtype=np.float64, na_value=np.nan)
+    diabetes_case_i = np.where(
+      (data['Glucose'] > 7.0) | (diq010 == 1), 1, 0)
 
-    df['Diabetes_Case_I'] = np.where(
-      (df['Glucose'] > 7.0) | (df['DIQ010'] == 1), 1, 0)
+    diabetes_case_ii = np.where(
+      (diabetes_case_i == 0) & (data['Glucose'] >= 5.6) & (data['Glucose'] < 7.0), 1, 0)
 
-    df['Diabetes_Case_II'] = np.where(
-      (df['Diabetes_Case_I'] == 0) & (df['Glucose'] >= 5.6) & (df['Glucose'] < 7.0), 1, 0)
-
-    df['CVD'] = np.where(
-        (df['Told_CHF'] == 1) | (df['Told_CHD'] == 1) | (df['Told_HA'] == 1) | (df['Told_stroke'] == 1), 1, 0)
+    cvd = np.where(
+        (data['Told_CHF'] == 1) | (data['Told_CHD'] == 1) | (data['Told_HA'] == 1) | (data['Told_stroke'] == 1), 1, 0)
 
     # Drop the unnecessary columns
-    df = df.drop(columns=['Told_CHF', 'Told_CHD', 'Told_HA', 'Told_stroke', 'Glucose', 'DIQ010'])
+    df = data.drop(columns=['Told_CHF', 'Told_CHD', 'Told_HA', 'Told_stroke', 'Glucose', 'DIQ010'])
+    df['Diabetes_Case_I'] = diabetes_case_i
+    df['Diabetes_Case_II'] = diabetes_case_ii
+    df['CVD'] = cvd
 
     return df
 
 def rename_columns(data):
 
-    df = data.copy()
-
-    df = df.rename(columns={ 'ALQ130': 'Alcohol_consumption', 'BMXARMC': 'Arm_circumference', 'BMXARML': 'Arm_length', 'BMXBMI': 'Body_mass_index', 'BMXHT': 'Height', 'BMXLEG': 'Leg_length', 'BMXWAIST': 'Waist_circumference', 'BMXWT': 'Weight', 'BPQ080': 'Told_High_Cholesterol', 'BPXPLS': 'Pulse', 'HSD010': 'General_health', 'HUQ010': 'Health_status', 'INDHHIN2': 'Household_income', 'LBXSCLSI': 'Chloride', 'LBXSNASI': 'Sodium', 'LBDLDLSI': 'LDL_cholesterol', 'LBDLYMNO': 'Lymphocytes', 'LBDSBUSI': 'Blood_urea_nitrogen', 'LBDSTRSI': 'Triglycerides', 'LBDTCSI': 'Total_cholesterol', 'LBXMCVSI': 'Mean_cell_volume', 'LBXSASSI': 'Aspartate_aminotransferase_AST', 'LBXSGTSI': 'Gamma_glutamyl_transferase', 'LBXSOSSI': 'Osmolality', 'LBXWBCSI': 'White_blood_cell_count', 'RIDAGEYR': 'Age', 'RIDRETH1': 'Race_ethnicity', 'WHD140': 'Self_reported_greatest_weight', 'YEAR': 'Survey_year'
-    })
+    df = data.rename(columns=RENAME_COLUMNS)
 
     return df
 
 
+def set_categorical_dtypes(data):
+    # Keep the coded answers as categories in the typed (parquet / feather) clean data file
+    categorical_vars = ['Race_ethnicity', 'General_health', 'Health_status', 'Told_High_Cholesterol', 'Household_income', 'Relative_Had_Diabetes']
+    return data.astype({col: 'category' for col in categorical_vars})
+
+
+def save_clean_data(df, file_format="parquet"):
+    clean_data_file = PROC_DATA_PATH + f"Dinh_2019_clean_data.{file_format}"
+
+    if file_format == "parquet":
+        df.to_parquet(clean_data_file, index=False)
+    elif file_format == "feather":
+        # Uncompressed Arrow IPC file so it can be memory-mapped
+        df.to_feather(clean_data_file, compression="uncompressed")
+    else:
+        df.to_csv(clean_data_file, index=False)
+
+    return clean_data_file
+
+
 def main():
-    # Get the name of the variables we need from manual file
-    dinh_2019_variables = pd.read_excel(PROC_DATA_PATH + "dinh_2019_variables_doc.xlsx")["NHANES Name"].unique()
-
-    # Compile raw data into a unique raw dataframe
-    df = compile_data(variable_list=dinh_2019_variables, print_statemets=False)
-    # Clean raw data
-    df = (df
-             .pipe(preprocessing_nhanes)
-             .pipe(create_targets)
-             .pipe(rename_columns)
-         )
+    parser = argparse.ArgumentParser(description="Create the clean Dinh et al. (2019) dataset")
+    parser.add_argument("--force", action="store_true", help="Rebuild every stage ignoring the cache")
+    parser.add_argument("--cache-size-gb", type=float, default=5, help="Maximum size of the stage cache")
+    parser.add_argument("--format", choices=["parquet", "feather", "csv"], default="parquet",
+                        help="Format of the clean data file, parquet and feather keep the categorical dtypes")
+    parser.add_argument("--eager", action="store_true",
+                        help="Compile every participant with compile_data instead of pushing the age filter into the scan")
+    parser.add_argument("--float64", action="store_true",
+                        help="Read every raw column as float64 instead of the compact dtypes of the NHANES codebook")
+    args = parser.parse_args()
+
+    variables_file = PROC_DATA_PATH + "dinh_2019_variables_doc.xlsx"
+
+    def compile_dinh_2019_data():
+        # Get the name of the variables we need from manual file
+        dinh_2019_variables = pd.read_excel(variables_file)["NHANES Name"].unique()
+
+        # Compile raw data into a unique raw dataframe
+        return compile_data(variable_list=dinh_2019_variables, print_statemets=False,
+                            compact_dtypes=not args.float64, keep_float64=FLOAT64_VARIABLES)
+
+    def query_dinh_2019_data():
+        # Same as compile_data for the adults only: preprocessing_nhanes drops the participants under 20 anyway
+        dinh_2019_variables = pd.read_excel(variables_file)["NHANES Name"].unique()
+        query = NHANESQuery().select(dinh_2019_variables).where("RIDAGEYR", ">=", 20)
+        return (query if args.float64 else query.compact(FLOAT64_VARIABLES)).collect()
+
+    # Inputs of the pipeline: raw files, NHANES docs and the variable list
+    file_index = update_file_index(RAW_DATA_PATH)
+    inputs_key = hash_key(
+        {name: [entry["size"], entry["mtime"]] for name, entry in file_index["files"].items()},
+        hash_file(PROC_DATA_PATH + "documentation_variables.csv"),
+        hash_file(variables_file),
+        args.float64,
+    )
+
+    # Clean raw data, reusing the stages whose inputs and code didn't change
+    cache = StageCache(PROC_DATA_PATH + "stage_cache", max_size_bytes=args.cache_size_gb * 1e9, force=args.force)
+    read_functions = [compact_dtype_plan, compact_to_pandas]
+    first_stage = (("compile_data", compile_dinh_2019_data, [compile_data, *read_functions]) if args.eager else
+                   ("query_nhanes", query_dinh_2019_data, [compile_data, NHANESQuery.collect, *read_functions]))
+    df = cache.run_pipeline([
+        first_stage,
+        ("preprocessing_nhanes", preprocessing_nhanes, []),
+        ("create_targets", create_targets, []),
+        ("rename_columns", rename_columns, []),
+    ], inputs_key)
+
     # Save file
-    df.to_csv(PROC_DATA_PATH + "Dinh_2019_clean_data.csv", index=False)
-    print(f"--> Clean data saved as {PROC_DATA_PATH + "Dinh_2019_clean_data.csv"}")
+    clean_data_file = save_clean_data(set_categorical_dtypes(df), args.format)
+    print(f"--> Clean data saved as {clean_data_file}")
 
 if __name__ == "__main__":
     main()
@@ -1,45 +1,53 @@
-from sklearn.pipeline import Pipeline
-from sklearn.compose import ColumnTransformer
-from sklearn.impute import SimpleImputer
-from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split, RandomizedSearchCV
-from sklearn.linear_model import LogisticRegression
-from sklearn.svm import SVC
-from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier
-from sklearn.base import BaseEstimator
-from sklearn.metrics import roc_auc_score, precision_score, recall_score, f1_score
-from sklearn.kernel_approximation import Nystroem
-
 import pandas as pd
 import numpy as np
-import pickle
+import pyarrow.parquet as pq
+import pyarrow.feather as feather
 import time
-from scipy.stats import uniform, loguniform, randint
-import xgboost as xgb
-from utils import ConvertToCategory, MissingValueCategoryAs999, WeightedEnsemble, find_model_name_from_pipeline
 import sys
-import argparse
 import os
 from dotenv import load_dotenv
 
+# scikit-learn (and SciPy through it), the estimators and the process pool are imported by the functions that use
+# them: loading the clean data or the variable lists doesn't pay for them, and a job only for the models it trains
 load_dotenv()
 
 SEED = int(os.getenv("SEED"))
 PROC_DATA_PATH = os.getenv("PROC_DATA_PATH")
 MODEL_RESULTS_PATH = os.getenv("MODEL_RESULTS_PATH")
 
-df = pd.read_csv(PROC_DATA_PATH + "Dinh_2019_clean_data.csv")
+def load_clean_data(file_path=PROC_DATA_PATH + "Dinh_2019_clean_data.parquet"):
+    """
+    Parquet and feather files keep the categorical dtypes of the clean data, and are memory-mapped
+    instead of parsed. The CSV format is still read for older clean data files.
+    """
+    if file_path.endswith(".parquet"):
+        table = pq.read_table(file_path, memory_map=True)
+        # Parquet only round-trips string categories, the pandas metadata tells which columns were categorical
+        categorical_vars = [col["name"] for col in table.schema.pandas_metadata["columns"] if col["pandas_type"] == "categorical"]
+        return table.to_pandas().astype({col: "category" for col in categorical_vars})
+    if file_path.endswith(".feather"):
+        return feather.read_table(file_path, memory_map=True).to_pandas()
+    return pd.read_csv(file_path)
+
+
+def downsample(df, seed=SEED):
+    # Drops 3 out of 4 participants without any of the conditions, the same ones for the same seed
+    df = df.copy()
+    df['strata'] = (df['Diabetes_Case_I'].astype(str) +
+              '_' + df['Diabetes_Case_II'].astype(str) +
+              '_' + df['CVD'].astype(str))
+    index_to_drop = df[df['strata'] == '0_0_0'].sample(frac=0.75, random_state=seed).index
+    df = df.drop(index_to_drop).reset_index(drop=True)
+    df = df.drop('strata', axis=1)
+    return df
 
-## Downsample
-df['strata'] = (df['Diabetes_Case_I'].astype(str) +
-          '_' + df['Diabetes_Case_II'].astype(str) +
-          '_' + df['CVD'].astype(str))
-index_to_drop = df[df['strata'] == '0_0_0'].sample(frac=0.75).index
-df = df.drop(index_to_drop).reset_index(drop=True)
-df = df.drop('strata', axis=1)
 
+def load_training_data(file_path=PROC_DATA_PATH + "Dinh_2019_clean_data.parquet", seed=SEED):
+    return downsample(load_clean_data(file_path), seed)
 
-def stratified_split(df, target:str):
+
+def stratified_split(df, target:str, seed=SEED):
+    from sklearn.model_selection import train_test_split
 
     X = df.drop(columns= [
         'Diabetes_Case_I',
@@ -57,7 +65,7 @@ def stratified_split(df, target:str):
 
     X_train, X_test, y_train, y_test = train_test_split(X, y,
                                                         test_size=0.2,
-                                                        random_state=SEED,
+                                                        random_state=seed,
                                                         stratify=strata)
 
     train_target_pcr = round(y_train.reset_index()[target].sum()/len(y_train),3)
@@ -69,48 +77,113 @@ def stratified_split(df, target:str):
         return X_train, X_test, y_train, y_test
 
 
-logistic_regression = {
+def logistic_regression_search_space():
+    from sklearn.linear_model import LogisticRegression
+    from scipy.stats import uniform
+
+    return {
         'estimator': [LogisticRegression(random_state=SEED, max_iter=10_000)],
         'estimator__C': uniform(0.1, 10),
         'estimator__penalty': ['l1', 'l2'],
         'estimator__solver': ['liblinear', 'saga'],
     }
 
-support_vector_machine = {
-    'estimator': [Pipeline([
-            ('nystroem', Nystroem(random_state=SEED)),
-            ('svm', SVC(probability=True, random_state=SEED))
-        ])],
-    'estimator__nystroem__n_components': randint(10, 500),
-    'estimator__nystroem__gamma': loguniform(1e-3, 1),
-    'estimator__svm__C': loguniform(1e-3, 1e3)
-}
 
-random_forest = {
-    'estimator': [RandomForestClassifier(random_state=SEED)],
-    'estimator__n_estimators': randint(50, 200),
-    'estimator__max_features': ['sqrt', 'log2'],
-    'estimator__max_depth': randint(1, 10),
-    'estimator__criterion': ['gini', 'entropy']
-}
+def support_vector_machine_search_space():
+    # Kernel SVM approximated with Nystroem features and a linear solver. The features only depend on the fold,
+    # n_components and gamma, so these are a few discrete values: with the pipeline memory, the candidates of a fold
+    # that only differ in C reuse the cached features
+    from sklearn.pipeline import Pipeline
+    from sklearn.kernel_approximation import Nystroem
+    from scipy.stats import loguniform
+    from utils import CalibratedLinearSVC
+
+    return {
+        'estimator': [Pipeline([
+                ('nystroem', Nystroem(random_state=SEED)),
+                ('svm', CalibratedLinearSVC(random_state=SEED))
+            ])],
+        'estimator__nystroem__n_components': [100, 200, 400],
+        'estimator__nystroem__gamma': [0.003, 0.01, 0.03],
+        'estimator__svm__C': loguniform(1e-3, 1)
+    }
+
+
+def random_forest_search_space():
+    from sklearn.ensemble import RandomForestClassifier
+    from scipy.stats import randint
+
+    return {
+        'estimator': [RandomForestClassifier(random_state=SEED)],
+        'estimator__n_estimators': randint(50, 200),
+        'estimator__max_features': ['sqrt', 'log2'],
+        'estimator__max_depth': randint(1, 10),
+        'estimator__criterion': ['gini', 'entropy']
+    }
+
+
+def xgb_params():
+    # Hyperparameters of the XGBoost searches, the estimators are added by xgb_search_space
+    from scipy.stats import randint
 
-xgb = {
-    'estimator': [xgb.XGBClassifier(random_state=SEED)],
-    'estimator__n_estimators': randint(50, 200),
-    'estimator__learning_rate': [0.01,0.05,0.1],
-    'estimator__max_depth': randint(1, 10),
-    'estimator__gamma': [0, 0.5, 1],
-    'estimator__reg_alpha': [0, 0.5, 1],
-    'estimator__reg_lambda': [0.5, 1, 5],
-    'estimator__base_score': [0.2, 0.5, 1]
+    return {
+        'estimator__learning_rate': [0.01,0.05,0.1],
+        'estimator__max_depth': randint(1, 10),
+        'estimator__gamma': [0, 0.5, 1],
+        'estimator__reg_alpha': [0, 0.5, 1],
+        'estimator__reg_lambda': [0.5, 1, 5],
+        'estimator__base_score': [0.2, 0.5]
+    }
+
+
+def xgb_search_space(search):
+    # XGBoost is only imported by the searches of the XGBoost models
+    import xgboost as xgb
+    from scipy.stats import randint
+    from xgb_classifiers import EarlyStoppingXGBClassifier, CategoricalXGBClassifier
+
+    # Early stopping decides the number of trees when the search is budgeted
+    if search == 'halving':
+        return {'estimator': [EarlyStoppingXGBClassifier(n_estimators=1000, early_stopping_rounds=20, random_state=SEED)],
+                **xgb_params()}
+    # Histogram boosting trained by QuantileSearch from one quantized matrix per CV fold, the categorical variables
+    # are marked as categorical features in model_pipeline
+    if search == 'quantile':
+        return {'estimator': [CategoricalXGBClassifier(n_estimators=1000, early_stopping_rounds=20, tree_method='hist',
+                                                       random_state=SEED)],
+                **xgb_params()}
+    return {'estimator': [xgb.XGBClassifier(random_state=SEED)], 'estimator__n_estimators': randint(50, 200), **xgb_params()}
+
+# Search engine per model family:
+# - "random": RandomizedSearchCV, 50 candidates x 10 folds
+# - "halving": successive halving over the training samples, within a budget of fits
+# - "quantile": QuantileSearch (XGBoost only), max_fits / 10 candidates x 10 folds sharing the quantized folds
+search_modes = {
+    'logistic_regression': 'halving',
+    'support_vector_machine': 'halving',
+    'random_forest': 'random',
+    'xgb': 'halving',
 }
 
-def model_pipeline(X_train, y_train, model):
-    # Categorical variables
-    categorical_vars = [ 'Race_ethnicity', 'General_health', 'Health_status', 'Told_High_Cholesterol', 'Household_income', 'Relative_Had_Diabetes']
 
-    # Numerical variables
-    numerical_vars = [ 'Age', 'Alcohol_consumption', 'Arm_circumference', 'Arm_length', 'Osmolality', 'Blood_urea_nitrogen', 'Body_mass_index', 'Chloride', 'Sodium', 'Gamma_glutamyl_transferase', 'Height', 'LDL_cholesterol', 'Leg_length', 'Lymphocytes', 'Mean_cell_volume', 'Pulse', 'Self_reported_greatest_weight', 'Total_cholesterol', 'Triglycerides', 'Waist_circumference', 'Weight', 'White_blood_cell_count', 'Aspartate_aminotransferase_AST', 'Alcohol_Intake', 'Caffeine_Intake', 'Calcium_Intake', 'Carbohydrate_Intake', 'Fiber_Intake', 'Kcal_Intake', 'Sodium_Intake', 'HDL_Cholesterol', 'Diastolic_Blood_Pressure', 'Systolic_Blood_Pressure']
+def halving_n_candidates(max_fits, cv=10, factor=3):
+    # Each round keeps 1/factor of the candidates, so all rounds add up to about n_candidates * cv * factor / (factor - 1) fits
+    return max(factor, int(max_fits / cv * (factor - 1) / factor))
+
+
+# Categorical variables
+categorical_vars = [ 'Race_ethnicity', 'General_health', 'Health_status', 'Told_High_Cholesterol', 'Household_income', 'Relative_Had_Diabetes']
+
+# Numerical variables
+numerical_vars = [ 'Age', 'Alcohol_consumption', 'Arm_circumference', 'Arm_length', 'Osmolality', 'Blood_urea_nitrogen', 'Body_mass_index', 'Chloride', 'Sodium', 'Gamma_glutamyl_transferase', 'Height', 'LDL_cholesterol', 'Leg_length', 'Lymphocytes', 'Mean_cell_volume', 'Pulse', 'Self_reported_greatest_weight', 'Total_cholesterol', 'Triglycerides', 'Waist_circumference', 'Weight', 'White_blood_cell_count', 'Aspartate_aminotransferase_AST', 'Alcohol_Intake', 'Caffeine_Intake', 'Calcium_Intake', 'Carbohydrate_Intake', 'Fiber_Intake', 'Kcal_Intake', 'Sodium_Intake', 'HDL_Cholesterol', 'Diastolic_Blood_Pressure', 'Systolic_Blood_Pressure']
+
+
+def create_preprocessor():
+    from sklearn.pipeline import Pipeline
+    from sklearn.compose import ColumnTransformer
+    from sklearn.impute import SimpleImputer
+    from sklearn.preprocessing import StandardScaler
+    from utils import ConvertToCategory, MissingValueCategoryAs999
 
     categorical_pipeline = Pipeline([
         ('convert_to_cat', ConvertToCategory(categorical_vars)),
@@ -122,15 +195,70 @@ def model_pipeline(X_train, y_train, model):
         ('scaler', StandardScaler()),
     ])
 
-    preprocessor = ColumnTransformer([
+    return ColumnTransformer([
         ('categorical', categorical_pipeline, categorical_vars),
         ('numerical', numerical_pipeline, numerical_vars)
     ])
 
+
+def model_pipeline(X_train, y_train, model, memory=None, search="random", max_fits=200, n_jobs=-1, estimator_n_jobs=None):
+    """
+    memory: joblib.Memory (or folder) caching the fitted preprocessor. The preprocessor has no searched
+    hyperparameters, so it's fitted once per CV fold and every candidate of that fold reuses its output.
+    Transformers of estimators that are pipelines are cached too, once per fold and their own hyperparameters.
+    search: "random" or "halving". Successive halving starts with as many candidates as `max_fits` allows,
+    trains them on a small sample and keeps the best third of them on three times the samples each round.
+    n_jobs: parallel fits of the search. estimator_n_jobs: threads of each fit (RandomForest, XGBoost), None keeps their default.
+    The "quantile" search fits one candidate at a time, each booster with the n_jobs threads.
+    """
+    from sklearn.pipeline import Pipeline
+    from sklearn.base import clone
+
+    if search == "quantile":
+        from quantile_search import QuantileSearch
+
+        n_threads = n_jobs if n_jobs > 0 else os.cpu_count()
+        feature_types = ['c'] * len(categorical_vars) + ['q'] * len(numerical_vars)
+        model = {**model, 'estimator': [clone(estimator).set_params(tree_method='hist', n_jobs=n_threads, enable_categorical=True,
+                                                                    feature_types=feature_types)
+                                        for estimator in model['estimator']]}
+        pipeline = Pipeline([
+            ('preprocessor', create_preprocessor()),
+            ('estimator', model['estimator'][0])
+        ])
+        return QuantileSearch(pipeline, model, n_iter=max(1, max_fits // 10), cv=10)
+
+    if estimator_n_jobs is not None:
+        model = {**model, 'estimator': [clone(estimator).set_params(n_jobs=estimator_n_jobs)
+                                        if 'n_jobs' in estimator.get_params() else estimator
+                                        for estimator in model['estimator']]}
+    # Estimators that are pipelines (e.g. Nystroem features + linear SVM) cache their transformers too
+    model = {**model, 'estimator': [clone(estimator).set_params(memory=memory) if isinstance(estimator, Pipeline) else estimator
+                                    for estimator in model['estimator']]}
+
     pipeline = Pipeline([
-        ('preprocessor', preprocessor),
+        ('preprocessor', create_preprocessor()),
         ('estimator', model)
-    ])
+    ], memory=memory)
+
+    if search == "halving":
+        from sklearn.experimental import enable_halving_search_cv
+        from sklearn.model_selection import HalvingRandomSearchCV
+
+        return HalvingRandomSearchCV(
+            pipeline,
+            param_distributions=model,
+            n_candidates=halving_n_candidates(max_fits),
+            factor=3,
+            resource='n_samples',
+            min_resources='exhaust',
+            scoring='roc_auc',
+            random_state=SEED,
+            n_jobs=n_jobs,
+            cv=10,
+        )
+
+    from sklearn.model_selection import RandomizedSearchCV
 
     grid = RandomizedSearchCV(
         pipeline,
@@ -138,113 +266,358 @@ def model_pipeline(X_train, y_train, model):
         n_iter=50,
         scoring='roc_auc',
         random_state=SEED,
-        n_jobs=-1,
+        n_jobs=n_jobs,
         cv=10,
     )
     return grid
 
 
-def calculate_metrics(y_true, y_pred, y_pred_proba):
-    return {
-        'AUC': [roc_auc_score(y_true, y_pred_proba).round(3)],
-        'Precision': [precision_score(y_true, y_pred).round(3)],
-        'Recall': [recall_score(y_true, y_pred).round(3)],
-        'F1': [f1_score(y_true, y_pred).round(3)],
-    }
+def log_pruned_candidates(pipeline):
+    # Candidates of a successive halving search that didn't make it to the last round
+    if not hasattr(pipeline, 'n_iterations_'):
+        return
 
+    results = pd.DataFrame(pipeline.cv_results_)
+    last_round = results.groupby(results['params'].astype(str))['iter'].transform('max')
+    pruned = results[(results['iter'] == last_round) & (last_round < pipeline.n_iterations_ - 1)]
 
-def run_models(X_train, X_test,
-              y_train, y_test,
-              model_pipelines):
+    print(f"Successive halving: {pipeline.n_candidates_[0]} candidates, {len(results)} fits of {pipeline.cv} folds, "
+          f"{len(pruned)} candidates pruned")
+    for _, candidate in pruned.iterrows():
+        params = {key.replace('estimator__', ''): value for key, value in candidate['params'].items() if key != 'estimator'}
+        print(f"    pruned after round {candidate['iter']} ({candidate['n_resources']} samples, "
+              f"AUC {candidate['mean_test_score']:.3f}): {params}")
 
-    auc_scores = []
-    fitted_models = []
-    all_metrics = []
 
-    case  = y_train.reset_index().columns[1]
+def calculate_metrics(y_true, y_pred, y_pred_proba, bootstrap=None):
+    # AUC, Precision, Recall and F1 with their bootstrap confidence intervals (CI Low and CI High columns)
+    from evaluation import Bootstrap
 
-    # Fit models
-    for pipeline in model_pipelines:
+    bootstrap = bootstrap or Bootstrap(y_true)
+    return bootstrap.metrics(y_pred_proba, y_pred)
+
+
+def preprocessing_time_saved(pipeline, X_train):
+    """
+    Estimate of the time the preprocessing cache saves: one preprocessor fit is timed on the training set,
+    and only cv folds + 1 refit of the n_candidates x cv + 1 fits of the search need it when it's cached.
+    The other fits still pay for hashing the input to look it up in the cache.
+    """
+    import joblib
+    from sklearn.base import clone
+
+    if pipeline.estimator.memory is None:
+        return 0.0
+
+    start_time = time.time()
+    clone(pipeline.estimator.named_steps['preprocessor']).fit_transform(X_train)
+    preprocessing_time = time.time() - start_time
+
+    start_time = time.time()
+    joblib.hash(X_train)
+    hashing_time = time.time() - start_time
+
+    # Each round of a successive halving search uses a different sample, so it has its own cached preprocessors
+    n_folds = pipeline.cv if isinstance(pipeline.cv, int) else pipeline.cv.get_n_splits()
+    n_cached_fits = len(pipeline.cv_results_['params']) - getattr(pipeline, 'n_iterations_', 1)
+    return max(0, preprocessing_time - hashing_time) * n_cached_fits * n_folds
+
+
+def fit_model(X_train, X_test,
+              y_train, y_test,
+              pipeline, profiler=None, results_path=MODEL_RESULTS_PATH):
+    # Fit and save one model search (in the registry of results_path), returning it with its row of the metrics table
+    from sklearn.base import clone
+    from utils import find_model_name_from_pipeline
+    from training_profiler import TrainingProfiler
 
-        model_name = find_model_name_from_pipeline(pipeline.param_distributions)
+    case  = y_train.reset_index().columns[1]
+    model_name = find_model_name_from_pipeline(pipeline.param_distributions)
+    profiler = profiler or TrainingProfiler()
+
+    if profiler.enabled:
+        # One fit of the preprocessor on the training set, the search fits it once per CV fold
+        with profiler.stage('preprocess', case, model_name):
+            clone(pipeline.estimator.named_steps['preprocessor']).fit_transform(X_train)
 
-        print(f"Training model: {model_name} predicting {case}...")
-        start_time = time.time()
+    print(f"Training model: {model_name} predicting {case}...")
+    start_time = time.time()
 
+    with profiler.stage('search', case, model_name):
         pipeline.fit(X_train, y_train)
+    log_pruned_candidates(pipeline)
 
-        # Save models
-        filename = f'dinh_model_{case}_{model_name}.pkl'
-        with open(MODEL_RESULTS_PATH + filename, 'wb') as file:
-            pickle.dump(pipeline, file)
+    end_time = time.time()
+    training_time = end_time - start_time
+    print(f"Model {model_name} training time: {training_time:.2f} seconds")
+    profiler.record_search(pipeline, case, model_name, pipeline.n_jobs if pipeline.n_jobs > 0 else os.cpu_count())
 
-        end_time = time.time()
-        training_time = end_time - start_time
-        print(f"Model {model_name} training time: {training_time:.2f} seconds")
+    # One predict_proba pass, predict is its argmax
+    with profiler.stage('predict', case, model_name):
+        probas = pipeline.predict_proba(X_test)
+    y_pred = pipeline.classes_[probas.argmax(axis=1)]
+    y_pred_proba = probas[:, 1]
 
-        y_pred = pipeline.predict(X_test)
-        y_pred_proba = pipeline.predict_proba(X_test)[:, 1]
+    # Metrics
+    metrics = calculate_metrics(y_test, y_pred, y_pred_proba)
 
-        # Metrics
-        metrics = calculate_metrics(y_test, y_pred, y_pred_proba)
-        auc_scores.append(metrics['AUC'][0])
-        fitted_models.append(pipeline)
+    # Save the best pipeline of the search
+    from model_registry import save_model, data_hash
+    with profiler.stage('save', case, model_name):
+        save_model(pipeline, case, metrics, data_hash(X_train, y_train), training_time, model_name,
+                   registry_path=os.path.join(results_path, "registry"))
 
-        all_metrics.append({
-            'Case': case,
-            'Model': model_name,
-            'Training Time (seconds)': f'{training_time:.2f}',
-            **metrics
-        })
+    return pipeline, {
+        'Case': case,
+        'Model': model_name,
+        'Training Time (seconds)': round(training_time, 2),
+        'Preprocessing Cache Saving (seconds)': round(preprocessing_time_saved(pipeline, X_train), 2),
+        **metrics
+    }
 
-    print(f"Creating AUC Weighted Ensemble...")
-    # Normalize AUC scores to use as weights
-    weights = np.array(auc_scores) / sum(auc_scores)
 
-    # Create auc weighted ensemble
-    ensemble = WeightedEnsemble(fitted_models, weights)
+def ensemble_metrics(X_test, y_test, fitted_models, auc_scores, bootstrap=None, results_path=MODEL_RESULTS_PATH):
+    # Row of the ensemble in the metrics table, and its positive class probabilities on the test set
+    from ensemble_inference import BatchEnsemble
+
+    case  = y_test.reset_index().columns[1]
+
+    print(f"Creating AUC Weighted Ensemble...")
+    # Create auc weighted ensemble, the AUC scores are normalized to use as weights
+    ensemble = BatchEnsemble.from_models(fitted_models, auc_scores)
+    ensemble.save(os.path.join(results_path, f'dinh_ensemble_{case}.pkl'))
 
     # Stack the ensemble model prediction to the table
-    y_pred = ensemble.predict(X_test)
     y_pred_proba = ensemble.predict_proba(X_test)
+    y_pred = (y_pred_proba >= 0.5).astype(int)
 
-    ensemble_metrics = calculate_metrics(y_test, y_pred, y_pred_proba)
-    all_metrics.append({
+    # No training: the time columns are left empty
+    return {
         'Case': case,
         'Model': 'AUC Weighted Ensemble',
-        'Training Time (seconds)': 'Training not needed',
-        **ensemble_metrics
-    })
+        'Training Time (seconds)': np.nan,
+        'Preprocessing Cache Saving (seconds)': np.nan,
+        **calculate_metrics(y_test, y_pred, y_pred_proba, bootstrap)
+    }, y_pred_proba
 
-    # Create a table with all metrics
-    return pd.DataFrame(all_metrics)
 
+def run_models(X_train, X_test,
+              y_train, y_test,
+              model_pipelines):
 
-def main():
-    targets = ['Diabetes_Case_I', 'Diabetes_Case_II', 'CVD']
-    table_metrics = pd.DataFrame()
+    fitted_models = []
+    all_metrics = []
 
-    for target in targets:
-        X_train, X_test, y_train, y_test = stratified_split(df, target)
-        pipeline_logistic_regression = model_pipeline(X_train, y_train, logistic_regression)
-        #pipeline_svm = model_pipeline(X_train, y_train, support_vector_machine)
-        pipeline_random_forest = model_pipeline(X_train, y_train, random_forest)
-        pipeline_xgb = model_pipeline(X_train, y_train, xgb)
+    # Fit models
+    for pipeline in model_pipelines:
+        fitted_model, metrics = fit_model(X_train, X_test, y_train, y_test, pipeline)
+        fitted_models.append(fitted_model)
+        all_metrics.append(metrics)
 
-        model_pipelines = [
-                           pipeline_logistic_regression,
-                           #pipeline_svm,
-                           pipeline_random_forest,
-                           pipeline_xgb]
+    auc_scores = [metrics['AUC'] for metrics in all_metrics]
+    all_metrics.append(ensemble_metrics(X_test, y_test, fitted_models, auc_scores)[0])
+
+    # Create a table with all metrics
+    return pd.DataFrame(all_metrics)
 
-        metrics = run_models(X_train, X_test,
-                             y_train, y_test,
-                             model_pipelines)
 
-        table_metrics = pd.concat([table_metrics, metrics], ignore_index=True)
+def model_family_search_space(family, search=None):
+    search = search or search_modes[family]
+    if family == 'xgb':
+        return xgb_search_space(search)
+    return {
+        'logistic_regression': logistic_regression_search_space,
+        'support_vector_machine': support_vector_machine_search_space,
+        'random_forest': random_forest_search_space,
+    }[family]()
+
+
+def run_training_job(df, target, family, n_cores, memory_location, profiler, search=None, results_path=MODEL_RESULTS_PATH,
+                     seed=SEED):
+    """
+    Runs in a worker process of schedule_training: fits one (target, model family) search using `n_cores`
+    parallel fits, each of them with a single estimator and BLAS thread (the "quantile" search fits one
+    booster at a time with `n_cores` threads). search: search mode, the one of search_modes by default.
+    """
+    import psutil
+    from joblib import Memory, parallel_config
+    from threadpoolctl import threadpool_limits
+    from utils import find_model_name_from_pipeline
+    from training_profiler import cpu_seconds, cpu_seconds_since
+
+    search = search or search_modes[family]
+    process = psutil.Process()
+    cpu_start = cpu_seconds(process)
+    start_time = time.time()
+
+    # The stages are recorded under the model name, like the ones of fit_model
+    search_space = model_family_search_space(family, search)
+    with profiler.stage('split', target, find_model_name_from_pipeline(search_space)):
+        X_train, X_test, y_train, y_test = stratified_split(df, target, seed)
+    pipeline = model_pipeline(X_train, y_train, search_space, Memory(memory_location, verbose=0),
+                              search=search, n_jobs=n_cores, estimator_n_jobs=1)
+
+    with threadpool_limits(limits=1), parallel_config(backend="loky", inner_max_num_threads=1):
+        fitted_model, metrics = fit_model(X_train, X_test, y_train, y_test, pipeline, profiler, results_path)
+
+    wall_time = time.time() - start_time
+    cpu_time = cpu_seconds_since(process, cpu_start)
+
+    # Only the best pipeline goes back to the main process, not the whole search
+    return fitted_model.best_estimator_, metrics, wall_time, cpu_time, profiler
+
+
+def schedule_training(df, targets, families, n_cores=None, parallel_jobs=None, profiler=None, searches=None, explain=False,
+                      results_path=MODEL_RESULTS_PATH, seed=SEED):
+    """
+    Spreads the (target, model family) jobs over a process pool. Each of the `parallel_jobs` workers gets an
+    explicit budget of n_cores // parallel_jobs cores for its search, instead of every search using all the cores
+    (n_jobs=-1) and every RandomForest / XGBoost fit its default threads on top of it.
+    The ensembles are created once all the models of a target are fitted, and the AUC of every pair of models of
+    a target compared on the same bootstrap resamples of its test set (in table.attrs["comparisons"]).
+    profiler: TrainingProfiler collecting the stages of the jobs, run in the workers, and of the ensembles.
+    searches: {model family: search mode} replacing the ones of search_modes.
+    explain: global importances of the models of each target on its test set, in table.attrs["importances"].
+    results_path: folder of the model registry and the ensembles written by the run.
+    seed: seed of the train / test split of each target, the one df was downsampled with.
+    """
+    import shutil
+    import tempfile
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from joblib import Memory
+    from evaluation import Bootstrap, compare_models
+    from training_profiler import TrainingProfiler
+
+    searches = {**search_modes, **(searches or {})}
+    n_cores = n_cores or os.cpu_count()
+    profiler = profiler or TrainingProfiler()
+    jobs = [(target, family) for target in targets for family in families]
+    parallel_jobs = min(parallel_jobs or len(families), len(jobs), n_cores)
+    cores_per_job = max(1, n_cores // parallel_jobs)
+    print(f"Scheduling {len(jobs)} jobs: {parallel_jobs} in parallel with {cores_per_job} cores each")
+
+    # Fitted preprocessors shared by all the candidates of a CV fold
+    memory = Memory(location=tempfile.mkdtemp(prefix="dinh_2019_preprocessing_"), verbose=0)
+
+    # One BLAS / OpenMP thread in the workers, inherited when they are spawned
+    thread_variables = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+    environment = {variable: os.environ.get(variable) for variable in thread_variables}
+    os.environ.update({variable: "1" for variable in thread_variables})
+
+    results = {}
+    start_time = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=parallel_jobs, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {executor.submit(run_training_job, df, target, family, cores_per_job, memory.location,
+                                       profiler.worker_profiler(), searches[family], results_path, seed): (target, family)
+                       for target, family in jobs}
+            for future in as_completed(futures):
+                target, family = futures[future]
+                fitted_model, metrics, wall_time, cpu_time, job_profiler = future.result()
+                results[target, family] = fitted_model, metrics
+                profiler.merge(job_profiler)
+                print(f"--> Job {target} / {family}: {wall_time:.1f} s, {cpu_time:.1f} CPU s, "
+                      f"{100 * cpu_time / (wall_time * cores_per_job):.0f}% of {cores_per_job} cores")
+    finally:
+        for variable, value in environment.items():
+            if value is None:
+                os.environ.pop(variable)
+            else:
+                os.environ[variable] = value
+        shutil.rmtree(memory.location, ignore_errors=True)
+
+    print(f"--> All jobs: {time.time() - start_time:.1f} s on {n_cores} cores")
+
+    table_metrics = []
+    comparisons = []
+    importances = []
+    for target in targets:
+        _, X_test, _, y_test = stratified_split(df, target, seed)
+        bootstrap = Bootstrap(y_test)
+        fitted_models = [results[target, family][0] for family in families]
+        target_metrics = [results[target, family][1] for family in families]
+        auc_scores = [metrics['AUC'] for metrics in target_metrics]
+        with profiler.stage('ensemble', target):
+            ensemble_row, ensemble_proba = ensemble_metrics(X_test, y_test, fitted_models, auc_scores, bootstrap, results_path)
+        table_metrics += target_metrics + [ensemble_row]
+
+        probas = {metrics['Model']: model.predict_proba(X_test)[:, 1] for model, metrics in zip(fitted_models, target_metrics)}
+        probas[ensemble_row['Model']] = ensemble_proba
+        comparisons.append(compare_models(bootstrap, probas).assign(Case=target))
+
+        if explain:
+            from explain import target_importances
+            with profiler.stage('explain', target):
+                importances.append(target_importances(
+                    {metrics['Model']: model for model, metrics in zip(fitted_models, target_metrics)}, X_test, target))
+
+    table_metrics = pd.DataFrame(table_metrics)
+    comparisons = pd.concat(comparisons, ignore_index=True)
+    table_metrics.attrs["comparisons"] = comparisons[['Case'] + [col for col in comparisons.columns if col != 'Case']]
+    if explain:
+        table_metrics.attrs["importances"] = pd.concat(importances, ignore_index=True)
+    return table_metrics
+
+
+def train(targets, families, file_path=PROC_DATA_PATH + "Dinh_2019_clean_data.parquet", seed=SEED, n_cores=None,
+          parallel_jobs=None, profiler=None, searches=None, explain=False):
+    # Trains the models of each target and family on the downsampled clean data, and writes the results tables
+    from training_profiler import TrainingProfiler
+
+    profiler = profiler or TrainingProfiler()
+    with profiler.stage('data_load'):
+        df = load_training_data(file_path, seed)
+
+    table_metrics = schedule_training(df, targets, families, n_cores, parallel_jobs, profiler, searches, explain, seed=seed)
 
     table_metrics.to_csv(MODEL_RESULTS_PATH + "dinh_2019_results.csv", index=False)
-    print(table_metrics)
+    table_metrics.attrs["comparisons"].to_csv(MODEL_RESULTS_PATH + "dinh_2019_comparisons.csv", index=False)
+    if explain:
+        table_metrics.attrs["importances"].to_csv(MODEL_RESULTS_PATH + "dinh_2019_importances.csv", index=False)
+    profiler.save()
+    return table_metrics
+
+
+def evaluate(targets, file_path=PROC_DATA_PATH + "Dinh_2019_clean_data.parquet", seed=SEED):
+    """
+    Metrics of the saved models (model registry) and ensembles of each target on its test set, the same one as in
+    training for the same data file and seed, with the paired comparisons in table.attrs["comparisons"].
+    """
+    from model_registry import load_target
+    from ensemble_inference import load_ensemble
+    from evaluation import Bootstrap, compare_models
+
+    df = load_training_data(file_path, seed)
+
+    table_metrics = []
+    comparisons = []
+    for target in targets:
+        _, X_test, _, y_test = stratified_split(df, target, seed)
+        bootstrap = Bootstrap(y_test)
+        probas = {model_name: pipeline.predict_proba(X_test)[:, 1] for model_name, pipeline in load_target(target).items()}
+        ensemble_file = MODEL_RESULTS_PATH + f'dinh_ensemble_{target}.pkl'
+        if os.path.exists(ensemble_file):
+            probas['AUC Weighted Ensemble'] = load_ensemble(ensemble_file).predict_proba(X_test)
+        if not probas:
+            raise FileNotFoundError(f"No saved models for {target}, train them first")
+
+        for model_name, y_pred_proba in probas.items():
+            y_pred = (y_pred_proba >= 0.5).astype(int)
+            table_metrics.append({'Case': target, 'Model': model_name,
+                                  **calculate_metrics(y_test, y_pred, y_pred_proba, bootstrap)})
+        comparisons.append(compare_models(bootstrap, probas).assign(Case=target))
+
+    table_metrics = pd.DataFrame(table_metrics)
+    comparisons = pd.concat(comparisons, ignore_index=True)
+    table_metrics.attrs["comparisons"] = comparisons[['Case'] + [col for col in comparisons.columns if col != 'Case']]
+    return table_metrics
+
+
+def main():
+    # Same as `python dinh_2019.py train ...`
+    from dinh_2019 import main as cli_main
+    cli_main(["train", *sys.argv[1:]])
 
 
 if __name__ == "__main__":
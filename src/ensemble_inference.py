@@ -0,0 +1,145 @@
+"""
+Batch inference engine for the AUC weighted ensemble of the Dinh et al. (2019) models.
+
+utils.WeightedEnsemble calls predict_proba of each fitted search in turn, so the same ColumnTransformer runs once
+per model. The models of a target are all refitted on the same training set, and their preprocessor has no searched
+hyperparameters, so BatchEnsemble keeps a single copy of its fitted statistics (imputed values, means and scales).
+They are applied with a few vectorized numpy operations that write one float32 matrix per chunk, and every model
+scores that same matrix. Rows are scored in chunks of `chunk_size`, so memory is bounded for any batch size.
+
+The saved artifact only holds those statistics, the final estimator of each best_estimator_ and the weights,
+not the search objects with their cv_results_:
+
+    ensemble = BatchEnsemble.from_models(fitted_models, auc_scores)
+    ensemble.save(MODEL_RESULTS_PATH + "dinh_ensemble_CVD.pkl")
+    probas = load_ensemble(MODEL_RESULTS_PATH + "dinh_ensemble_CVD.pkl").predict_proba(df)
+"""
+
+import pickle
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+
+
+def preprocessing_statistics(preprocessor):
+    # Fitted statistics of the ColumnTransformer built by dinh_2019_train_models.create_preprocessor,
+    # or of a preprocessor that already holds them (out_of_core.StreamingPreprocessor)
+    if isinstance(preprocessor, MatrixPreprocessing):
+        return {key: getattr(preprocessor, key) for key in ['categorical_vars', 'numerical_vars', 'fill_values', 'means', 'scales']}
+
+    transformers = {name: (transformer, columns) for name, transformer, columns in preprocessor.transformers_}
+    _, categorical_vars = transformers['categorical']
+    numerical_pipeline, numerical_vars = transformers['numerical']
+
+    return {
+        'categorical_vars': list(categorical_vars),
+        'numerical_vars': list(numerical_vars),
+        'fill_values': numerical_pipeline.named_steps['imputer'].statistics_,
+        'means': numerical_pipeline.named_steps['scaler'].mean_,
+        'scales': numerical_pipeline.named_steps['scaler'].scale_,
+    }
+
+
+def positive_proba(estimator, matrix, small_batch_rows=4096):
+    # RandomForest predict_proba dispatches one joblib task per tree, which takes longer than the trees themselves
+    # for a few rows: small batches go straight to the fitted trees (same probabilities, the matrix is already float32)
+    if isinstance(estimator, RandomForestClassifier) and len(matrix) <= small_batch_rows:
+        probas = np.zeros(len(matrix))
+        for tree in estimator.estimators_:
+            values = tree.tree_.predict(matrix)
+            probas += values[:, 1] / (values[:, 0] + values[:, 1])
+        return probas / len(estimator.estimators_)
+    return estimator.predict_proba(matrix)[:, 1]
+
+
+class MatrixPreprocessing:
+    # Fitted preprocessor statistics applied with numpy, set by the subclasses:
+    # categorical_vars, numerical_vars, fill_values, means and scales
+
+    def _impute_and_scale(self, numerical):
+        # In place on a float64 block of the numerical columns
+        missing = np.isnan(numerical)
+        numerical[missing] = np.broadcast_to(self.fill_values, numerical.shape)[missing]
+        numerical -= self.means
+        numerical /= self.scales
+
+    def transform(self, X):
+        # Same output as the fitted ColumnTransformer: categorical codes with missing as 999, then the scaled numerical columns
+        n_categorical = len(self.categorical_vars)
+        matrix = np.empty((len(X), n_categorical + len(self.numerical_vars)), dtype=np.float32)
+
+        categorical = matrix[:, :n_categorical]
+        categorical[:] = X[self.categorical_vars].to_numpy(np.float32, na_value=np.nan)
+        categorical[np.isnan(categorical)] = 999
+
+        numerical = X[self.numerical_vars].to_numpy(np.float64, na_value=np.nan, copy=True)
+        self._impute_and_scale(numerical)
+        matrix[:, n_categorical:] = numerical
+
+        return matrix
+
+    def transform_records(self, records):
+        # Same as transform for a list of {column: value} dicts, absent and None values are missing. No DataFrame is built
+        columns = self.categorical_vars + self.numerical_vars
+        values = np.array([[record.get(col) for col in columns] for record in records], dtype=np.float64)
+
+        n_categorical = len(self.categorical_vars)
+        categorical = values[:, :n_categorical]
+        categorical[np.isnan(categorical)] = 999
+        self._impute_and_scale(values[:, n_categorical:])
+
+        return values.astype(np.float32)
+
+
+class BatchEnsemble(MatrixPreprocessing):
+    def __init__(self, categorical_vars, numerical_vars, fill_values, means, scales, estimators, weights, chunk_size=100_000):
+        self.categorical_vars = categorical_vars
+        self.numerical_vars = numerical_vars
+        self.fill_values = fill_values
+        self.means = means
+        self.scales = scales
+        self.estimators = estimators
+        self.weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_models(cls, models, weights, chunk_size=100_000):
+        # models: fitted searches (their best_estimator_ is used) or fitted pipelines
+        pipelines = [getattr(model, 'best_estimator_', model) for model in models]
+        statistics = [preprocessing_statistics(pipeline.named_steps['preprocessor']) for pipeline in pipelines]
+
+        for other in statistics[1:]:
+            if (other['categorical_vars'] != statistics[0]['categorical_vars'] or
+                    other['numerical_vars'] != statistics[0]['numerical_vars'] or
+                    not all(np.allclose(other[key], statistics[0][key]) for key in ['fill_values', 'means', 'scales'])):
+                raise ValueError("The models of the ensemble were not fitted on the same training data")
+
+        estimators = [pipeline.named_steps['estimator'] for pipeline in pipelines]
+        return cls(**statistics[0], estimators=estimators, weights=weights, chunk_size=chunk_size)
+
+    def predict_proba_matrix(self, matrix):
+        # Weighted probability of the positive class for an already transformed matrix
+        probas = np.zeros(len(matrix))
+        for estimator, weight in zip(self.estimators, self.weights):
+            probas += weight * positive_proba(estimator, matrix)
+        return probas
+
+    def predict_proba(self, X):
+        # Weighted probability of the positive class, like WeightedEnsemble.predict_proba
+        probas = np.empty(len(X))
+        for start in range(0, len(X), self.chunk_size):
+            matrix = self.transform(X.iloc[start:start + self.chunk_size])
+            probas[start:start + len(matrix)] = self.predict_proba_matrix(matrix)
+        return probas
+
+    def predict(self, X, threshold=0.5):
+        return (self.predict_proba(X) >= threshold).astype(int)
+
+    def save(self, file_path):
+        with open(file_path, 'wb') as file:
+            pickle.dump(self, file)
+        return file_path
+
+
+def load_ensemble(file_path):
+    with open(file_path, 'rb') as file:
+        return pickle.load(file)
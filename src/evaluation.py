@@ -0,0 +1,178 @@
+"""
+Test set metrics of the Dinh et al. (2019) models with bootstrap confidence intervals, and paired comparisons.
+
+Calling roc_auc_score on each of 1,000 resamples sorts the predictions 1,000 times. Here a resample is a row of
+counts (how many times each test row is drawn), and a batch of resamples is a counts matrix:
+
+- The predictions are sorted once. The counts of the positive and negative rows are summed per distinct score
+  (reduceat over the sorted order), and the AUC of every resample is the weighted Mann-Whitney statistic of those
+  sums: the positives over the negatives with a lower score, plus half of the tied ones.
+- Precision, recall and F1 at the 0.5 threshold come from the true / false positive and false negative counts,
+  three matrix-vector products.
+
+Resamples are stratified by default: the positives and the negatives are drawn separately, so every resample has
+the class counts of the test set and an AUC. The counts are drawn from `seed` batch by batch, so two models
+evaluated with the same Bootstrap see the same resamples, which makes the bootstrap comparison paired.
+The DeLong test compares two AUCs from their covariance on the same test set, without resampling.
+
+    bootstrap = Bootstrap(y_test, n_resamples=1000)
+    metrics = bootstrap.metrics(y_pred_proba)                    # {'AUC': .., 'AUC CI Low': .., 'AUC CI High': .., ...}
+    comparison = compare_models(bootstrap, {'XGBClassifier': xgb_proba, 'AUC Weighted Ensemble': ensemble_proba})
+"""
+
+import os
+import itertools
+import numpy as np
+import pandas as pd
+from scipy.stats import norm, rankdata
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SEED = int(os.getenv("SEED"))
+
+METRICS = ['AUC', 'Precision', 'Recall', 'F1']
+
+
+def resampled_auc(counts, y_true, y_score):
+    # AUC of each row of counts (n_resamples x n_rows), with the predictions sorted once
+    order = np.argsort(y_score, kind="stable")
+    sorted_scores = y_score[order]
+    starts = np.flatnonzero(np.r_[True, sorted_scores[1:] != sorted_scores[:-1]])
+
+    positive = y_true[order] == 1
+    sorted_counts = counts[:, order]
+    positives = np.add.reduceat(np.where(positive, sorted_counts, 0), starts, axis=1)
+    negatives = np.add.reduceat(np.where(positive, 0, sorted_counts), starts, axis=1)
+
+    negatives_below = np.cumsum(negatives, axis=1) - negatives
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return ((positives * (negatives_below + 0.5 * negatives)).sum(axis=1) /
+                (positives.sum(axis=1) * negatives.sum(axis=1)))
+
+
+def resampled_classification_metrics(counts, y_true, y_pred):
+    # Precision, recall and F1 of each row of counts, 0 when they are undefined (like zero_division=0 in sklearn)
+    true_positives = counts @ ((y_true == 1) & (y_pred == 1)).astype(np.float64)
+    false_positives = counts @ ((y_true == 0) & (y_pred == 1)).astype(np.float64)
+    false_negatives = counts @ ((y_true == 1) & (y_pred == 0)).astype(np.float64)
+
+    def ratio(numerator, denominator):
+        return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+    return {
+        'Precision': ratio(true_positives, true_positives + false_positives),
+        'Recall': ratio(true_positives, true_positives + false_negatives),
+        'F1': ratio(2 * true_positives, 2 * true_positives + false_positives + false_negatives),
+    }
+
+
+class Bootstrap:
+    """
+    Resamples of a test set: `n_resamples` bootstrap samples (stratified by class by default), drawn from `seed`
+    in batches of `batch_size` resamples to bound the memory of the counts matrices.
+    """
+    def __init__(self, y_true, n_resamples=1000, stratified=True, confidence=0.95, batch_size=250, seed=SEED):
+        self.y_true = np.asarray(y_true).astype(int)
+        self.n_resamples = n_resamples
+        self.stratified = stratified
+        self.confidence = confidence
+        self.batch_size = batch_size
+        self.seed = seed
+
+    def counts(self):
+        # Counts matrices of the resamples, the same ones on every call
+        rng = np.random.default_rng(self.seed)
+        n_rows = len(self.y_true)
+        groups = [np.flatnonzero(self.y_true == label) for label in (0, 1)] if self.stratified else [np.arange(n_rows)]
+
+        for start in range(0, self.n_resamples, self.batch_size):
+            size = min(self.batch_size, self.n_resamples - start)
+            counts = np.zeros((size, n_rows))
+            for rows in groups:
+                counts[:, rows] = rng.multinomial(len(rows), np.full(len(rows), 1 / len(rows)), size=size)
+            yield counts
+
+    def resampled_metrics(self, y_pred_proba, y_pred=None, threshold=0.5):
+        # {metric: value on each resample}, y_pred being the positive class probabilities over threshold by default
+        y_score = np.asarray(y_pred_proba, dtype=np.float64)
+        y_pred = (y_score >= threshold).astype(int) if y_pred is None else np.asarray(y_pred).astype(int)
+        batches = []
+        for counts in self.counts():
+            batch = resampled_classification_metrics(counts, self.y_true, y_pred)
+            batch['AUC'] = resampled_auc(counts, self.y_true, y_score)
+            batches.append(batch)
+        return {metric: np.concatenate([batch[metric] for batch in batches]) for metric in METRICS}
+
+    def interval(self, values):
+        alpha = (1 - self.confidence) / 2
+        return np.nanquantile(values, alpha), np.nanquantile(values, 1 - alpha)
+
+    def metrics(self, y_pred_proba, y_pred=None, threshold=0.5):
+        # Point estimates on the test set and percentile confidence intervals of the resamples
+        y_score = np.asarray(y_pred_proba, dtype=np.float64)
+        y_pred = (y_score >= threshold).astype(int) if y_pred is None else np.asarray(y_pred).astype(int)
+        ones = np.ones((1, len(self.y_true)))
+        point = resampled_classification_metrics(ones, self.y_true, y_pred)
+        point['AUC'] = resampled_auc(ones, self.y_true, y_score)
+
+        resampled = self.resampled_metrics(y_score, y_pred)
+        metrics = {}
+        for metric in METRICS:
+            low, high = self.interval(resampled[metric])
+            metrics[metric] = round(float(point[metric][0]), 3)
+            metrics[f'{metric} CI Low'] = round(float(low), 3)
+            metrics[f'{metric} CI High'] = round(float(high), 3)
+        return metrics
+
+
+def delong_test(y_true, y_score_a, y_score_b):
+    """
+    DeLong test of the difference of two correlated AUCs, with the midranks of the fast DeLong algorithm
+    (Sun and Xu, 2014). Returns the AUC difference, its standard error and the two-sided p-value.
+    """
+    y_true = np.asarray(y_true).astype(int)
+    scores = np.vstack([y_score_a, y_score_b]).astype(np.float64)
+    positives, negatives = scores[:, y_true == 1], scores[:, y_true == 0]
+    n_positives, n_negatives = positives.shape[1], negatives.shape[1]
+
+    positive_ranks = rankdata(positives, axis=1)
+    negative_ranks = rankdata(negatives, axis=1)
+    all_ranks = rankdata(np.hstack([positives, negatives]), axis=1)
+
+    aucs = (all_ranks[:, :n_positives].sum(axis=1) / n_positives - (n_positives + 1) / 2) / n_negatives
+    positive_components = (all_ranks[:, :n_positives] - positive_ranks) / n_negatives
+    negative_components = 1 - (all_ranks[:, n_positives:] - negative_ranks) / n_positives
+    covariance = np.cov(positive_components) / n_positives + np.cov(negative_components) / n_negatives
+
+    difference = aucs[0] - aucs[1]
+    standard_error = np.sqrt(max(covariance[0, 0] + covariance[1, 1] - 2 * covariance[0, 1], 0))
+    if standard_error == 0:
+        return difference, standard_error, float(difference == 0)
+    return difference, standard_error, 2 * norm.sf(abs(difference) / standard_error)
+
+
+def compare_models(bootstrap, probas):
+    """
+    Paired comparisons of the AUC of every pair of models of `probas` ({model name: positive class probabilities
+    on the test set of `bootstrap`}): difference, its bootstrap confidence interval and p-value, and the DeLong p-value.
+    """
+    resampled_aucs = {model: bootstrap.resampled_metrics(proba)['AUC'] for model, proba in probas.items()}
+
+    comparisons = []
+    for model_a, model_b in itertools.combinations(probas, 2):
+        differences = resampled_aucs[model_a] - resampled_aucs[model_b]
+        low, high = bootstrap.interval(differences)
+        # Two-sided: how often the resampled difference falls on the other side of zero
+        bootstrap_p_value = min(1.0, 2 * min(np.mean(differences <= 0), np.mean(differences >= 0)))
+        difference, _, delong_p_value = delong_test(bootstrap.y_true, probas[model_a], probas[model_b])
+        comparisons.append({
+            'Model A': model_a,
+            'Model B': model_b,
+            'AUC Difference': round(float(difference), 4),
+            'AUC Difference CI Low': round(float(low), 4),
+            'AUC Difference CI High': round(float(high), 4),
+            'Bootstrap p-value': float(bootstrap_p_value),
+            'DeLong p-value': float(delong_p_value),
+        })
+    return pd.DataFrame(comparisons)
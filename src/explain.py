@@ -0,0 +1,214 @@
+"""
+Feature contributions of the Dinh et al. (2019) models, computed from the fitted models themselves.
+
+Model-agnostic SHAP (KernelExplainer) on a whole search pipeline evaluates it on thousands of perturbed rows per
+explained row. The fitted estimators of the best pipelines have exact or fast attributions of their own:
+
+- XGBoost: TreeSHAP of the booster (predict with pred_contribs=True), in log-odds. With approximate=True, the
+  Saabas attributions of the booster instead (approx_contribs=True), which only follow the path of each row.
+- LogisticRegression: coef * (x - mean of x), the exact SHAP values of a linear model with independent features,
+  in log-odds. The mean is the one of the explained rows unless a background matrix is given.
+- RandomForest: TreeSHAP of the shap package if it's installed. Otherwise the Saabas attributions: each split on
+  the path of a row gives its feature the change of the positive class probability between the node and its
+  child. The path indicators of every tree (decision_path) times a sparse (node x feature) matrix of those
+  changes gives all the contributions at once. In probability.
+
+The preprocessor is applied with ensemble_inference.MatrixPreprocessing, in chunks of `chunk_size` rows, so the
+contributions are computed on the same float32 matrix the models score. There is no one-hot encoding in
+create_preprocessor: every categorical variable is one column of codes (999 for missing), so the columns of
+the matrix, and of the contributions, are the categorical then numerical variables named by rename_columns.
+The contributions of a row plus the bias add up to the model output (log-odds or probability).
+
+    contributions = explain_model(pipeline, X_test)          # rows x variables, attrs: bias, output, method
+    importances = global_importances(contributions)          # mean |contribution| per variable
+
+    python explain.py --targets CVD                          # models of the registry on the clean data rows
+"""
+
+import os
+import time
+import argparse
+import importlib.util
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import xgboost as xgb
+from sklearn.pipeline import Pipeline
+from sklearn.linear_model import LogisticRegression
+from sklearn.ensemble import RandomForestClassifier
+from ensemble_inference import MatrixPreprocessing, preprocessing_statistics
+from xgb_classifiers import CategoricalXGBClassifier
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PROC_DATA_PATH = os.getenv("PROC_DATA_PATH")
+MODEL_RESULTS_PATH = os.getenv("MODEL_RESULTS_PATH")
+
+# Columns of the importance tables of target_importances
+IMPORTANCE_COLUMNS = ['Case', 'Model', 'Feature', 'Mean |Contribution|', 'Mean Contribution', 'Rank', 'Method', 'Output']
+
+
+class FittedPreprocessing(MatrixPreprocessing):
+    # Statistics of a fitted preprocessor, applied like BatchEnsemble does
+    def __init__(self, preprocessor):
+        for key, value in preprocessing_statistics(preprocessor).items():
+            setattr(self, key, value)
+
+    @property
+    def feature_names(self):
+        return self.categorical_vars + self.numerical_vars
+
+
+def xgb_contributions(estimator, matrix, approximate=False):
+    # TreeSHAP of the booster (Saabas if approximate), up to the best iteration of early stopping like predict_proba
+    if isinstance(estimator, CategoricalXGBClassifier):
+        data = xgb.DMatrix(estimator.categorical_matrix(matrix), feature_types=estimator.feature_types, enable_categorical=True)
+    else:
+        data = xgb.DMatrix(matrix)
+    best_iteration = getattr(estimator, 'best_iteration', None)
+    iteration_range = (0, best_iteration + 1) if best_iteration is not None else (0, 0)
+    contributions = estimator.get_booster().predict(data, pred_contribs=True, approx_contribs=approximate,
+                                                     iteration_range=iteration_range)
+    return contributions[:, :-1], contributions[:, -1]
+
+
+def linear_contributions(estimator, matrix, background_mean):
+    coef = estimator.coef_[0]
+    return (matrix - background_mean) * coef, np.full(len(matrix), estimator.intercept_[0] + background_mean @ coef)
+
+
+def saabas_paths(estimator, n_features):
+    # Sparse (node x feature) matrix of the probability changes of every split of the forest, stacked like
+    # the columns of decision_path, and the mean probability at the roots
+    blocks, root_values = [], []
+    for tree in estimator.estimators_:
+        tree = tree.tree_
+        values = tree.value[:, 0, 1] / tree.value[:, 0, :].sum(axis=1)
+        parents = np.empty(tree.node_count, dtype=np.int64)
+        split_nodes = np.flatnonzero(tree.children_left >= 0)
+        parents[tree.children_left[split_nodes]] = split_nodes
+        parents[tree.children_right[split_nodes]] = split_nodes
+
+        children = np.arange(1, tree.node_count)
+        blocks.append(sp.csr_matrix((values[children] - values[parents[children]],
+                                     (children, tree.feature[parents[children]])),
+                                    shape=(tree.node_count, n_features)))
+        root_values.append(values[0])
+    return sp.vstack(blocks).tocsr() / len(estimator.estimators_), float(np.mean(root_values))
+
+
+def forest_contributions(estimator, matrix, paths=None):
+    if paths is None:
+        # Only imported when it's used, it's slow to import
+        import shap
+        explainer = shap.TreeExplainer(estimator)
+        values = np.asarray(explainer.shap_values(matrix, check_additivity=False))
+        # One array per class (older shap) or a trailing class axis
+        values = values[1] if values.ndim == 3 and values.shape[0] == 2 else values[..., 1]
+        return values, np.full(len(matrix), np.ravel(explainer.expected_value)[1])
+    changes, root_value = paths
+    indicator, _ = estimator.decision_path(matrix)
+    return np.asarray((indicator @ changes).todense()), np.full(len(matrix), root_value)
+
+
+def explain_model(pipeline, X, chunk_size=20_000, background=None, approximate=False):
+    """
+    Contributions of each variable to the prediction of each row of X: a DataFrame with the columns of the
+    preprocessed matrix, and in attrs the bias of each row, the output they add up to and the method.
+    pipeline: fitted search (its best_estimator_ is explained) or fitted Pipeline of preprocessor and estimator.
+    background: rows whose mean a LogisticRegression contribution is relative to, X by default.
+    approximate: Saabas attributions for the tree models instead of TreeSHAP, one pass over the path of each row
+    (TreeSHAP grows with the square of the depth of the trees).
+    """
+    pipeline = getattr(pipeline, 'best_estimator_', pipeline)
+    preprocessing = FittedPreprocessing(pipeline.named_steps['preprocessor'])
+    estimator = pipeline.named_steps['estimator']
+
+    if isinstance(estimator, xgb.XGBClassifier):
+        method, output = ('Saabas (XGBoost)' if approximate else 'TreeSHAP (XGBoost)'), 'log-odds'
+        contribute = lambda matrix: xgb_contributions(estimator, matrix, approximate)
+    elif isinstance(estimator, LogisticRegression):
+        method, output = 'Linear', 'log-odds'
+        background = X if background is None else background
+        mean = np.zeros(len(preprocessing.feature_names))
+        for start in range(0, len(background), chunk_size):
+            mean += preprocessing.transform(background.iloc[start:start + chunk_size]).sum(axis=0, dtype=np.float64)
+        mean /= len(background)
+        contribute = lambda matrix: linear_contributions(estimator, matrix, mean)
+    elif isinstance(estimator, RandomForestClassifier):
+        saabas = approximate or importlib.util.find_spec('shap') is None
+        method, output = ('Saabas' if saabas else 'TreeSHAP (shap)'), 'probability'
+        paths = saabas_paths(estimator, len(preprocessing.feature_names)) if saabas else None
+        contribute = lambda matrix: forest_contributions(estimator, matrix, paths)
+    else:
+        raise ValueError(f"No native contributions for {type(estimator).__name__}")
+
+    contributions = np.empty((len(X), len(preprocessing.feature_names)), dtype=np.float32)
+    bias = np.empty(len(X))
+    for start in range(0, len(X), chunk_size):
+        matrix = preprocessing.transform(X.iloc[start:start + chunk_size])
+        contributions[start:start + len(matrix)], bias[start:start + len(matrix)] = contribute(matrix)
+
+    df = pd.DataFrame(contributions, columns=preprocessing.feature_names, index=X.index)
+    df.attrs.update({'bias': bias, 'output': output, 'method': method})
+    return df
+
+
+def global_importances(contributions):
+    # Mean absolute and mean signed contribution of each variable, the most important first
+    importances = pd.DataFrame({
+        'Feature': contributions.columns,
+        'Mean |Contribution|': np.abs(contributions.to_numpy()).mean(axis=0),
+        'Mean Contribution': contributions.to_numpy().mean(axis=0),
+    })
+    importances = importances.sort_values('Mean |Contribution|', ascending=False, ignore_index=True)
+    importances['Rank'] = np.arange(1, len(importances) + 1)
+    importances['Method'] = contributions.attrs['method']
+    importances['Output'] = contributions.attrs['output']
+    return importances
+
+
+def target_importances(models, X, target, chunk_size=20_000, approximate=False):
+    """
+    Global importances of the models of one target ({model name: fitted pipeline or search}) on the rows of X,
+    in one table with their Case and Model. Models without native contributions (the Nystroem + SVM pipeline)
+    are left out, the table is empty if none of them has any.
+    """
+    tables = []
+    for model_name, pipeline in models.items():
+        estimator = getattr(pipeline, 'best_estimator_', pipeline).named_steps['estimator']
+        if isinstance(estimator, Pipeline):
+            print(f"--> {target} / {model_name}: no native contributions, skipped")
+            continue
+        start_time = time.time()
+        contributions = explain_model(pipeline, X, chunk_size, approximate=approximate)
+        print(f"--> {target} / {model_name}: {contributions.attrs['method']} of {len(X)} rows in {time.time() - start_time:.2f} s")
+        tables.append(global_importances(contributions).assign(Case=target, Model=model_name))
+    if not tables:
+        return pd.DataFrame(columns=IMPORTANCE_COLUMNS)
+    return pd.concat(tables, ignore_index=True)[IMPORTANCE_COLUMNS]
+
+
+def main():
+    from model_registry import load_target
+    from dinh_2019_train_models import load_clean_data
+
+    parser = argparse.ArgumentParser(description="Global importances of the Dinh et al. (2019) models of the registry")
+    parser.add_argument("--targets", nargs="+", default=['Diabetes_Case_I', 'Diabetes_Case_II', 'CVD'])
+    parser.add_argument("--data", default=PROC_DATA_PATH + "Dinh_2019_clean_data.parquet",
+                        help="Rows the contributions are computed on, all the clean data rows by default")
+    parser.add_argument("--chunk-size", type=int, default=20_000)
+    parser.add_argument("--approximate", action="store_true", help="Saabas attributions of the tree models instead of TreeSHAP")
+    parser.add_argument("--output", default=MODEL_RESULTS_PATH + "dinh_2019_importances.csv")
+    args = parser.parse_args()
+
+    df = load_clean_data(args.data)
+    importances = pd.concat([target_importances(load_target(target), df, target, args.chunk_size, args.approximate) for target in args.targets],
+                            ignore_index=True)
+    importances.to_csv(args.output, index=False)
+    print(importances.groupby(['Case', 'Model']).head(5))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Model store of the Dinh et al. (2019) models, replacing the pickles of whole fitted searches.
+
+Only the best pipeline of a search is kept, in MODEL_RESULTS_PATH/registry/<target>/<model name>/:
+- metadata.json: target, model, hyperparameters, CV score, test metrics, hash of the training data, training time
+  and library versions. It's all that `list_models` reads.
+- preprocessor.joblib: the fitted ColumnTransformer.
+- estimator.ubj for XGBoost models, in the native XGBoost format, which doesn't depend on the pickled class layout.
+  estimator.joblib for the other models, saved uncompressed so that files over MMAP_MIN_BYTES can be loaded with
+  mmap_mode='r' and have their numpy arrays memory-mapped instead of copied (for small files the mapping is slower).
+
+Models are only deserialised by `load_model` (one target and model) or `load_target` (the models of one target).
+
+    python model_registry.py list
+    python model_registry.py import    # dinh_model_*.pkl searches of MODEL_RESULTS_PATH into the registry
+"""
+
+import os
+import re
+import glob
+import json
+import time
+import shutil
+import argparse
+import importlib
+import joblib
+import sklearn
+import xgboost as xgb
+import pandas as pd
+from sklearn.pipeline import Pipeline
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MODEL_RESULTS_PATH = os.getenv("MODEL_RESULTS_PATH")
+REGISTRY_PATH = os.path.join(MODEL_RESULTS_PATH, "registry")
+MMAP_MIN_BYTES = 10 * 2**20
+
+
+def data_hash(X, y):
+    return joblib.hash((X, y))
+
+
+def json_params(params):
+    # Hyperparameters that can be written to JSON and passed back to the estimator
+    return {key: value for key, value in params.items() if isinstance(value, (bool, int, float, str, type(None)))}
+
+
+def model_path(target, model_name, registry_path=REGISTRY_PATH):
+    return os.path.join(registry_path, target, model_name)
+
+
+def save_model(pipeline, target, metrics=None, training_data_hash=None, training_time=None, model_name=None,
+               registry_path=REGISTRY_PATH):
+    """
+    pipeline: fitted search (its best_estimator_ is saved) or fitted Pipeline of preprocessor and estimator.
+    model_name: the estimator class name by default. Replaces the model saved for the same target and model name.
+    """
+    best_pipeline = getattr(pipeline, 'best_estimator_', pipeline)
+    estimator = best_pipeline.named_steps['estimator']
+    model_name = model_name or type(estimator).__name__
+    is_xgboost = isinstance(estimator, xgb.XGBModel)
+
+    metadata = {
+        'target': target,
+        'model': model_name,
+        'estimator_class': f"{type(estimator).__module__}.{type(estimator).__name__}",
+        'estimator_format': 'xgboost_ubj' if is_xgboost else 'joblib',
+        'hyperparameters': json_params(estimator.get_params()),
+        'cv_score': getattr(pipeline, 'best_score_', None),
+        'metrics': metrics or {},
+        'data_hash': training_data_hash,
+        'training_time': training_time,
+        'saved_at': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'versions': {'scikit-learn': sklearn.__version__, 'xgboost': xgb.__version__},
+    }
+
+    # Written next to the final folder and renamed, so readers never see a half saved model
+    path = model_path(target, model_name, registry_path)
+    part_path = path + ".part"
+    shutil.rmtree(part_path, ignore_errors=True)
+    os.makedirs(part_path)
+
+    joblib.dump(best_pipeline.named_steps['preprocessor'], os.path.join(part_path, "preprocessor.joblib"))
+    if is_xgboost:
+        estimator.save_model(os.path.join(part_path, "estimator.ubj"))
+    else:
+        joblib.dump(estimator, os.path.join(part_path, "estimator.joblib"))
+    with open(os.path.join(part_path, "metadata.json"), "w") as file:
+        json.dump(metadata, file, indent=2, default=str)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(part_path, path)
+    return path
+
+
+def list_models(target=None, registry_path=REGISTRY_PATH):
+    # Metadata of the saved models, without loading any of them
+    models = []
+    for metadata_path in sorted(glob.glob(os.path.join(registry_path, target or "*", "*", "metadata.json"))):
+        with open(metadata_path) as file:
+            models.append(json.load(file))
+    return models
+
+
+def estimator_class(metadata):
+    module, name = metadata['estimator_class'].rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)
+
+
+def load_model(target, model_name, registry_path=REGISTRY_PATH, mmap_mode='r'):
+    path = model_path(target, model_name, registry_path)
+    with open(os.path.join(path, "metadata.json")) as file:
+        metadata = json.load(file)
+
+    preprocessor = joblib.load(os.path.join(path, "preprocessor.joblib"))
+    if metadata['estimator_format'] == 'xgboost_ubj':
+        # The booster file has the trees, the hyperparameters come from the metadata
+        estimator = estimator_class(metadata)(**metadata['hyperparameters'])
+        estimator.load_model(os.path.join(path, "estimator.ubj"))
+    else:
+        estimator_path = os.path.join(path, "estimator.joblib")
+        estimator = joblib.load(estimator_path, mmap_mode=mmap_mode if os.path.getsize(estimator_path) >= MMAP_MIN_BYTES else None)
+
+    return Pipeline([('preprocessor', preprocessor), ('estimator', estimator)])
+
+
+def load_target(target, registry_path=REGISTRY_PATH, mmap_mode='r'):
+    # {model name: fitted pipeline} of one target, the other targets are not read
+    return {metadata['model']: load_model(target, metadata['model'], registry_path, mmap_mode)
+            for metadata in list_models(target, registry_path)}
+
+
+def import_pickles(model_results_path=MODEL_RESULTS_PATH, registry_path=REGISTRY_PATH):
+    # Best pipelines of the dinh_model_<target>_<model>.pkl searches, with the metrics of dinh_2019_results.csv if it's there
+    results_path = os.path.join(model_results_path, "dinh_2019_results.csv")
+    results = pd.read_csv(results_path) if os.path.exists(results_path) else pd.DataFrame(columns=['Case', 'Model'])
+
+    for file_path in sorted(glob.glob(os.path.join(model_results_path, "dinh_model_*.pkl"))):
+        target, model_name = re.match(r"dinh_model_(.+)_([A-Za-z]+)\.pkl$", os.path.basename(file_path)).groups()
+        pipeline = joblib.load(file_path)
+
+        row = results[(results['Case'] == target) & (results['Model'] == model_name)]
+        # Older results have the metrics written as one element lists, e.g. "[0.889]"
+        metrics = {col: float(str(row[col].iloc[0]).strip("[]")) for col in ['AUC', 'Precision', 'Recall', 'F1']
+                   if col in row and len(row)}
+        training_time = float(row['Training Time (seconds)'].iloc[0]) if len(row) else None
+
+        print(f"Importing {os.path.basename(file_path)}")
+        save_model(pipeline, target, metrics, training_time=training_time, model_name=model_name, registry_path=registry_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Model store of the Dinh et al. (2019) models")
+    parser.add_argument("command", choices=["list", "import"])
+    parser.add_argument("--target", default=None, help="Only list the models of this target")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        import_pickles()
+
+    models = list_models(args.target)
+    print(pd.DataFrame([{'Case': metadata['target'], 'Model': metadata['model'],
+                         'CV AUC': metadata['cv_score'], **metadata['metrics'],
+                         'Training Time (seconds)': metadata['training_time'], 'Saved at': metadata['saved_at']}
+                        for metadata in models]).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,104 +1,262 @@
 """
-Downloading the files takes from 15 min to 30 min per year with high speed internet, the good thing is that in can get interrupted at it skips the files already downloaded - just make sure the last file was correctly writen.
+Downloading the files takes from 15 min to 30 min per year with high speed internet, the good thing is that in can get interrupted at it skips the files already downloaded.
+A parquet file only gets its final name once it's completely written, so an interrupted file is downloaded again.
+
+The five component pages and the XPT files are downloaded concurrently by a bounded pool of workers sharing
+one keep-alive connection pool. Requests to the same host are rate limited and failed requests are retried with backoff.
 """
 
 import os
-from glob import glob
+import time
+import threading
+import argparse
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
-import io
 import pyreadstat
-import tempfile
+import pyarrow as pa
+import pyarrow.parquet as pq
 import inquirer
 from dotenv import load_dotenv
+from nhanes_file_index import update_file_index, register_file
 
 load_dotenv()
 
 RAW_DATA_PATH = os.getenv("RAW_DATA_PATH")
 PROC_DATA_PATH = os.getenv("PROC_DATA_PATH")
 
-def scrape_nhanes_xpt_files(year, DATA_PATH=RAW_DATA_PATH):
+CDC_URL = "https://wwwn.cdc.gov"
+
+
+class RateLimiter:
+    """
+    Minimum interval between two requests to the same host, shared by all the workers.
+    """
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.lock = threading.Lock()
+        self.next_request = {}
+
+    def wait(self, url):
+        self.wait_host(urlparse(url).hostname)
+
+    def wait_host(self, host):
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_request.get(host, now))
+            self.next_request[host] = request_time + self.interval
+        time.sleep(max(0, request_time - now))
+
+
+class RateLimitedRetry(Retry):
+    """
+    Retry whose retried requests also wait for the rate limiter of their host. urllib3 retries inside the
+    connection pool, so they don't go through RateLimiter.wait, and the first retry has no backoff.
+    """
+    rate_limiter = None
+    host = None
+
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.rate_limiter, retry.host = self.rate_limiter, self.host
+        return retry
+
+    def increment(self, *args, _pool=None, **kwargs):
+        retry = super().increment(*args, _pool=_pool, **kwargs)
+        if _pool is not None:
+            retry.host = _pool.host
+        return retry
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        if self.rate_limiter is not None and self.host is not None:
+            self.rate_limiter.wait_host(self.host)
+
+
+def create_session(workers, retries=5, backoff_factor=1, rate_limiter=None):
+    # One keep-alive connection per worker, retrying connection errors and server errors with exponential backoff
+    retry = RateLimitedRetry(total=retries,
+                             backoff_factor=backoff_factor,
+                             status_forcelist=[429, 500, 502, 503, 504],
+                             allowed_methods=["GET"])
+    retry.rate_limiter = rate_limiter
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def scrape_xpt_links(session, rate_limiter, year, type, base_url=CDC_URL, include_paxmin=False):
+    # Type of data and year
+    url = f"{base_url}/nchs/nhanes/search/datapage.aspx?Component={type}&CycleBeginYear={year[:4]}"
+
+    rate_limiter.wait(url)
+    response = session.get(url)
+
+    # Check if the request was successful
+    if response.status_code != 200:
+        print(f"Failed to retrieve the {type} webpage. Status code: {response.status_code}")
+        return []
+
+    # Parse the HTML content
+    soup = BeautifulSoup(response.content, 'html.parser')
+
+    # Find all links that end with .XPT (case insensitive)
+    xpt_links = soup.find_all('a', href=lambda href: href and href.lower().endswith('.xpt'))
+
+    file_urls = []
+    for link in xpt_links:
+        file_url = link['href']
+        if not file_url.startswith('http') and (include_paxmin or not "PAXMIN" in file_url) and not "POL" in file_url:
+            file_urls.append(f"{base_url}{file_url}")
+
+    return file_urls
+
+
+def download_xpt_file(session, rate_limiter, file_url, parquet_path, chunksize=100_000):
+    """
+    Stream the XPT file to disk and convert it to parquet one row group of `chunksize` rows at a time,
+    so memory stays flat no matter the size of the file (e.g. PAXMIN).
+    Both files are written under a ".part" name and the parquet file is only renamed to its final name
+    once complete, so an interrupted download is never taken as an already downloaded file.
+    """
+    file_name = file_url.split('/')[-1]
+    xpt_path = parquet_path[:-len('.parquet')] + '.XPT.part'
+    partial_parquet_path = parquet_path + '.part'
+
+    try:
+        rate_limiter.wait(file_url)
+        with session.get(file_url, stream=True) as file_response:
+            if file_response.status_code != 200:
+                print(f"Failed to download {file_name}. Status code: {file_response.status_code}")
+                return None
+
+            with open(xpt_path, 'wb') as xpt_file:
+                for content in file_response.iter_content(chunk_size=1 << 20):
+                    xpt_file.write(content)
+
+        writer = None
+        reader = pyreadstat.read_file_in_chunks(pyreadstat.read_xport, xpt_path, chunksize=chunksize, encoding='cp1252')
+        for xpt_data, _ in reader:
+            if writer is None:
+                table = pa.Table.from_pandas(xpt_data, preserve_index=False)
+                writer = pq.ParquetWriter(partial_parquet_path, table.schema)
+            else:
+                table = pa.Table.from_pandas(xpt_data, schema=writer.schema, preserve_index=False)
+            writer.write_table(table)
+
+        if writer is None:
+            # Files without rows
+            xpt_data, _ = pyreadstat.read_xport(xpt_path, encoding='cp1252')
+            xpt_data.to_parquet(partial_parquet_path, index=False)
+        else:
+            writer.close()
+
+        os.replace(partial_parquet_path, parquet_path)
+        return parquet_path
+
+    finally:
+        for path in [xpt_path, partial_parquet_path]:
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+def scrape_nhanes_xpt_files(year,
+                            DATA_PATH=RAW_DATA_PATH,
+                            workers=8,
+                            requests_per_second=4,
+                            base_url=CDC_URL,
+                            include_paxmin=False,
+                            chunksize=100_000,
+                            retries=5,
+                            backoff_factor=1):
     """
-    Note PAXMIN.XPT aka "Physical Activity Monitor - Minute	" is the only file missing.
+    Note PAXMIN.XPT aka "Physical Activity Monitor - Minute	" is missing unless include_paxmin=True.
     It's +6 gigas and CDC website its not preciselly fast.
-    It takes 6 hours to download usually.
+    It takes 6 hours to download usually. Files are streamed and converted `chunksize` rows at a time,
+    so it can be downloaded with a flat memory use. `python paxmin_features.py extract` then aggregates it
+    into per-participant activity features that compile_data can read.
     Polling data without a unique identifer also will be missing ("*POL*.parquet") since
     I have no use for it.
+
+    workers=1 downloads the files one after another. A component page that still fails after `retries` retries
+    (with `backoff_factor`) is skipped, like a failed download, and the other pages and downloads go on.
     """
 
     list_types = ["Demographics", "Dietary", "Examination", "Laboratory", "Questionnaire"]
 
-    # Create folder structure for the data based on the year
-    os.chdir(DATA_PATH)
-    os.makedirs(f"{year}", exist_ok=True)
-    os.chdir(f"{year}")
+    # Files already downloaded for this year, from the raw_data manifest
+    DATA_PATH = os.path.abspath(DATA_PATH)
+    os.makedirs(DATA_PATH, exist_ok=True)
+    file_index = update_file_index(DATA_PATH)
+    downloaded_files = {entry["name"] for entry in file_index["files"].values() if entry["cycle"] == year}
 
     print(f"NHANES Data from {year} year")
     print("__________________________")
     print("__________________________")
 
-    for type in list_types:
-        # Type of data and year
-        url = f"https://wwwn.cdc.gov/nchs/nhanes/search/datapage.aspx?Component={type}&CycleBeginYear={year[:4]}"
+    rate_limiter = RateLimiter(requests_per_second)
+    session = create_session(workers, retries, backoff_factor, rate_limiter)
 
-        # Send a GET request to the URL
-        response = requests.get(url)
+    def scrape_page(type):
+        try:
+            return scrape_xpt_links(session, rate_limiter, year, type, base_url, include_paxmin)
+        except requests.RequestException as error:
+            print(f"Failed to retrieve the {type} webpage: {error}")
+            return []
 
-        # Check if the request was successful
-        if response.status_code != 200:
-            print(f"Failed to retrieve the webpage. Status code: {response.status_code}")
-            continue
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Scrape the five component pages in parallel
+        type_links = executor.map(scrape_page, list_types)
 
-        # Create folder structure for the data based on the data type
-        os.makedirs(type, exist_ok=True)
-        os.chdir(type)
-        print("### Data type:", type, "###")
-        print("__________________________")
-
-        # Parse the HTML content
-        soup = BeautifulSoup(response.content, 'html.parser')
+        downloads = {}
+        for type, file_urls in zip(list_types, type_links):
+            # Create folder structure for the data based on the year and data type
+            os.makedirs(os.path.join(DATA_PATH, year, type), exist_ok=True)
+            print("### Data type:", type, "-", len(file_urls), "files ###")
 
-        # Find all links that end with .XPT (case insensitive)
-        xpt_links = soup.find_all('a', href=lambda href: href and href.lower().endswith('.xpt'))
+            for file_url in file_urls:
+                file_name = file_url.split('/')[-1]
+                parquet_path = os.path.join(DATA_PATH, year, type, file_name.replace('.XPT', '.parquet'))
 
-        # Download and process each XPT file
-        for link in xpt_links:
-            file_url = link['href']
-            if not file_url.startswith('http') and not "PAXMIN" in file_url and not "POL" in file_url:
-                file_url = f"https://wwwn.cdc.gov{file_url}"
-            else:
-                continue
+                # Download the XPT file if it doesn't exist
+                if file_name[:-len('.XPT')] in downloaded_files:
+                    print(f"{file_name} file already in the destination folder")
+                    continue
 
-            file_name = file_url.split('/')[-1]
-            parquet_filename = file_name.replace('.XPT', '.parquet')
-
-            # Download the XPT file if it doesn't exist
-            if not os.path.exists(parquet_filename):
-                print(f"Downloading {file_name} from CDC website...")
-                file_response = requests.get(file_url)
-                if file_response.status_code == 200:
-                    # Create a temporary file so pyreadstat can read it
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.XPT') as temp_file:
-                        temp_file.write(file_response.content)
-                        temp_file_path = temp_file.name
-
-                    xpt_data, _ = pyreadstat.read_xport(temp_file_path, encoding='cp1252')
-                    xpt_data.to_parquet(parquet_filename, index=False)
-
-                    # Remove the temporary file
-                    os.unlink(temp_file_path)
-                    print(f"Saved as {parquet_filename}")
-                else:
-                    print(f"Failed to download {file_name}. Status code: {file_response.status_code}")
-            else:
-                print(f"{parquet_filename} file already in the destination folder")
+                print(f"Downloading {file_name} from {base_url}...")
+                future = executor.submit(download_xpt_file, session, rate_limiter, file_url, parquet_path, chunksize)
+                downloads[future] = file_name
 
-        # Moving again to parent directory
-        os.chdir('..')
         print("__________________________")
+        for future in as_completed(downloads):
+            try:
+                parquet_path = future.result()
+            except Exception as error:
+                print(f"Failed to download {downloads[future]}: {error}")
+                continue
+            if parquet_path:
+                # The manifest is only updated from this thread
+                register_file(parquet_path, file_index, DATA_PATH)
+                print(f"Saved as {parquet_path}")
+
+    session.close()
+    print("__________________________")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Download NHANES XPT files as parquet")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent downloads (1 = one after another)")
+    parser.add_argument("--requests-per-second", type=float, default=4, help="Rate limit per host")
+    parser.add_argument("--include-paxmin", action="store_true", help="Also download PAXMIN (+6 gigas)")
+    parser.add_argument("--chunksize", type=int, default=100_000, help="Rows per parquet row group while converting")
+    args = parser.parse_args()
+
     years = ["1999-2000", "2001-2002", "2003-2004",
         "2005-2006", "2007-2008", "2009-2010", "2011-2012","2013-2014"]
 
@@ -114,7 +272,11 @@ def main():
     selected_years = answers['selected_years']
 
     for year in selected_years:
-        scrape_nhanes_xpt_files(year)
+        scrape_nhanes_xpt_files(year,
+                                workers=args.workers,
+                                requests_per_second=args.requests_per_second,
+                                include_paxmin=args.include_paxmin,
+                                chunksize=args.chunksize)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,166 @@
+"""
+On-disk manifest of the NHANES raw_data tree, so that finding a parquet file doesn't need a recursive glob.
+
+For every parquet file it keeps: name without extension (e.g. "DEMO_D"), path (relative to RAW_DATA_PATH), cycle,
+component, column names, row count, size and mtime. Files are indexed by their relative path: NHANES reuses some
+file names in several cycles (e.g. DSBI, DSII and DSPI in all of them), so find_files gives every path of a name.
+
+The manifest is refreshed incrementally: a folder is only listed again when its mtime changed,
+and a parquet footer is only read again when the file size or mtime changed.
+"""
+
+import os
+import re
+import json
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RAW_DATA_PATH = os.getenv("RAW_DATA_PATH")
+FILE_INDEX_NAME = "nhanes_file_index.json"
+# Manifests of an older version (indexed by file name) are rebuilt
+FILE_INDEX_VERSION = 2
+
+
+def _file_entry(file_path, RAW_DATA_PATH):
+    stat = os.stat(file_path)
+    metadata = pq.read_metadata(file_path)
+    relative_path = os.path.relpath(file_path, RAW_DATA_PATH)
+    cycle = re.search(r"\d{4}-\d{4}", relative_path)
+    folder = os.path.dirname(relative_path)
+
+    return {
+        "name": os.path.basename(file_path)[:-len(".parquet")],
+        "path": relative_path,
+        "cycle": cycle.group() if cycle else None,
+        "component": os.path.basename(folder) if cycle and folder != cycle.group() else None,
+        "columns": metadata.schema.to_arrow_schema().names,
+        "num_rows": metadata.num_rows,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+    }
+
+
+def _is_stale(entry, RAW_DATA_PATH):
+    try:
+        stat = os.stat(os.path.join(RAW_DATA_PATH, entry["path"]))
+    except FileNotFoundError:
+        return True
+    return stat.st_size != entry["size"] or stat.st_mtime != entry["mtime"]
+
+
+def load_file_index(RAW_DATA_PATH=RAW_DATA_PATH):
+    index_path = os.path.join(RAW_DATA_PATH, FILE_INDEX_NAME)
+    if os.path.exists(index_path):
+        with open(index_path) as file:
+            file_index = json.load(file)
+        if file_index.get("version") == FILE_INDEX_VERSION:
+            return file_index
+    return {"version": FILE_INDEX_VERSION, "directories": {}, "files": {}}
+
+
+def save_file_index(file_index, RAW_DATA_PATH=RAW_DATA_PATH):
+    # Write to a temporary file and rename, so a crash never leaves a half written index
+    index_path = os.path.join(RAW_DATA_PATH, FILE_INDEX_NAME)
+    with open(index_path + ".tmp", "w") as file:
+        json.dump(file_index, file)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def update_file_index(RAW_DATA_PATH=RAW_DATA_PATH, print_statemets=False):
+    """
+    Load the manifest and bring it up to date with the raw_data tree:
+    - Folders with an unchanged mtime are not listed again (no files added or removed)
+    - Files with an unchanged size and mtime keep their entry
+    - Everything else gets its parquet footer read again
+    The manifest is only written back to disk if something changed.
+    """
+    file_index = load_file_index(RAW_DATA_PATH)
+    directories, files = file_index["directories"], file_index["files"]
+    changed = False
+
+    pending = ["."]
+    seen_directories = set()
+    while pending:
+        directory = pending.pop()
+        seen_directories.add(directory)
+        directory_path = os.path.join(RAW_DATA_PATH, directory)
+        mtime = os.stat(directory_path).st_mtime
+        known = directories.get(directory)
+
+        if known is None or known["mtime"] != mtime:
+            subdirectories, file_names = [], []
+            for entry in os.scandir(directory_path):
+                if entry.is_dir():
+                    subdirectories.append(os.path.normpath(os.path.join(directory, entry.name)))
+                elif entry.name.endswith(".parquet"):
+                    file_names.append(entry.name[:-len(".parquet")])
+
+            # Forget the files that were removed from this folder
+            for name in (known or {}).get("files", []):
+                if name not in file_names:
+                    files.pop(os.path.normpath(os.path.join(directory, name + ".parquet")), None)
+
+            known = {"mtime": mtime, "subdirectories": sorted(subdirectories), "files": sorted(file_names)}
+            directories[directory] = known
+            changed = True
+
+        for name in known["files"]:
+            file_path = os.path.join(directory_path, name + ".parquet")
+            key = os.path.normpath(os.path.join(directory, name + ".parquet"))
+            entry = files.get(key)
+            if entry is None or _is_stale(entry, RAW_DATA_PATH):
+                if print_statemets:
+                    print(f"Indexing {file_path}")
+                files[key] = _file_entry(file_path, RAW_DATA_PATH)
+                changed = True
+
+        pending.extend(known["subdirectories"])
+
+    # Folders that no longer exist
+    for directory in set(directories) - seen_directories:
+        for name in directories.pop(directory)["files"]:
+            files.pop(os.path.normpath(os.path.join(directory, name + ".parquet")), None)
+        changed = True
+
+    if changed:
+        save_file_index(file_index, RAW_DATA_PATH)
+
+    return file_index
+
+
+def register_file(file_path, file_index, RAW_DATA_PATH=RAW_DATA_PATH):
+    # Add a file that was just written without refreshing the whole tree
+    directory = os.path.relpath(os.path.dirname(os.path.abspath(file_path)), RAW_DATA_PATH)
+    entry = _file_entry(file_path, RAW_DATA_PATH)
+    file_index["files"][os.path.normpath(entry["path"])] = entry
+
+    # The folder mtime changed because of this file, so the folder needs to be listed again next time
+    file_index["directories"].pop(directory, None)
+    save_file_index(file_index, RAW_DATA_PATH)
+    return file_index
+
+
+def find_files(file_index, file_name, RAW_DATA_PATH=RAW_DATA_PATH):
+    # Paths of every file with this name, one per cycle (and folder) it is in
+    return sorted(os.path.join(RAW_DATA_PATH, entry["path"]) for entry in file_index["files"].values()
+                  if entry["name"] == file_name)
+
+
+def find_file(file_index, file_name, RAW_DATA_PATH=RAW_DATA_PATH, cycle=None):
+    # Path of a file name, in `cycle` if the name is used in several cycles
+    paths = [os.path.join(RAW_DATA_PATH, entry["path"]) for entry in file_index["files"].values()
+             if entry["name"] == file_name and (cycle is None or entry["cycle"] == cycle)]
+    if len(paths) > 1:
+        raise ValueError(f"{file_name} is in several cycles, pick one of them or use find_files")
+    return paths[0] if paths else None
+
+
+def file_paths_by_name(file_index, RAW_DATA_PATH=RAW_DATA_PATH):
+    # File name -> paths of the files with that name
+    file_paths = {}
+    for key in sorted(file_index["files"]):
+        entry = file_index["files"][key]
+        file_paths.setdefault(entry["name"], []).append(os.path.join(RAW_DATA_PATH, entry["path"]))
+    return file_paths
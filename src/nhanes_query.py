@@ -0,0 +1,250 @@
+"""
+Lazy queries over the raw NHANES parquet files, the filtered counterpart of compile_data:
+
+    query = NHANESQuery().select(variables).cycles("2011-2012", "2013-2014").where("RIDAGEYR", ">=", 20)
+    df = query.collect()
+
+Nothing is read until collect(). The raw_data files are a pyarrow dataset partitioned by cycle (the first folder
+of their path is the YEAR key), so the files of the cycles not asked for are pruned from their path only. Then:
+
+1. The files with the variables of the `where` conditions are scanned first, with the conditions pushed into
+   the scan: the SEQN that meet all of them, per cycle. Their rows are kept, so they are only read once.
+   A participant without a value for a condition variable doesn't meet it (like df[df["RIDAGEYR"] >= 20]).
+2. The other files only read SEQN and their planned variables, filtered to those SEQN in the scan. Row groups
+   whose SEQN statistics are out of the range of the SEQN kept are skipped without being read.
+3. The rows left are stacked and joined like in compile_data, to the same columns (SEQN, YEAR, variables).
+   With compact(), the columns are cast to the compact dtypes of compile_data before leaving arrow.
+
+The rows and compressed bytes read are compared with what compile_data reads for the same variables (from the
+parquet footers only), printed and kept in df.attrs["query_stats"].
+"""
+
+import os
+import re
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from nhanes_file_index import update_file_index, file_paths_by_name
+from utils import plan_variable_files, parquet_bytes_read, compact_dtype_plan, compact_to_pandas
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RAW_DATA_PATH = os.getenv("RAW_DATA_PATH")
+PROC_DATA_PATH = os.getenv("PROC_DATA_PATH")
+
+YEAR_PARTITIONING = ds.partitioning(pa.schema([("YEAR", pa.string())]))
+
+
+def row_group_bytes(metadata, row_group_ids, columns):
+    # Compressed size of the `columns` chunks of some row groups
+    n_bytes = 0
+    for i in row_group_ids:
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            if column.path_in_schema in columns:
+                n_bytes += column.total_compressed_size
+    return n_bytes
+
+
+def scan_fragment(fragment, columns, filter, stats):
+    # Row groups whose statistics can meet the filter, then only their rows that meet it
+    schema = fragment.physical_schema
+    row_groups = fragment.split_by_row_group(filter, schema=schema) if filter is not None else [fragment]
+    row_group_ids = [row_group.id for part in row_groups for row_group in part.row_groups]
+
+    stats["files_opened"] += 1
+    stats["row_groups_skipped"] += fragment.metadata.num_row_groups - len(row_group_ids)
+    stats["rows_scanned"] += sum(fragment.metadata.row_group(i).num_rows for i in row_group_ids)
+    stats["bytes_read"] += row_group_bytes(fragment.metadata, row_group_ids, columns)
+
+    tables = [part.to_table(schema=schema, columns=columns, filter=filter) for part in row_groups]
+    table = pa.concat_tables(tables) if tables else schema.empty_table().select(columns)
+    stats["rows_kept"] += table.num_rows
+    return table
+
+
+class NHANESQuery:
+    def __init__(self, RAW_DATA_PATH=RAW_DATA_PATH, PROC_DATA_PATH=PROC_DATA_PATH,
+                 variables=(), selected_cycles=None, conditions=(), keep_float64=None):
+        self.RAW_DATA_PATH = RAW_DATA_PATH
+        self.PROC_DATA_PATH = PROC_DATA_PATH
+        self.variables = tuple(variables)
+        self.selected_cycles = selected_cycles
+        self.conditions = tuple(conditions)
+        # None: float64 columns, otherwise compact dtypes except for these variables
+        self.keep_float64 = keep_float64
+
+    def _replace(self, **changes):
+        settings = {'RAW_DATA_PATH': self.RAW_DATA_PATH, 'PROC_DATA_PATH': self.PROC_DATA_PATH,
+                    'variables': self.variables, 'selected_cycles': self.selected_cycles, 'conditions': self.conditions,
+                    'keep_float64': self.keep_float64}
+        return NHANESQuery(**{**settings, **changes})
+
+    def select(self, *variables):
+        # Variables as in the docs, a single list works too
+        if len(variables) == 1 and not isinstance(variables[0], str):
+            variables = tuple(variables[0])
+        return self._replace(variables=self.variables + tuple(var for var in variables if var not in self.variables))
+
+    def cycles(self, *cycles):
+        return self._replace(selected_cycles=tuple(cycles))
+
+    def where(self, variable, op, value):
+        # Operators of pyarrow.parquet filters: ==, !=, <, >, <=, >=, in, not in
+        return self._replace(conditions=self.conditions + ((variable, op, value),))
+
+    def compact(self, keep_float64=()):
+        # Columns cast to the types of utils.compact_dtype_plan in the scan, YEAR as a categorical
+        return self._replace(keep_float64=tuple(keep_float64))
+
+    def _fragments(self, plan, cycles):
+        # {path: fragment} of the planned files in the selected cycles, pruned on the YEAR partition key
+        dataset = ds.dataset(sorted(plan), format="parquet", partitioning=YEAR_PARTITIONING,
+                             partition_base_dir=self.RAW_DATA_PATH)
+        year_filter = ds.field("YEAR").isin(list(cycles)) if cycles is not None else None
+        return {os.path.normpath(fragment.path): fragment for fragment in dataset.get_fragments(filter=year_filter)}
+
+    def collect(self, print_statemets=True):
+        file_index = update_file_index(self.RAW_DATA_PATH)
+        file_paths = file_paths_by_name(file_index, self.RAW_DATA_PATH)
+        condition_vars = [var for var, _, _ in self.conditions]
+        plan = plan_variable_files(list(dict.fromkeys(self.variables + tuple(condition_vars))), file_index, file_paths,
+                                   self.PROC_DATA_PATH, self.RAW_DATA_PATH)
+        plan = {os.path.normpath(path): variables for path, variables in plan.items()}
+        demo_files = {os.path.normpath(path) for name, paths in file_paths.items() if "DEMO" in name for path in paths}
+        for path in demo_files:
+            plan.setdefault(path, [])
+        fragments = self._fragments(plan, self.selected_cycles)
+        compact = self.keep_float64 is not None
+        # Types from the footers of the files of the selected cycles only
+        dtypes = (compact_dtype_plan({path: plan[path] for path in fragments}, self.PROC_DATA_PATH, self.keep_float64)
+                  if compact else {})
+
+        stats = {"files_opened": 0, "row_groups_skipped": 0, "rows_scanned": 0, "rows_kept": 0, "bytes_read": 0}
+
+        # 1. SEQN meeting every condition, per cycle. The files of the condition variables are read once,
+        # with all their planned columns, and their rows meeting the conditions are kept for step 2
+        scanned = {}
+        kept_seqn = {}
+        for i, (var, op, value) in enumerate(self.conditions):
+            condition = pq.filters_to_expression([(var.upper(), op, value)])
+            meets = {}
+            for path, fragment in fragments.items():
+                if var not in plan[path]:
+                    continue
+                if path in scanned:
+                    scanned[path] = scanned[path].filter(condition)
+                else:
+                    columns = ["SEQN"] + sorted({var.upper() for var in plan[path]})
+                    scanned[path] = scan_fragment(fragment, columns, condition, stats)
+                year = ds.get_partition_keys(fragment.partition_expression)["YEAR"]
+                meets.setdefault(year, []).append(scanned[path].column("SEQN").to_numpy())
+            meets = {year: np.unique(np.concatenate(seqn)) for year, seqn in meets.items()}
+            kept_seqn = meets if i == 0 else {year: np.intersect1d(seqn, meets[year])
+                                              for year, seqn in kept_seqn.items() if year in meets}
+
+        def seqn_filter(year):
+            if not self.conditions:
+                return None
+            seqn = kept_seqn.get(year, np.array([]))
+            if not len(seqn):
+                return pc.field("SEQN").isin(pa.array([], pa.float64()))
+            # The range lets the scan skip row groups from their statistics, isin keeps the exact rows
+            return ((pc.field("SEQN") >= float(seqn[0])) & (pc.field("SEQN") <= float(seqn[-1])) &
+                    pc.field("SEQN").isin(pa.array(seqn)))
+
+        # 2. Participants of the selected cycles and the values of their variables
+        master = []
+        variable_columns = {var: [] for var in self.variables}
+        for path in sorted(fragments):
+            fragment = fragments[path]
+            year = ds.get_partition_keys(fragment.partition_expression)["YEAR"]
+            variables = [var for var in plan[path] if var in variable_columns]
+            if not variables and path not in demo_files:
+                continue
+
+            # The DEMO files give the participants of the cycle, read once with their variables
+            columns = ["SEQN"] + sorted({var.upper() for var in variables})
+            if path in scanned:
+                table = scanned[path].filter(seqn_filter(year)).select(columns)
+            else:
+                table = scan_fragment(fragment, columns, seqn_filter(year), stats)
+            df = compact_to_pandas(table, dtypes) if compact else table.to_pandas()
+            if path in demo_files:
+                master.append(pd.DataFrame({"SEQN": df["SEQN"].to_numpy(), "YEAR": year}))
+            df = df.set_index("SEQN")
+            for var in variables:
+                variable_columns[var].append(df[var.upper()].rename(var))
+
+        # 3. Same join as compile_data
+        master_df = (pd.concat(master, ignore_index=True) if master else
+                     pd.DataFrame({"SEQN": np.array([], np.int32 if compact else np.float64), "YEAR": []}))
+        master_df.sort_values(by=["SEQN", "YEAR"], inplace=True)
+        if compact:
+            master_df["YEAR"] = master_df["YEAR"].astype("category")
+        # Variables without files in the selected cycles keep the SEQN type, for the join to keep it
+        empty_index = pd.Index([], dtype=master_df["SEQN"].dtype, name="SEQN")
+        variables_df = pd.concat(
+            [pd.concat(columns) if columns else pd.Series(np.nan, index=empty_index, name=var)
+             for var, columns in variable_columns.items()],
+            axis=1)
+        master_df = master_df.join(variables_df, on="SEQN").reset_index(drop=True)
+
+        stats.update(self.eager_stats(plan, demo_files))
+        stats["rows_skipped"] = stats["eager_rows"] - stats["rows_kept"]
+        stats["bytes_skipped"] = stats["eager_bytes"] - stats["bytes_read"]
+        master_df.attrs["query_stats"] = stats
+
+        if print_statemets:
+            print(f"--> Query of {len(self.variables)} variables: {len(master_df):,} participants, "
+                  f"{stats['files_opened']} file scans ({stats['row_groups_skipped']} row groups skipped), "
+                  f"{stats['rows_kept']:,} of {stats['rows_scanned']:,} rows scanned kept, "
+                  f"{stats['bytes_read'] / 1e6:.1f} MB read")
+            print(f"--> Compared with compile_data: {stats['rows_skipped']:,} of {stats['eager_rows']:,} rows "
+                  f"and {stats['bytes_skipped'] / 1e6:.1f} of {stats['eager_bytes'] / 1e6:.1f} MB skipped")
+
+        return master_df
+
+    def eager_stats(self, plan, demo_files):
+        # Rows and compressed bytes compile_data reads for the same variables, from the footers
+        eager_rows, eager_bytes = 0, 0
+        for path, variables in plan.items():
+            variables = [var for var in variables if var in self.variables]
+            parquet_file = pq.ParquetFile(path)
+            for columns in ([["SEQN"]] if path in demo_files else []) + ([["SEQN"] + sorted({var.upper() for var in variables})] if variables else []):
+                eager_rows += parquet_file.metadata.num_rows
+                eager_bytes += parquet_bytes_read(parquet_file, columns)
+        return {"eager_rows": eager_rows, "eager_bytes": eager_bytes}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lazy query of NHANES variables with filters pushed into the parquet scan")
+    parser.add_argument("variables", nargs="+")
+    parser.add_argument("--cycles", nargs="+", default=None, help="e.g. 2011-2012 2013-2014, all of them by default")
+    parser.add_argument("--min-age", type=float, default=None, help="Only participants with RIDAGEYR >= min age")
+    parser.add_argument("--output", default=None, help="Parquet file of the result")
+    parser.add_argument("--compact", action="store_true", help="Compact dtypes instead of float64 columns")
+    args = parser.parse_args()
+
+    query = NHANESQuery().select(args.variables)
+    if args.cycles:
+        query = query.cycles(*args.cycles)
+    if args.min_age is not None:
+        query = query.where("RIDAGEYR", ">=", args.min_age)
+    if args.compact:
+        query = query.compact()
+
+    df = query.collect()
+    if args.output:
+        df.to_parquet(args.output, index=False)
+    print(df)
+
+
+if __name__ == "__main__":
+    main()
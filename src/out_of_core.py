@@ -0,0 +1,409 @@
+"""
+Out-of-core training of the Dinh et al. (2019) models, for clean data files larger than the memory.
+
+The clean parquet file is never loaded whole: ParquetChunks reads `batch_size` rows of the needed columns at a time,
+and the train / test split is a hash of SEQN, so every pass over the file puts a participant on the same side.
+
+- StreamingPreprocessor computes the imputer and scaler statistics of create_preprocessor in one pass (running
+  count, mean and sum of squared deviations per column, merged chunk by chunk) and gives the same matrix.
+- The search transforms the training chunks once and spills them as float32 .npy files, read back memory-mapped
+  by every candidate. A hashed 10% of the training participants is held out to score the candidates.
+- The logistic model is an SGDClassifier with log loss behind a StandardScaler, both fitted with partial_fit
+  over the chunks (one pass for the scaler, `n_epochs` for the classifier).
+- XGBoost reads the chunks through a DataIter into one ExtMemQuantileDMatrix, whose quantized pages stay on disk,
+  shared by all the candidates (QuantileDMatrix keeps them in memory with --in-memory). The number of trees is
+  decided by early stopping on the held out participants.
+
+out_of_core_model_pipeline has the arguments of model_pipeline and the fitted search the attributes fit_model
+uses (best_estimator_, best_score_, cv_results_, predict_proba), with the chunks as X and the target name as y.
+The models are saved in the registry, and the AUC weighted ensemble of each target next to the results:
+
+    python out_of_core.py --data clean_data.parquet --batch-size 100000
+"""
+
+import os
+import time
+import tempfile
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import xgboost as xgb
+from sklearn.base import BaseEstimator, TransformerMixin, clone
+from sklearn.pipeline import Pipeline
+from sklearn.linear_model import SGDClassifier
+from sklearn.preprocessing import StandardScaler
+from sklearn.model_selection import ParameterSampler
+from sklearn.metrics import roc_auc_score
+from scipy.stats import loguniform
+from dinh_2019_train_models import (SEED, PROC_DATA_PATH, MODEL_RESULTS_PATH, categorical_vars, numerical_vars,
+                                    xgb_params, calculate_metrics)
+from ensemble_inference import MatrixPreprocessing, BatchEnsemble
+from model_registry import save_model
+
+TARGETS = ['Diabetes_Case_I', 'Diabetes_Case_II', 'CVD']
+
+# SGD is sensitive to the scale of the features, and the categorical codes (1-9, 999 when missing) are not scaled
+sgd_logistic_regression = {
+    'estimator': [Pipeline([
+            ('scaler', StandardScaler()),
+            ('sgd', SGDClassifier(loss='log_loss', random_state=SEED))
+        ])],
+    'estimator__sgd__alpha': loguniform(1e-5, 1e-2),
+    'estimator__sgd__penalty': ['l1', 'l2'],
+}
+
+xgb_external_memory = {
+    **xgb_params(),
+    'estimator': [xgb.XGBClassifier(n_estimators=1000, early_stopping_rounds=20, tree_method='hist', random_state=SEED)],
+}
+
+out_of_core_search_spaces = {
+    'logistic_regression': sgd_logistic_regression,
+    'xgb': xgb_external_memory,
+}
+
+out_of_core_model_names = {
+    'logistic_regression': 'SGDClassifier',
+    'xgb': 'XGBClassifier',
+}
+
+
+def split_fraction(seqn, salt=0):
+    # SplitMix64 hash of the participant ids: a number in [0, 1) per participant, the same on every pass over the file
+    with np.errstate(over='ignore'):
+        z = np.asarray(seqn).astype(np.uint64) + np.uint64(salt + 1) * np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)) / 2**53
+
+
+class ParquetChunks:
+    """
+    Iterable over the rows of a parquet file, `batch_size` rows and `columns` at a time.
+    subset: None (all rows), "train" or "test", the test rows being a hashed `test_size` of the participants.
+    """
+    def __init__(self, file_path, columns=None, batch_size=100_000, subset=None, test_size=0.2):
+        self.file_path = file_path
+        self.columns = columns
+        self.batch_size = batch_size
+        self.subset = subset
+        self.test_size = test_size
+
+    def __iter__(self):
+        # Pre-buffering keeps the column chunks already read in the arrow memory pool, its peak grows with the file
+        parquet_file = pq.ParquetFile(self.file_path, pre_buffer=False)
+        for batch in parquet_file.iter_batches(batch_size=self.batch_size, columns=self.columns):
+            chunk = batch.to_pandas()
+            if self.subset is not None:
+                in_test = split_fraction(chunk['SEQN'].to_numpy()) < self.test_size
+                chunk = chunk[in_test if self.subset == "test" else ~in_test].reset_index(drop=True)
+            if len(chunk):
+                yield chunk
+
+
+class StreamingPreprocessor(MatrixPreprocessing, TransformerMixin, BaseEstimator):
+    """
+    SimpleImputer (mean) + StandardScaler of the numerical columns and missing categories as 999, fitted one chunk
+    at a time. fit takes a DataFrame or an iterable of chunks, transform returns the float32 matrix of BatchEnsemble.
+    """
+    def __init__(self, categorical_vars, numerical_vars):
+        self.categorical_vars = categorical_vars
+        self.numerical_vars = numerical_vars
+
+    def partial_fit(self, X, y=None):
+        values = X[self.numerical_vars].to_numpy(np.float64, na_value=np.nan)
+        count = (~np.isnan(values)).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.nansum(values, axis=0) / count
+        m2 = np.nansum((values - mean) ** 2, axis=0)
+
+        if not hasattr(self, 'n_rows_'):
+            self.n_rows_ = 0
+            self.count_ = np.zeros(len(self.numerical_vars))
+            self.mean_ = np.zeros(len(self.numerical_vars))
+            self.m2_ = np.zeros(len(self.numerical_vars))
+
+        # Merge of the running and chunk statistics (Chan et al.), columns without values in the chunk are kept
+        total = self.count_ + count
+        observed = count > 0
+        delta = np.where(observed, mean - self.mean_, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean_ = np.where(observed, self.mean_ + delta * count / total, self.mean_)
+            self.m2_ = np.where(observed, self.m2_ + np.where(observed, m2, 0) + delta ** 2 * self.count_ * count / total, self.m2_)
+        self.count_ = total
+        self.n_rows_ += len(X)
+
+        # The scaler sees the imputed column: the filled rows sit at the mean and add no squared deviation
+        self.fill_values = self.mean_
+        self.means = self.mean_
+        scales = np.sqrt(self.m2_ / self.n_rows_)
+        self.scales = np.where(scales < 10 * np.finfo(np.float64).eps, 1.0, scales)
+        return self
+
+    def fit(self, X, y=None):
+        for attribute in ['n_rows_', 'count_', 'mean_', 'm2_']:
+            self.__dict__.pop(attribute, None)
+        for chunk in ([X] if isinstance(X, pd.DataFrame) else X):
+            self.partial_fit(chunk)
+        return self
+
+    def __sklearn_is_fitted__(self):
+        return hasattr(self, 'n_rows_')
+
+
+class MatrixSpill:
+    # Transformed chunks and their labels as .npy files in `directory`, memory-mapped back on every pass
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = []
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, matrix, labels):
+        if not len(matrix):
+            return
+        matrix_path = os.path.join(self.directory, f"matrix_{len(self.files)}.npy")
+        labels_path = os.path.join(self.directory, f"labels_{len(self.files)}.npy")
+        np.save(matrix_path, matrix)
+        np.save(labels_path, labels)
+        self.files.append((matrix_path, labels_path))
+
+    def __iter__(self):
+        for matrix_path, labels_path in self.files:
+            yield np.load(matrix_path, mmap_mode='r'), np.load(labels_path)
+
+    def labels(self):
+        return np.concatenate([np.load(labels_path) for _, labels_path in self.files])
+
+
+class SpillIter(xgb.DataIter):
+    # Feeds the chunks of a MatrixSpill to a (ExtMem)QuantileDMatrix
+    def __init__(self, spill, cache_prefix=None):
+        self.spill = spill
+        self.chunks = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self.chunks is None:
+            self.chunks = iter(self.spill)
+        try:
+            matrix, labels = next(self.chunks)
+        except StopIteration:
+            return False
+        input_data(data=np.ascontiguousarray(matrix), label=labels)
+        return True
+
+    def reset(self):
+        self.chunks = None
+
+
+class OutOfCoreSearch:
+    """
+    Random search over `n_iter` candidates of `param_distributions`, each one fitted once on the spilled training
+    chunks and scored (AUC) on the held out `validation_size` of the training participants. The best candidate
+    is kept as it is, there is no refit.
+    """
+    def __init__(self, estimator, param_distributions, n_iter=10, n_epochs=5, validation_size=0.1,
+                 external_memory=True, random_state=SEED):
+        self.estimator = estimator
+        self.param_distributions = param_distributions
+        self.n_iter = n_iter
+        self.n_epochs = n_epochs
+        self.validation_size = validation_size
+        self.external_memory = external_memory
+        self.random_state = random_state
+        self.n_jobs = 1
+        self.cv = 1
+
+    def spill(self, X, y, preprocessor, directory):
+        train, validation = MatrixSpill(os.path.join(directory, "train")), MatrixSpill(os.path.join(directory, "validation"))
+        for chunk in X:
+            matrix = preprocessor.transform(chunk)
+            labels = chunk[y].to_numpy(np.float32)
+            in_validation = split_fraction(chunk['SEQN'].to_numpy(), salt=1) < self.validation_size
+            train.append(matrix[~in_validation], labels[~in_validation])
+            validation.append(matrix[in_validation], labels[in_validation])
+        return train, validation
+
+    def fit_incremental(self, estimator, train):
+        # The transformers of a pipeline estimator get one partial_fit pass each, then the classifier
+        # gets `n_epochs` partial_fit passes over their output, each chunk shuffled
+        steps = estimator.steps if isinstance(estimator, Pipeline) else [('estimator', estimator)]
+
+        def transform(matrix, transformers):
+            for _, transformer in transformers:
+                matrix = transformer.transform(matrix)
+            return matrix
+
+        for i, (_, transformer) in enumerate(steps[:-1]):
+            for matrix, _ in train:
+                transformer.partial_fit(transform(matrix, steps[:i]))
+
+        rng = np.random.default_rng(self.random_state)
+        classifier = steps[-1][1]
+        for _ in range(self.n_epochs):
+            for matrix, labels in train:
+                order = rng.permutation(len(labels))
+                classifier.partial_fit(transform(matrix[order], steps[:-1]), labels[order], classes=[0, 1])
+        return estimator
+
+    def fit_booster(self, estimator, train, validation, matrices, directory):
+        # The quantized matrices are built on the first XGBoost candidate and shared by the next ones
+        if not matrices:
+            if self.external_memory:
+                matrices['train'] = xgb.ExtMemQuantileDMatrix(SpillIter(train, os.path.join(directory, "xgb_train")))
+                matrices['validation'] = xgb.ExtMemQuantileDMatrix(SpillIter(validation, os.path.join(directory, "xgb_validation")),
+                                                                   ref=matrices['train'])
+            else:
+                matrices['train'] = xgb.QuantileDMatrix(SpillIter(train))
+                matrices['validation'] = xgb.QuantileDMatrix(SpillIter(validation), ref=matrices['train'])
+
+        booster = xgb.train(estimator.get_xgb_params(), matrices['train'], num_boost_round=estimator.n_estimators,
+                            evals=[(matrices['validation'], 'validation')],
+                            early_stopping_rounds=estimator.early_stopping_rounds, verbose_eval=False)
+        if estimator.early_stopping_rounds:
+            booster = booster[:booster.best_iteration + 1]
+        estimator.load_model(bytearray(booster.save_raw('ubj')))
+        return estimator
+
+    def fit(self, X, y):
+        """
+        X: iterable of DataFrame chunks, e.g. ParquetChunks(..., subset="train"), read twice.
+        y: name of the target column of the chunks.
+        """
+        self.best_estimator_ = clone(self.estimator)
+        preprocessor = self.best_estimator_.named_steps['preprocessor'].fit(X)
+        candidates = list(ParameterSampler(self.param_distributions, self.n_iter, random_state=self.random_state))
+
+        results = []
+        with tempfile.TemporaryDirectory(prefix="dinh_2019_out_of_core_") as directory:
+            train, validation = self.spill(X, y, preprocessor, directory)
+            y_validation = validation.labels()
+            matrices = {}
+
+            for params in candidates:
+                estimator = clone(params['estimator']).set_params(
+                    **{key.replace('estimator__', ''): value for key, value in params.items() if key != 'estimator'})
+
+                start_time = time.time()
+                if isinstance(estimator, xgb.XGBModel):
+                    estimator = self.fit_booster(estimator, train, validation, matrices, directory)
+                else:
+                    estimator = self.fit_incremental(estimator, train)
+                fit_time = time.time() - start_time
+
+                start_time = time.time()
+                probas = np.concatenate([estimator.predict_proba(matrix)[:, 1] for matrix, _ in validation])
+                score = roc_auc_score(y_validation, probas)
+                results.append((params, estimator, fit_time, time.time() - start_time, score))
+
+            # The external memory pages are in the temporary folder
+            matrices.clear()
+
+        scores = np.array([score for *_, score in results])
+        best = int(scores.argmax())
+        self.cv_results_ = {
+            'params': [params for params, *_ in results],
+            'mean_fit_time': np.array([fit_time for _, _, fit_time, _, _ in results]),
+            'std_fit_time': np.zeros(len(results)),
+            'mean_score_time': np.array([score_time for _, _, _, score_time, _ in results]),
+            'mean_test_score': scores,
+            'rank_test_score': (-scores).argsort().argsort() + 1,
+        }
+        self.best_params_ = results[best][0]
+        self.best_score_ = scores[best]
+        self.best_estimator_.set_params(estimator=results[best][1])
+        self.refit_time_ = 0.0
+        self.classes_ = np.array([0, 1])
+        return self
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+
+def out_of_core_model_pipeline(X_train, y_train, model, n_iter=10, n_epochs=5, external_memory=True):
+    """
+    Same arguments as model_pipeline, for the search spaces of out_of_core_search_spaces. The search is
+    fitted with search.fit(X_train, y_train), X_train being an iterable of chunks and y_train the target name.
+    """
+    pipeline = Pipeline([
+        ('preprocessor', StreamingPreprocessor(categorical_vars, numerical_vars)),
+        ('estimator', model['estimator'][0])
+    ])
+    return OutOfCoreSearch(pipeline, model, n_iter=n_iter, n_epochs=n_epochs, external_memory=external_memory)
+
+
+def predict_chunks(positive_proba, chunks, target):
+    # Labels and positive class probabilities of all the rows of the chunks, one chunk in memory at a time
+    labels, probas = [], []
+    for chunk in chunks:
+        labels.append(chunk[target].to_numpy())
+        probas.append(positive_proba(chunk))
+    return np.concatenate(labels), np.concatenate(probas)
+
+
+def train_out_of_core(file_path, targets, families, batch_size=100_000, n_iter=10, n_epochs=5, external_memory=True):
+    columns = ['SEQN'] + categorical_vars + numerical_vars + TARGETS
+    train = ParquetChunks(file_path, columns, batch_size, subset="train")
+    test = ParquetChunks(file_path, columns, batch_size, subset="test")
+
+    table_metrics = []
+    for target in targets:
+        fitted_models = []
+        for family in families:
+            model = out_of_core_search_spaces[family]
+            model_name = out_of_core_model_names[family]
+            search = out_of_core_model_pipeline(train, target, model, n_iter, n_epochs, external_memory)
+
+            print(f"Training model: {model_name} predicting {target} out of core...")
+            start_time = time.time()
+            search.fit(train, target)
+            training_time = time.time() - start_time
+            print(f"Model {model_name} training time: {training_time:.2f} seconds")
+
+            y_test, y_pred_proba = predict_chunks(lambda chunk: search.predict_proba(chunk)[:, 1], test, target)
+            metrics = calculate_metrics(y_test, (y_pred_proba >= 0.5).astype(int), y_pred_proba)
+            save_model(search, target, metrics, training_time=training_time, model_name=model_name)
+
+            fitted_models.append(search)
+            table_metrics.append({'Case': target, 'Model': model_name,
+                                  'Training Time (seconds)': round(training_time, 2), **metrics})
+
+        if len(fitted_models) > 1:
+            print(f"Creating AUC Weighted Ensemble...")
+            ensemble = BatchEnsemble.from_models(fitted_models, [row['AUC'] for row in table_metrics[-len(fitted_models):]],
+                                                 chunk_size=batch_size)
+            ensemble.save(MODEL_RESULTS_PATH + f'dinh_ensemble_out_of_core_{target}.pkl')
+            y_test, y_pred_proba = predict_chunks(ensemble.predict_proba, test, target)
+            table_metrics.append({'Case': target, 'Model': 'AUC Weighted Ensemble',
+                                  'Training Time (seconds)': np.nan,
+                                  **calculate_metrics(y_test, (y_pred_proba >= 0.5).astype(int), y_pred_proba)})
+
+    return pd.DataFrame(table_metrics)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the Dinh et al. (2019) models without loading the clean data")
+    parser.add_argument("--data", default=PROC_DATA_PATH + "Dinh_2019_clean_data.parquet", help="Clean data parquet file")
+    parser.add_argument("--batch-size", type=int, default=100_000, help="Rows read from the file at a time")
+    parser.add_argument("--targets", nargs="+", default=TARGETS, choices=TARGETS)
+    parser.add_argument("--families", nargs="+", default=list(out_of_core_search_spaces), choices=list(out_of_core_search_spaces))
+    parser.add_argument("--n-iter", type=int, default=10, help="Candidates of each search")
+    parser.add_argument("--epochs", type=int, default=5, help="Passes over the training chunks of the SGD logistic model")
+    parser.add_argument("--in-memory", action="store_true", help="Keep the XGBoost quantized matrix in memory")
+    args = parser.parse_args()
+
+    table_metrics = train_out_of_core(args.data, args.targets, args.families, args.batch_size, args.n_iter,
+                                      args.epochs, not args.in_memory)
+    table_metrics.to_csv(MODEL_RESULTS_PATH + "dinh_2019_out_of_core_results.csv", index=False)
+    print(table_metrics)
+
+
+if __name__ == "__main__":
+    # Through the module, so that the saved StreamingPreprocessor is pickled as out_of_core and not __main__
+    import out_of_core
+    out_of_core.main()
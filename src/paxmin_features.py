@@ -0,0 +1,270 @@
+"""
+Per-participant physical activity features from the PAXMIN minute files (Physical Activity Monitor - Minute,
+2011-2012 and 2013-2014, one row per participant and minute, +6 gigas per cycle).
+
+PAXMIN is read `chunk_size` rows at a time and only the columns below. The rows are in SEQN and time order, so
+each chunk is cut before the first minute of its last participant and those minutes are carried over to the next
+chunk: memory stays the same for any file size. Each chunk is aggregated with a few numpy passes, first per
+participant day and then per participant:
+
+- PAXMTSM: activity of the minute in MIMS units, negative when it couldn't be computed.
+- PAXPREDM: predicted state of the minute, 1 wake wear, 2 sleep wear, 3 non wear, 4 unknown.
+- PAXQFM: quality flag, minutes flagged are left out like the non wear minutes.
+
+A wear minute is a wake wear minute with a valid, unflagged activity value, and a valid day has at least
+`min_wear_minutes` of them. The features are means over the valid days of the participant (missing without any):
+
+- PAXVALIDDAYS: number of valid days
+- PAXWEARMIN: wear minutes per day
+- PAXSEDMIN: sedentary minutes per day (activity below `sedentary_max`)
+- PAXMVPAMIN: moderate to vigorous activity minutes per day (activity from `mvpa_min`)
+- PAXSEDBOUTS: sedentary bouts per day, runs of at least `bout_minutes` sedentary minutes
+- PAXMIMSDAY: total activity per day in MIMS units
+
+The cut points are defaults, to be set to the ones of the study. The features are written next to the minute file
+as PAXMIN_FEATURES_<cycle suffix>.parquet and added to the raw_data manifest, so compile_data finds its variables.
+
+    python paxmin_features.py extract                                  # every PAXMIN file of RAW_DATA_PATH
+    python paxmin_features.py synthetic --subjects 14000 --output PAXMIN_G.parquet
+"""
+
+import os
+import re
+import time
+import argparse
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import psutil
+from nhanes_file_index import update_file_index, register_file
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RAW_DATA_PATH = os.getenv("RAW_DATA_PATH")
+
+PAXMIN_COLUMNS = ["SEQN", "PAXDAYM", "PAXMTSM", "PAXPREDM", "PAXQFM"]
+WAKE_WEAR, SLEEP_WEAR, NON_WEAR = 1, 2, 3
+SEDENTARY_MAX_MIMS = 10.0
+MVPA_MIN_MIMS = 20.0
+BOUT_MINUTES = 30
+MIN_WEAR_MINUTES = 600
+
+FEATURES_SCHEMA = pa.schema([
+    ("SEQN", pa.float64()),
+    ("PAXVALIDDAYS", pa.int32()),
+    ("PAXWEARMIN", pa.float32()),
+    ("PAXSEDMIN", pa.float32()),
+    ("PAXMVPAMIN", pa.float32()),
+    ("PAXSEDBOUTS", pa.float32()),
+    ("PAXMIMSDAY", pa.float32()),
+])
+
+
+def group_starts(*keys):
+    # First row of each run of equal keys
+    new_group = np.zeros(len(keys[0]), dtype=bool)
+    new_group[0] = True
+    for key in keys:
+        new_group[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(new_group), new_group
+
+
+def day_features(seqn, day, mims, prediction, quality,
+                 sedentary_max=SEDENTARY_MAX_MIMS, mvpa_min=MVPA_MIN_MIMS, bout_minutes=BOUT_MINUTES):
+    # Minutes of one or more whole participants, in order -> wear, sedentary, MVPA minutes, sedentary bouts and MIMS per day
+    wear = (prediction == WAKE_WEAR) & (mims >= 0) & (quality == 0)
+    sedentary = wear & (mims < sedentary_max)
+    mvpa = wear & (mims >= mvpa_min)
+    starts, new_day = group_starts(seqn, day)
+
+    # Sedentary runs, cut at the start of each participant day
+    previous_sedentary = np.zeros_like(sedentary)
+    previous_sedentary[1:] = sedentary[:-1]
+    run_start = sedentary & (new_day | ~previous_sedentary)
+    run_lengths = np.bincount(np.cumsum(run_start)[sedentary])[1:]
+    bouts = np.zeros(len(seqn), dtype=np.int32)
+    bouts[run_start] = run_lengths >= bout_minutes
+
+    return {
+        'SEQN': seqn[starts],
+        'wear': np.add.reduceat(wear.astype(np.int32), starts),
+        'sedentary': np.add.reduceat(sedentary.astype(np.int32), starts),
+        'mvpa': np.add.reduceat(mvpa.astype(np.int32), starts),
+        'bouts': np.add.reduceat(bouts, starts),
+        'mims': np.add.reduceat(np.where(wear, mims, 0), starts),
+    }
+
+
+def subject_features(days, min_wear_minutes=MIN_WEAR_MINUTES):
+    # Per participant day features -> one row per participant, means over the valid days
+    starts, _ = group_starts(days['SEQN'])
+    valid = days['wear'] >= min_wear_minutes
+    n_valid = np.add.reduceat(valid.astype(np.int32), starts)
+
+    def valid_mean(values):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (np.add.reduceat(np.where(valid, values, 0), starts) / n_valid).astype(np.float32)
+
+    return {
+        'SEQN': days['SEQN'][starts].astype(np.float64),
+        'PAXVALIDDAYS': n_valid,
+        'PAXWEARMIN': valid_mean(days['wear']),
+        'PAXSEDMIN': valid_mean(days['sedentary']),
+        'PAXMVPAMIN': valid_mean(days['mvpa']),
+        'PAXSEDBOUTS': valid_mean(days['bouts']),
+        'PAXMIMSDAY': valid_mean(days['mims']),
+    }
+
+
+def paxmin_chunks(paxmin_path, chunk_size=1_000_000):
+    """
+    Columns of PAXMIN_COLUMNS as numpy arrays, `chunk_size` rows at a time, every chunk holding all the minutes of
+    its participants. A participant cut by the end of a chunk is carried over to the next one.
+    """
+    parquet_file = pq.ParquetFile(paxmin_path, pre_buffer=False)
+    carry = None
+    for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=PAXMIN_COLUMNS):
+        chunk = {col: batch.column(col).to_numpy(zero_copy_only=False) for col in PAXMIN_COLUMNS}
+        if carry is not None:
+            chunk = {col: np.concatenate([carry[col], chunk[col]]) for col in PAXMIN_COLUMNS}
+
+        seqn = chunk['SEQN']
+        if np.any(seqn[1:] < seqn[:-1]):
+            raise ValueError(f"{paxmin_path} is not sorted by SEQN")
+        last_subject = np.searchsorted(seqn, seqn[-1])
+        carry = {col: values[last_subject:] for col, values in chunk.items()}
+        if last_subject:
+            yield {col: values[:last_subject] for col, values in chunk.items()}
+
+    if carry is not None and len(carry['SEQN']):
+        yield carry
+
+
+def extract_paxmin_features(paxmin_path, output_path, chunk_size=1_000_000, sedentary_max=SEDENTARY_MAX_MIMS,
+                            mvpa_min=MVPA_MIN_MIMS, bout_minutes=BOUT_MINUTES, min_wear_minutes=MIN_WEAR_MINUTES,
+                            print_statemets=True):
+    # Written under a ".part" name and renamed once complete, like the downloaded files
+    process = psutil.Process()
+    peak_rss = process.memory_info().rss
+    start_time = time.time()
+    n_rows, n_subjects = 0, 0
+
+    partial_output_path = output_path + ".part"
+    with pq.ParquetWriter(partial_output_path, FEATURES_SCHEMA) as writer:
+        for chunk in paxmin_chunks(paxmin_path, chunk_size):
+            days = day_features(chunk['SEQN'], chunk['PAXDAYM'], chunk['PAXMTSM'], chunk['PAXPREDM'], chunk['PAXQFM'],
+                                sedentary_max, mvpa_min, bout_minutes)
+            features = subject_features(days, min_wear_minutes)
+            writer.write_table(pa.table(features, schema=FEATURES_SCHEMA))
+
+            n_rows += len(chunk['SEQN'])
+            n_subjects += len(features['SEQN'])
+            peak_rss = max(peak_rss, process.memory_info().rss)
+    os.replace(partial_output_path, output_path)
+
+    stats = {'rows': n_rows, 'subjects': n_subjects, 'seconds': time.time() - start_time, 'peak_rss_mb': peak_rss / 1e6}
+    if print_statemets:
+        print(f"--> {n_rows:,} minutes of {n_subjects:,} participants in {stats['seconds']:.1f} s "
+              f"({n_rows / stats['seconds']:,.0f} rows/s, peak RSS {stats['peak_rss_mb']:.0f} MB): {output_path}")
+    return stats
+
+
+def extract_all(RAW_DATA_PATH=RAW_DATA_PATH, chunk_size=1_000_000, **thresholds):
+    # Features of every PAXMIN_<suffix> file of the raw_data manifest, next to it
+    file_index = update_file_index(RAW_DATA_PATH)
+    for key in sorted(file_index["files"]):
+        match = re.fullmatch(r"PAXMIN(_[A-Z])?", file_index["files"][key]["name"])
+        if not match:
+            continue
+        paxmin_path = os.path.join(RAW_DATA_PATH, file_index["files"][key]["path"])
+        output_path = os.path.join(os.path.dirname(paxmin_path), f"PAXMIN_FEATURES{match.group(1) or ''}.parquet")
+        extract_paxmin_features(paxmin_path, output_path, chunk_size, **thresholds)
+        register_file(output_path, file_index, RAW_DATA_PATH)
+
+
+def synthetic_paxmin(n_subjects, output_path, seed=0, subjects_per_block=100, first_seqn=62161):
+    """
+    PAXMIN shaped file of `n_subjects` participants x 9 days x 1440 minutes, written `subjects_per_block`
+    participants (one row group) at a time. Participants sleep from about 23:00 to 7:00, take the monitor off
+    some hours, and spend each waking hour sedentary, in light or in moderate to vigorous activity with their
+    own probabilities, so there are sedentary bouts. 1% of the minutes are flagged and 0.5% have no activity value.
+    """
+    rng = np.random.default_rng(seed)
+    n_days, minutes_per_day = 9, 1440
+    minutes = n_days * minutes_per_day
+    minute_of_day = np.tile(np.arange(minutes_per_day), n_days)
+    day = np.repeat(np.arange(1, n_days + 1), minutes_per_day)
+    hour = np.arange(minutes) // 60
+
+    schema = pa.schema([("SEQN", pa.float64()), ("PAXDAYM", pa.float64()), ("PAXSSNMP", pa.float64()),
+                        ("PAXMTSM", pa.float64()), ("PAXPREDM", pa.float64()), ("PAXQFM", pa.float64())])
+    partial_output_path = output_path + ".part"
+    with pq.ParquetWriter(partial_output_path, schema) as writer:
+        for block_start in range(0, n_subjects, subjects_per_block):
+            n_block = min(subjects_per_block, n_subjects - block_start)
+            shape = (n_block, minutes)
+
+            # Sleep window of each participant and hours without the monitor
+            bedtime = rng.normal(23 * 60, 45, (n_block, 1))
+            wake_time = rng.normal(7 * 60, 45, (n_block, 1))
+            asleep = (minute_of_day >= bedtime) | (minute_of_day < wake_time)
+            hours = n_days * 24
+            off = (rng.random((n_block, hours)) < rng.uniform(0, 0.15, (n_block, 1)))[:, hour]
+            prediction = np.where(off, NON_WEAR, np.where(asleep, SLEEP_WEAR, WAKE_WEAR))
+
+            # Activity state of each waking hour: 0 sedentary, 1 light, 2 moderate to vigorous
+            p_sedentary = rng.uniform(0.3, 0.7, (n_block, 1))
+            p_mvpa = rng.uniform(0.01, 0.1, (n_block, 1))
+            draw = rng.random((n_block, hours))
+            state = np.where(draw < p_sedentary, 0, np.where(draw > 1 - p_mvpa, 2, 1))[:, hour]
+            mims = rng.gamma(2.0, np.array([2.5, 7.0, 15.0])[state])
+            mims[asleep] = rng.gamma(1.0, 1.0, shape)[asleep]
+            mims[off] = 0
+            mims[rng.random(shape) < 0.005] = -0.01
+            quality = (rng.random(shape) < 0.01).astype(np.float64)
+
+            seqn = np.repeat(np.arange(first_seqn + block_start, first_seqn + block_start + n_block, dtype=np.float64), minutes)
+            writer.write_table(pa.table({
+                "SEQN": seqn,
+                "PAXDAYM": np.tile(day, n_block).astype(np.float64),
+                "PAXSSNMP": np.tile(np.arange(minutes) * 4800, n_block).astype(np.float64),
+                "PAXMTSM": mims.ravel().round(3),
+                "PAXPREDM": prediction.ravel().astype(np.float64),
+                "PAXQFM": quality.ravel(),
+            }, schema=schema))
+    os.replace(partial_output_path, output_path)
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-participant activity features of the PAXMIN minute files")
+    parser.add_argument("command", choices=["extract", "synthetic"])
+    parser.add_argument("--input", default=None, help="PAXMIN file to extract, by default every PAXMIN file of RAW_DATA_PATH")
+    parser.add_argument("--output", default=None, help="Features file of --input, or synthetic PAXMIN file")
+    parser.add_argument("--chunk-size", type=int, default=1_000_000, help="Minutes read at a time")
+    parser.add_argument("--sedentary-max", type=float, default=SEDENTARY_MAX_MIMS, help="Sedentary below this MIMS per minute")
+    parser.add_argument("--mvpa-min", type=float, default=MVPA_MIN_MIMS, help="Moderate to vigorous from this MIMS per minute")
+    parser.add_argument("--bout-minutes", type=int, default=BOUT_MINUTES)
+    parser.add_argument("--min-wear-minutes", type=int, default=MIN_WEAR_MINUTES, help="Wear minutes of a valid day")
+    parser.add_argument("--subjects", type=int, default=14_000, help="Participants of the synthetic file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == "synthetic":
+        start_time = time.time()
+        synthetic_paxmin(args.subjects, args.output or "PAXMIN_SYNTHETIC.parquet", args.seed)
+        print(f"--> Synthetic PAXMIN of {args.subjects:,} participants in {time.time() - start_time:.1f} s")
+        return
+
+    thresholds = {'sedentary_max': args.sedentary_max, 'mvpa_min': args.mvpa_min,
+                  'bout_minutes': args.bout_minutes, 'min_wear_minutes': args.min_wear_minutes}
+    if args.input:
+        output_path = args.output or os.path.join(os.path.dirname(args.input) or ".", "PAXMIN_FEATURES.parquet")
+        extract_paxmin_features(args.input, output_path, args.chunk_size, **thresholds)
+    else:
+        extract_all(RAW_DATA_PATH, args.chunk_size, **thresholds)
+
+
+if __name__ == "__main__":
+    main()
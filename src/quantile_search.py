@@ -0,0 +1,147 @@
+"""
+Search engine of the XGBoost models that quantizes the training data once per CV fold.
+
+Fitting XGBClassifier on the pandas frame of a fold builds a new histogram matrix every time, so a search of
+n candidates x 10 folds re-quantizes the same data n x 10 times. QuantileSearch goes over the folds instead:
+
+1. The preprocessor is fitted on the training part of the fold, the same for every candidate.
+2. One QuantileDMatrix is built on it (and one on the held out rows used for early stopping, with the same bins).
+   Without early_stopping_rounds the boosters train on the whole training part, like XGBClassifier.fit does.
+3. Every candidate trains its booster from those matrices with xgb.train, with tree_method='hist' and a fixed
+   number of threads, and is scored (AUC) on the test part of the fold.
+
+Only the matrices of one fold are in memory at a time. The categorical variables are the first columns of the
+preprocessed matrix, marked as categorical features so that XGBoost splits on their categories instead of their
+codes (xgb_classifiers.CategoricalXGBClassifier, their missing category 999 being a missing value). The best candidate is
+refitted on the whole training set, as a Pipeline of the preprocessor and the classifier, like the best_estimator_
+of the scikit-learn searches.
+"""
+
+import os
+import time
+import numpy as np
+import xgboost as xgb
+from sklearn.base import clone
+from sklearn.model_selection import ParameterSampler, StratifiedKFold, train_test_split
+from sklearn.metrics import roc_auc_score
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SEED = int(os.getenv("SEED"))
+
+
+class QuantileSearch:
+    """
+    Random search over `n_iter` candidates of `param_distributions`, with `cv` stratified folds and the attributes
+    of RandomizedSearchCV used by fit_model (cv_results_, best_estimator_, best_score_, refit_time_, predict_proba).
+    estimator: Pipeline of the preprocessor and a CategoricalXGBClassifier with feature_types and early_stopping_rounds,
+    n_jobs being the threads of each booster. The search fits one candidate at a time.
+    """
+    def __init__(self, estimator, param_distributions, n_iter=20, cv=10, validation_fraction=0.1, max_bin=256,
+                 random_state=SEED):
+        self.estimator = estimator
+        self.param_distributions = param_distributions
+        self.n_iter = n_iter
+        self.cv = cv
+        self.validation_fraction = validation_fraction
+        self.max_bin = max_bin
+        self.random_state = random_state
+        self.n_jobs = 1
+
+    def candidate_estimator(self, params):
+        return clone(params['estimator']).set_params(
+            **{key.replace('estimator__', ''): value for key, value in params.items() if key != 'estimator'})
+
+    def matrix(self, preprocessor, X):
+        return self.estimator.named_steps['estimator'].categorical_matrix(preprocessor.transform(X))
+
+    def quantize(self, preprocessor, X, y, n_threads):
+        # Training and early stopping matrices, the held out rows are split like in EarlyStoppingXGBClassifier.
+        # Without early stopping, the whole training part and no held out rows
+        matrix = self.matrix(preprocessor, X)
+        feature_types = self.estimator.named_steps['estimator'].feature_types
+        if not self.estimator.named_steps['estimator'].early_stopping_rounds:
+            return xgb.QuantileDMatrix(matrix, np.asarray(y), feature_types=feature_types, enable_categorical=True,
+                                       max_bin=self.max_bin, nthread=n_threads), None
+        X_fit, X_val, y_fit, y_val = train_test_split(matrix, np.asarray(y),
+                                                      test_size=self.validation_fraction,
+                                                      random_state=self.random_state,
+                                                      stratify=y)
+        train = xgb.QuantileDMatrix(X_fit, y_fit, feature_types=feature_types, enable_categorical=True,
+                                    max_bin=self.max_bin, nthread=n_threads)
+        validation = xgb.QuantileDMatrix(X_val, y_val, ref=train, feature_types=feature_types, enable_categorical=True,
+                                         max_bin=self.max_bin, nthread=n_threads)
+        return train, validation
+
+    def train_booster(self, estimator, train, validation):
+        booster = xgb.train({**estimator.get_xgb_params(), 'max_bin': self.max_bin}, train,
+                            num_boost_round=estimator.n_estimators,
+                            evals=[(validation, 'validation')] if validation is not None else [],
+                            early_stopping_rounds=estimator.early_stopping_rounds, verbose_eval=False)
+        return booster[:booster.best_iteration + 1] if estimator.early_stopping_rounds else booster
+
+    def fit(self, X, y):
+        preprocessor = self.estimator.named_steps['preprocessor']
+        n_threads = self.estimator.named_steps['estimator'].n_jobs
+        candidates = list(ParameterSampler(self.param_distributions, self.n_iter, random_state=self.random_state))
+        folds = StratifiedKFold(self.cv, shuffle=True, random_state=self.random_state).split(X, y)
+
+        fit_times = np.zeros((len(candidates), self.cv))
+        score_times = np.zeros((len(candidates), self.cv))
+        scores = np.zeros((len(candidates), self.cv))
+        quantize_times = []
+        for i, (train_index, test_index) in enumerate(folds):
+            start_time = time.time()
+            fold_preprocessor = clone(preprocessor).fit(X.iloc[train_index], y.iloc[train_index])
+            train, validation = self.quantize(fold_preprocessor, X.iloc[train_index], y.iloc[train_index], n_threads)
+            test = xgb.DMatrix(self.matrix(fold_preprocessor, X.iloc[test_index]), feature_types=train.feature_types, enable_categorical=True, nthread=n_threads)
+            quantize_times.append(time.time() - start_time)
+
+            for j, params in enumerate(candidates):
+                start_time = time.time()
+                booster = self.train_booster(self.candidate_estimator(params), train, validation)
+                fit_times[j, i] = time.time() - start_time
+
+                start_time = time.time()
+                scores[j, i] = roc_auc_score(y.iloc[test_index], booster.predict(test))
+                score_times[j, i] = time.time() - start_time
+
+            # Only the matrices of one fold are kept at a time
+            del train, validation, test
+
+        self.cv_results_ = {
+            'params': candidates,
+            'mean_fit_time': fit_times.mean(axis=1),
+            'std_fit_time': fit_times.std(axis=1),
+            'mean_score_time': score_times.mean(axis=1),
+            'std_score_time': score_times.std(axis=1),
+            **{f'split{i}_test_score': scores[:, i] for i in range(self.cv)},
+            'mean_test_score': scores.mean(axis=1),
+            'std_test_score': scores.std(axis=1),
+            'rank_test_score': (-scores.mean(axis=1)).argsort().argsort() + 1,
+        }
+        # Preprocessor fit and quantization of each fold, shared by all the candidates
+        self.quantize_time_ = float(np.mean(quantize_times))
+
+        best = int(self.cv_results_['mean_test_score'].argmax())
+        self.best_index_ = best
+        self.best_params_ = candidates[best]
+        self.best_score_ = self.cv_results_['mean_test_score'][best]
+
+        start_time = time.time()
+        self.best_estimator_ = clone(self.estimator)
+        preprocessor = self.best_estimator_.named_steps['preprocessor'].fit(X, y)
+        estimator = self.candidate_estimator(self.best_params_)
+        booster = self.train_booster(estimator, *self.quantize(preprocessor, X, y, n_threads))
+        estimator.load_model(bytearray(booster.save_raw('ubj')))
+        self.best_estimator_.set_params(estimator=estimator)
+        self.refit_time_ = time.time() - start_time
+        self.classes_ = np.array([0, 1])
+        return self
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
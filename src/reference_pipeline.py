@@ -0,0 +1,68 @@
+"""
+The original chained combine_first code of preprocessing_nhanes -> create_targets -> rename_columns, kept as
+the reference the schema-driven stages of dinh_2019_create_clean_data_file are checked against.
+"""
+
+import numpy as np
+from utils import create_intake_new_column
+from dinh_2019_create_clean_data_file import rename_columns
+
+
+def reference_preprocessing_nhanes(data):
+    df = data.copy()
+
+    df['ALQ130'] = df['ALQ130'].replace([77, 99, 777, 999], np.nan)
+    df['WHD140'] = df['WHD140'].replace([7777, 77777, 9999, 99999], np.nan)
+
+    df['Alcohol_Intake'] = create_intake_new_column(df, 'DRXTALCO', 'DR1TALCO', 'DR2TALCO')
+    df['Caffeine_Intake'] = create_intake_new_column(df, 'DRXTCAFF', 'DR1TCAFF', 'DR2TCAFF')
+    df['Calcium_Intake'] = create_intake_new_column(df, 'DRXTCALC', 'DR1TCALC', 'DR2TCALC')
+    df['Carbohydrate_Intake'] = create_intake_new_column(df, 'DRXTCARB', 'DR1TCARB', 'DR2TCARB')
+    df['Fiber_Intake'] = create_intake_new_column(df, 'DRXTFIBE', 'DR1TFIBE', 'DR2TFIBE')
+    df['Kcal_Intake'] = create_intake_new_column(df, 'DRXTKCAL', 'DR1TKCAL', 'DR2TKCAL')
+    df['Sodium_Intake'] = create_intake_new_column(df, 'DRDTSODI', 'DR1TSODI', 'DR2TSODI')
+
+    df['Relative_Had_Diabetes'] = df['MCQ250A'].combine_first(df['MCQ300C']).combine_first(df['MCQ300c'])
+    df['Told_CHF'] = df['MCQ160B'].combine_first(df['MCQ160b'])
+    df['Told_CHD'] = df['MCQ160C'].combine_first(df['MCQ160c'])
+    df['Told_HA'] = df['MCQ160E'].combine_first(df['MCQ160e'])
+    df['Told_stroke'] = df['MCQ160F'].combine_first(df['MCQ160f'])
+    df['Pregnant'] = df['SEQ060'].combine_first(df['RHQ141']).combine_first(df['RHD143'])
+    df['HDL_Cholesterol'] = df['LBDHDLSI'].combine_first(df['LBDHDDSI'])
+    df['Glucose'] = df['LBXGLUSI'].combine_first(df['LBDGLUSI'])
+    df['Diastolic_Blood_Pressure'] = df['BPXDI4'].combine_first(df['BPXDI3']).combine_first(df['BPXDI2']).combine_first(df['BPXDI1'])
+    df['Systolic_Blood_Pressure'] = df['BPXSY4'].combine_first(df['BPXSY3']).combine_first(df['BPXSY2']).combine_first(df['BPXSY1'])
+
+    cond_1 = (df['Pregnant'].isna()) | (df['Pregnant'] != 1)
+    cond_2 =(df['RIDAGEYR'] >= 20)
+    df = df[cond_1 & cond_2]
+
+    columns_to_drop = ['DRXTALCO', 'DR1TALCO', 'DR2TALCO', 'DRXTCAFF', 'DR1TCAFF', 'DR2TCAFF',
+                    'DRXTCALC', 'DR1TCALC', 'DR2TCALC', 'DRXTCARB', 'DR1TCARB', 'DR2TCARB',
+                    'DRXTFIBE', 'DR1TFIBE', 'DR2TFIBE', 'DRXTKCAL', 'DR1TKCAL', 'DR2TKCAL',
+                    'DRDTSODI', 'DR1TSODI', 'DR2TSODI', 'MCQ250A', 'MCQ300C', 'MCQ300c',
+                    'MCQ160B', 'MCQ160b', 'MCQ160C', 'MCQ160c', 'MCQ160E', 'MCQ160e',
+                    'MCQ160F', 'MCQ160f', 'SEQ060', 'RHQ141', 'RHD143',
+                    'LBDHDLSI', 'LBDHDDSI', 'LBXGLUSI', 'LBDGLUSI',
+                    'BPXDI4', 'BPXDI3', 'BPXDI2', 'BPXDI1',
+                    'BPXSY4', 'BPXSY3', 'BPXSY2', 'BPXSY1', 'Pregnant']
+
+    return df.drop(columns=columns_to_drop)
+
+
+def reference_create_targets(data):
+    df = data.copy()
+
+    df['Diabetes_Case_I'] = np.where(
+      (df['Glucose'] > 7.0) | (df['DIQ010'] == 1), 1, 0)
+    df['Diabetes_Case_II'] = np.where(
+      (df['Diabetes_Case_I'] == 0) & (df['Glucose'] >= 5.6) & (df['Glucose'] < 7.0), 1, 0)
+    df['CVD'] = np.where(
+        (df['Told_CHF'] == 1) | (df['Told_CHD'] == 1) | (df['Told_HA'] == 1) | (df['Told_stroke'] == 1), 1, 0)
+
+    return df.drop(columns=['Told_CHF', 'Told_CHD', 'Told_HA', 'Told_stroke', 'Glucose', 'DIQ010'])
+
+
+def reference_rename_columns(data):
+    df = data.copy()
+    return rename_columns(df)
@@ -0,0 +1,83 @@
+"""
+Load test of scoring_server.py: `--concurrency` clients, each with its own keep-alive connection, post single
+synthetic records to /score until `--requests` are sent, then the latency percentiles and requests per second
+are printed.
+
+    python scoring_server.py --port 8000 &
+    python scoring_load_test.py --url http://127.0.0.1:8000 --requests 5000 --concurrency 16
+"""
+
+import json
+import time
+import argparse
+import threading
+import http.client
+import numpy as np
+from urllib.parse import urlparse
+from synthetic_data import synthetic_clean_data
+
+
+def synthetic_records(n_records, columns, seed=0):
+    # JSON bodies of synthetic clean data rows, missing values as null
+    df = synthetic_clean_data(n_records, seed)[columns].astype(object)
+    df = df.where(df.notna(), None)
+    return [json.dumps(record).encode() for record in df.to_dict(orient="records")]
+
+
+def run_client(url, bodies, latencies, errors):
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    for body in bodies:
+        start_time = time.perf_counter()
+        try:
+            connection.request("POST", "/score", body, {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+        except (ConnectionError, http.client.HTTPException) as error:
+            errors.append(type(error).__name__)
+            connection.close()
+            continue
+        latencies.append(time.perf_counter() - start_time)
+        if response.status != 200:
+            errors.append(response.status)
+    connection.close()
+
+
+def load_test(url, n_requests, concurrency, seed=0):
+    url = urlparse(url)
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    connection.request("GET", "/health")
+    schema = json.loads(connection.getresponse().read())
+    connection.close()
+
+    bodies = synthetic_records(n_requests, schema["categorical"] + schema["numerical"], seed)
+    latencies, errors = [], []
+    clients = [threading.Thread(target=run_client, args=(url, bodies[i::concurrency], latencies, errors))
+               for i in range(concurrency)]
+
+    start_time = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    duration = time.perf_counter() - start_time
+
+    latencies = np.array(latencies) * 1e3
+    print(f"{n_requests} requests, {concurrency} clients, {len(errors)} errors" + (f" {sorted(set(errors), key=str)}" if errors else ""))
+    print(f"Latency (ms): p50 {np.percentile(latencies, 50):.2f}, p90 {np.percentile(latencies, 90):.2f}, "
+          f"p99 {np.percentile(latencies, 99):.2f}, max {latencies.max():.2f}")
+    print(f"Throughput: {n_requests / duration:,.0f} requests / second")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the scoring server")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    load_test(args.url, args.requests, args.concurrency, args.seed)
+
+
+if __name__ == "__main__":
+    main()
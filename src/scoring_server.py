@@ -0,0 +1,200 @@
+"""
+Local HTTP/JSON scoring service for the Dinh et al. (2019) models.
+
+    python scoring_server.py --port 8000
+    curl localhost:8000/score -d '{"Age": 62, "Body_mass_index": 31.2, "Race_ethnicity": 3}'
+    {"Diabetes_Case_I": 0.41, "Diabetes_Case_II": 0.22, "CVD": 0.18}
+
+The AUC weighted ensembles saved by dinh_2019_train_models (dinh_ensemble_<target>.pkl) are loaded once at startup.
+A record is a JSON object keyed by the clean data column names (the rename_columns names): absent and null values are
+missing and get imputed like in training. A JSON list of records is scored as a batch and returns a list.
+
+Records never go through a DataFrame, they are written straight into the float32 matrix the ensembles score.
+Concurrent requests are micro-batched: a single scoring thread takes every record waiting in its queue
+(up to --max-batch-size), so each ensemble scores all of them with one predict_proba call per model.
+
+GET /health returns the targets and the columns of the schema. Use scoring_load_test.py for latency and throughput.
+"""
+
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from dotenv import load_dotenv
+from ensemble_inference import load_ensemble
+from dinh_2019_create_clean_data_file import RENAME_COLUMNS
+
+load_dotenv()
+
+MODEL_RESULTS_PATH = os.getenv("MODEL_RESULTS_PATH")
+TARGETS = ['Diabetes_Case_I', 'Diabetes_Case_II', 'CVD']
+
+
+def load_ensembles(targets=TARGETS, model_path=MODEL_RESULTS_PATH):
+    ensembles = {}
+    for target in targets:
+        file_path = os.path.join(model_path, f'dinh_ensemble_{target}.pkl')
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"{file_path} not found, train the models with dinh_2019_train_models.py first")
+        ensembles[target] = load_ensemble(file_path)
+    return ensembles
+
+
+def validate_record(record, categorical_vars, numerical_vars):
+    # Raises ValueError with a message for the client if the record doesn't follow the clean data schema
+    if not isinstance(record, dict):
+        raise ValueError("Each record must be a JSON object of column: value")
+
+    unknown = [col for col in record if col not in categorical_vars and col not in numerical_vars]
+    if unknown:
+        hints = [f"{col} -> {RENAME_COLUMNS[col]}" for col in unknown if col in RENAME_COLUMNS]
+        raise ValueError(f"Unknown columns: {unknown}" + (f", use the clean data names ({', '.join(hints)})" if hints else ""))
+
+    for col, value in record.items():
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{col} must be a number or null, got {value!r}")
+        if col in categorical_vars and not float(value).is_integer():
+            raise ValueError(f"{col} is a categorical answer code, got {value!r}")
+
+
+class MicroBatcher:
+    """
+    Scores the records of concurrent requests together. Request threads put their records in the queue and wait,
+    the scoring thread takes all the records waiting (at most max_batch_size, waiting up to max_wait seconds for
+    more) and scores them as one matrix.
+    """
+    def __init__(self, ensembles, max_batch_size=256, max_wait=0.0):
+        self.ensembles = ensembles
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def score(self, records):
+        job = {'records': records, 'done': threading.Event()}
+        self.queue.put(job)
+        job['done'].wait()
+        if 'error' in job:
+            raise job['error']
+        return job['probas']
+
+    def next_batch(self):
+        jobs = [self.queue.get()]
+        n_records = len(jobs[0]['records'])
+        deadline = time.perf_counter() + self.max_wait
+        while n_records < self.max_batch_size:
+            try:
+                job = self.queue.get(timeout=max(0, deadline - time.perf_counter())) if self.max_wait else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            jobs.append(job)
+            n_records += len(job['records'])
+        return jobs
+
+    def run(self):
+        while True:
+            jobs = self.next_batch()
+            records = [record for job in jobs for record in job['records']]
+            try:
+                probas = {target: ensemble.predict_proba_matrix(ensemble.transform_records(records)).tolist()
+                          for target, ensemble in self.ensembles.items()}
+                start = 0
+                for job in jobs:
+                    end = start + len(job['records'])
+                    job['probas'] = [{target: probas[target][i] for target in self.ensembles} for i in range(start, end)]
+                    start = end
+            except Exception as error:
+                for job in jobs:
+                    job['error'] = error
+            for job in jobs:
+                job['done'].set()
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, without this Nagle's algorithm delays the body
+    disable_nagle_algorithm = True
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self.send_json(404, {"error": f"Unknown path {self.path}"})
+        self.send_json(200, {"targets": list(self.server.batcher.ensembles),
+                             "categorical": self.server.categorical_vars,
+                             "numerical": self.server.numerical_vars})
+
+    def do_POST(self):
+        if self.path != "/score":
+            return self.send_json(404, {"error": f"Unknown path {self.path}"})
+        try:
+            content = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            records = content if isinstance(content, list) else [content]
+            if not records:
+                raise ValueError("No records to score")
+            for record in records:
+                validate_record(record, self.server.categorical_vars, self.server.numerical_vars)
+        except ValueError as error:
+            # json.JSONDecodeError is a ValueError too
+            return self.send_json(400, {"error": str(error)})
+
+        try:
+            probas = self.server.batcher.score(records)
+        except Exception as error:
+            return self.send_json(500, {"error": f"{type(error).__name__}: {error}"})
+        self.send_json(200, probas if isinstance(content, list) else probas[0])
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ScoringServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Room for many clients connecting at once, with the default backlog of 5 their connections get reset
+    request_queue_size = 128
+
+
+def create_server(host="127.0.0.1", port=8000, max_batch_size=256, max_wait=0.0, verbose=False):
+    ensembles = load_ensembles()
+    server = ScoringServer((host, port), ScoringHandler)
+    server.batcher = MicroBatcher(ensembles, max_batch_size, max_wait)
+    # The schema of the first ensemble, all of them are trained on the same clean data columns
+    first_ensemble = next(iter(ensembles.values()))
+    server.categorical_vars = first_ensemble.categorical_vars
+    server.numerical_vars = first_ensemble.numerical_vars
+    server.verbose = verbose
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP/JSON scoring service of the Dinh et al. (2019) models")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=256, help="Most records scored together")
+    parser.add_argument("--max-wait-ms", type=float, default=0.0,
+                        help="Time the scoring thread waits for more records before scoring a batch")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    server = create_server(args.host, args.port, args.max_batch_size, args.max_wait_ms / 1000, args.verbose)
+    print(f"Scoring {', '.join(server.batcher.ensembles)} on http://{args.host}:{args.port}/score")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Content-addressed cache for the stages of a dataframe pipeline.
+
+Each stage output is saved as parquet under a key that hashes the key of the stage before it
+(the first stage uses the hash of the pipeline inputs) and the source code of the modules that compute it.
+Changing an input or the code of a stage invalidates that stage and every stage after it.
+
+The cache folder is kept under `max_size_bytes` by deleting the least recently used outputs.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import inspect
+import pandas as pd
+
+
+def hash_key(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:16]
+
+
+def hash_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for content in iter(lambda: file.read(1 << 20), b""):
+            digest.update(content)
+    return digest.hexdigest()[:16]
+
+
+def code_version(*functions):
+    # Source of the modules the functions live in, so helper functions are covered too
+    modules = sorted({function.__module__ for function in functions})
+    return hash_key([inspect.getsource(sys.modules[module]) for module in modules])
+
+
+class StageCache:
+    def __init__(self, cache_path, max_size_bytes=5e9, force=False):
+        self.cache_path = cache_path
+        self.max_size_bytes = max_size_bytes
+        self.force = force
+        os.makedirs(cache_path, exist_ok=True)
+
+    def file_path(self, stage, key):
+        return os.path.join(self.cache_path, f"{stage}_{key}.parquet")
+
+    def get(self, stage, key):
+        file_path = self.file_path(stage, key)
+        if self.force or not os.path.exists(file_path):
+            return None
+        # Touch the file so eviction knows it was used recently
+        os.utime(file_path)
+        return pd.read_parquet(file_path)
+
+    def put(self, stage, key, df):
+        file_path = self.file_path(stage, key)
+        df.to_parquet(file_path + ".part", index=False)
+        os.replace(file_path + ".part", file_path)
+        self.evict()
+
+    def evict(self):
+        cache_files = [entry for entry in os.scandir(self.cache_path) if entry.name.endswith(".parquet")]
+        cache_files.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+
+        cache_size = 0
+        for entry in cache_files:
+            cache_size += entry.stat().st_size
+            if cache_size > self.max_size_bytes:
+                os.unlink(entry.path)
+
+    def run_pipeline(self, stages, inputs_key, print_statemets=True):
+        """
+        stages: list of (name, function, code_functions). The first function takes no arguments,
+        each of the next ones takes the output of the previous stage.
+
+        Only the stages after the last cached one are run.
+        """
+        keys = []
+        key = inputs_key
+        for name, function, code_functions in stages:
+            key = hash_key(name, key, code_version(function, *code_functions))
+            keys.append(key)
+
+        df, first_stage = None, 0
+        for i in reversed(range(len(stages))):
+            df = self.get(stages[i][0], keys[i])
+            if df is not None:
+                if print_statemets:
+                    print(f"--> Stage {stages[i][0]} loaded from cache")
+                first_stage = i + 1
+                break
+
+        for i in range(first_stage, len(stages)):
+            name, function, _ = stages[i]
+            if print_statemets:
+                print(f"--> Running stage {name}")
+            df = function() if i == 0 else function(df)
+            self.put(name, keys[i], df)
+
+        return df
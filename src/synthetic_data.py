@@ -0,0 +1,224 @@
+"""
+Synthetic NHANES data and a local stand-in of the CDC website, so the benchmarks and tests run offline.
+
+synthetic_clean_data: frame shaped like the Dinh_2019 clean data file.
+synthetic_raw_data: raw_data tree of parquet files and its documentation_variables.csv, read by compile_data.
+CDCStandIn: HTTP server with the component pages and XPT files of one cycle, some of them failing on purpose.
+"""
+
+import os
+import time
+import numpy as np
+import pandas as pd
+from dinh_2019_create_clean_data_file import set_categorical_dtypes, HARMONISATION_SPEC, SENTINEL_CODES, RENAME_COLUMNS
+
+
+# Mean, standard deviation and missing fraction of the numerical columns of the clean data
+synthetic_numerical_vars = {
+    'Age': (50, 18, 0), 'Alcohol_consumption': (2.9, 2.9, 0.43), 'Arm_circumference': (33, 5.1, 0.09),
+    'Arm_length': (37.3, 2.8, 0.09), 'Osmolality': (278, 5.2, 0.11), 'Blood_urea_nitrogen': (4.8, 2.2, 0.11),
+    'Body_mass_index': (28.8, 6.7, 0.07), 'Chloride': (103.7, 2.9, 0.11), 'Sodium': (139.2, 2.4, 0.11),
+    'Gamma_glutamyl_transferase': (30, 45, 0.11), 'Height': (167.4, 10.2, 0.06), 'LDL_cholesterol': (3, 0.9, 0.58),
+    'Leg_length': (39, 4, 0.1), 'Lymphocytes': (2.1, 1.2, 0.09), 'Mean_cell_volume': (89.6, 5.8, 0.09),
+    'Pulse': (72.4, 12.2, 0.09), 'Self_reported_greatest_weight': (192, 51, 0.02), 'Total_cholesterol': (5.1, 1.1, 0.1),
+    'Triglycerides': (1.7, 1.6, 0.11), 'Waist_circumference': (98.4, 15.9, 0.1), 'Weight': (80.9, 21, 0.06),
+    'White_blood_cell_count': (7.2, 2.4, 0.09), 'Aspartate_aminotransferase_AST': (25.9, 19.1, 0.11),
+    'Alcohol_Intake': (8.9, 24.2, 0.11), 'Caffeine_Intake': (147, 179, 0.11), 'Calcium_Intake': (885, 517, 0.11),
+    'Carbohydrate_Intake': (252, 114, 0.11), 'Fiber_Intake': (16.3, 9.2, 0.11), 'Kcal_Intake': (2054, 892, 0.11),
+    'Sodium_Intake': (3327, 1592, 0.11), 'HDL_Cholesterol': (1.36, 0.41, 0.1), 'Diastolic_Blood_Pressure': (69.7, 13.9, 0.09),
+    'Systolic_Blood_Pressure': (123.7, 19.4, 0.09),
+}
+
+# Answer codes and missing fraction of the categorical columns of the clean data
+synthetic_categorical_vars = {
+    'Race_ethnicity': ([1, 2, 3, 4, 5], 0), 'General_health': ([1, 2, 3, 4, 5, 9], 0.13),
+    'Health_status': ([1, 2, 3, 4, 5, 9], 0), 'Told_High_Cholesterol': ([1, 2, 9], 0.21),
+    'Household_income': ([1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 12, 13, 14, 15, 77, 99], 0.39),
+    'Relative_Had_Diabetes': ([1, 2, 9], 0),
+}
+
+
+def synthetic_clean_data(n_rows, seed=0):
+    """
+    Frame with the columns and dtypes of the Dinh_2019 clean data file: normal numerical values clipped at 0,
+    uniform answer codes, missing values at the rates of the real data, and targets that depend on age,
+    body mass index and blood pressure.
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'SEQN': np.arange(n_rows, dtype=np.float64),
+                       'Survey_year': rng.choice([f"{year}-{year + 1}" for year in range(1999, 2015, 2)], n_rows)})
+
+    for col, (mean, std, missing) in synthetic_numerical_vars.items():
+        values = np.clip(rng.normal(mean, std, n_rows), 0, None)
+        values[rng.random(n_rows) < missing] = np.nan
+        df[col] = values
+    for col, (codes, missing) in synthetic_categorical_vars.items():
+        values = rng.choice(codes, n_rows).astype(np.float64)
+        values[rng.random(n_rows) < missing] = np.nan
+        df[col] = values
+
+    risk = (df['Age'] - 50) / 18 + (df['Body_mass_index'].fillna(28.8) - 28.8) / 6.7
+    for target, shift in [('Diabetes_Case_I', 2), ('Diabetes_Case_II', 2),
+                          ('CVD', 2.5 - (df['Systolic_Blood_Pressure'].fillna(123.7) - 123.7) / 19.4)]:
+        df[target] = (rng.random(n_rows) < 1 / (1 + np.exp(shift - risk))).astype(np.int64)
+
+    return set_categorical_dtypes(df)
+
+
+cycles = [f"{year}-{year + 1}" for year in range(1999, 2015, 2)]
+cycle_suffixes = ["", "_B", "_C", "_D", "_E", "_F", "_G", "_H"]
+demographics_vars = ['RIDAGEYR', 'RIDRETH1', 'INDHHIN2']
+
+
+def synthetic_raw_vars():
+    # Raw NHANES variable -> (mean, std, missing) for measures or (codes, missing) for coded answers
+    raw_vars = {'DIQ010': ([1, 2, 3, 9], 0.02)}
+    for raw, clean in RENAME_COLUMNS.items():
+        if clean in synthetic_numerical_vars:
+            raw_vars[raw] = synthetic_numerical_vars[clean]
+        elif clean in synthetic_categorical_vars:
+            raw_vars[raw] = synthetic_categorical_vars[clean]
+
+    other_vars = {'Glucose': (5.9, 1.8, 0.55), 'Pregnant': ([1, 2], 0.9)}
+    for new_col, cols, _ in HARMONISATION_SPEC:
+        stats = (synthetic_numerical_vars.get(new_col) or synthetic_categorical_vars.get(new_col) or
+                 other_vars.get(new_col, ([1, 2, 9], 0.3)))
+        for col in cols:
+            raw_vars.setdefault(col, stats)
+
+    # Children are in the raw data too
+    raw_vars['RIDAGEYR'] = (35, 25, 0)
+    return raw_vars
+
+
+def synthetic_component(file_prefix):
+    # NHANES component of a synthetic file (DEMO, BMX, LBX, DR1, ALQ, ...), as in the Component column of the codebook
+    if file_prefix == "DEMO":
+        return "Demographics"
+    if file_prefix.startswith("LB"):
+        return "Laboratory"
+    if file_prefix in ("BMX", "BPX"):
+        return "Examination"
+    if file_prefix.startswith("DR"):
+        return "Dietary"
+    return "Questionnaire"
+
+
+def synthetic_values(stats, n_rows, rng):
+    if isinstance(stats[0], list):
+        codes, missing = stats
+        values = rng.choice(codes, n_rows).astype(np.float64)
+    else:
+        mean, std, missing = stats
+        values = np.clip(rng.normal(mean, std, n_rows), 0, None)
+    values[rng.random(n_rows) < missing] = np.nan
+    return values
+
+
+def synthetic_raw_data(n_rows, raw_path, proc_path, seed=0):
+    """
+    NHANES-shaped raw_data tree for compile_data: n_rows participants spread over the 8 cycles of 1999-2014,
+    one parquet file per component and cycle (DEMO_B, BMX_B, ...) and the documentation_variables.csv mapping
+    the variables to their files and NHANES components. The variables NHANES renamed in lower case (MCQ160b, ...) are documented with
+    that name from 2007-2008 on, and the sentinel codes of SENTINEL_CODES are in 1% of their answers.
+    Returns the list of variables.
+    """
+    rng = np.random.default_rng(seed)
+    raw_vars = synthetic_raw_vars()
+    lower_case_vars = {var for var in raw_vars if var != var.upper()}
+    renamed_vars = {var.upper() for var in lower_case_vars}
+
+    docs = []
+    first_seqn = 0
+    for i, (cycle, suffix) in enumerate(zip(cycles, cycle_suffixes)):
+        cycle_rows = n_rows // len(cycles) + (i < n_rows % len(cycles))
+        seqn = np.arange(first_seqn, first_seqn + cycle_rows, dtype=np.float64)
+        first_seqn += cycle_rows
+
+        # The lower case variables replace their upper case names from 2007-2008 on
+        cycle_vars = [var for var in raw_vars
+                      if not (var in lower_case_vars and i < 4) and not (var in renamed_vars and i >= 4)]
+        components = {}
+        for var in cycle_vars:
+            component = "DEMO" if var in demographics_vars else var[:3].upper()
+            components.setdefault(component, []).append(var)
+
+        os.makedirs(os.path.join(raw_path, cycle), exist_ok=True)
+        for component, component_vars in components.items():
+            df = pd.DataFrame({'SEQN': seqn})
+            for var in component_vars:
+                values = synthetic_values(raw_vars[var], cycle_rows, rng)
+                if var in SENTINEL_CODES:
+                    sentinels = rng.random(cycle_rows) < 0.01
+                    values[sentinels] = rng.choice(SENTINEL_CODES[var], sentinels.sum())
+                df[var.upper()] = values
+            df.to_parquet(os.path.join(raw_path, cycle, component + suffix + ".parquet"), index=False)
+            docs += [{'Variable Name': var, 'Data File Name': component + suffix, 'Component': synthetic_component(component),
+                      'Use Constraints': 'None'}
+                     for var in component_vars]
+
+    os.makedirs(proc_path, exist_ok=True)
+    pd.DataFrame(docs).to_csv(os.path.join(proc_path, "documentation_variables.csv"), index=False)
+    return list(raw_vars)
+
+
+class CDCStandIn:
+    """
+    Local HTTP server with the datapage.aspx component pages and XPT files of one cycle. `flaky` paths answer 503
+    to their first `flaky[path]` requests, `failing` component pages always do. `truncated` paths close the
+    connection halfway through the body of their first `truncated[path]` responses, like an interrupted download.
+    Every request is recorded with its time.
+    """
+    def __init__(self, directory, year, files, flaky=None, failing=(), truncated=None):
+        import threading
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        from urllib.parse import urlparse, parse_qs
+
+        self.requests = []
+        self.flaky = dict(flaky or {})
+        self.truncated = dict(truncated or {})
+        lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                with lock:
+                    stand_in.requests.append((time.monotonic(), url.path, url.query))
+                    failures_left = stand_in.flaky.get(self.path, 0)
+                    stand_in.flaky[self.path] = failures_left - 1
+                    truncations_left = stand_in.truncated.get(self.path, 0)
+                    stand_in.truncated[self.path] = truncations_left - 1
+                component = parse_qs(url.query).get("Component", [None])[0]
+                if failures_left > 0 or component in failing:
+                    self.send_error(503)
+                    return
+
+                if url.path.endswith("datapage.aspx"):
+                    links = "".join(f'<a href="/Nchs/Nhanes/{year}/{name}.XPT">{name}</a>' for name in files.get(component, []))
+                    body = f"<html><body>{links}</body></html>".encode()
+                elif url.path.endswith(".XPT"):
+                    with open(os.path.join(directory, os.path.basename(url.path)), "rb") as file:
+                        body = file.read()
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if truncations_left > 0:
+                    self.wfile.write(body[:len(body) // 2])
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
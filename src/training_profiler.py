@@ -0,0 +1,213 @@
+"""
+Opt-in profiling of a training run (python dinh_2019_train_models.py --profile).
+
+Each stage of the run (data_load, split, preprocess, search, predict, save, ensemble) records its wall time, CPU
+time and peak RSS. The RSS is sampled every `interval` seconds and includes the joblib workers of the search.
+From each fitted search it also takes:
+- the mean fit and score time of every candidate, from cv_results_
+- the time of the refit on the whole training set (refit_time_)
+- the CV overhead: search time not spent fitting or scoring
+
+The report is written next to dinh_2019_results.csv:
+- dinh_2019_profile.json: everything below, plus the slowest stage
+- dinh_2019_profile_stages.csv: one row per stage
+- dinh_2019_profile_candidates.csv: one row per candidate (and successive halving round)
+
+A stage can also be run under a profiler with `hook` ("cprofile" or "py-spy") and `hook_stage`. cProfile only sees
+the main thread of the process, py-spy (if installed) also records the joblib workers. The output goes to
+<stage>_<target>_<model>.prof / .svg in the report folder.
+"""
+
+import os
+import json
+import time
+import shutil
+import signal
+import cProfile
+import threading
+import subprocess
+import numpy as np
+import pandas as pd
+import psutil
+from contextlib import contextmanager
+
+
+def cpu_seconds(process):
+    # CPU time of the process, its finished children and its running children (the joblib workers of the search)
+    times = process.cpu_times()
+    cpu_time = {process.pid: times.user + times.system + times.children_user + times.children_system}
+    for child in process.children(recursive=True):
+        try:
+            child_times = child.cpu_times()
+            cpu_time[child.pid] = child_times.user + child_times.system
+        except psutil.NoSuchProcess:
+            pass
+    return cpu_time
+
+
+def cpu_seconds_since(process, cpu_start):
+    cpu_end = cpu_seconds(process)
+    return sum(cpu_end[pid] - cpu_start.get(pid, 0) for pid in cpu_end)
+
+
+def rss_bytes(process):
+    # Resident memory of the process and its children (the joblib workers)
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss
+
+
+class TrainingProfiler:
+    def __init__(self, enabled=False, hook=None, hook_stage="search", output_path=".", interval=0.05):
+        self.enabled = enabled
+        self.hook = hook
+        self.hook_stage = hook_stage
+        self.output_path = output_path
+        self.interval = interval
+        self.stages = []
+        self.candidates = []
+        self.open_stages = []
+        self.process = psutil.Process()
+        self.sampler = None
+
+    def sample_rss(self):
+        while self.open_stages:
+            rss = rss_bytes(self.process)
+            for record in list(self.open_stages):
+                record['peak_rss_mb'] = max(record['peak_rss_mb'], rss / 1e6)
+            time.sleep(self.interval)
+
+    @contextmanager
+    def stage(self, name, target=None, model=None):
+        if not self.enabled:
+            yield
+            return
+
+        record = {'stage': name, 'target': target, 'model': model, 'pid': os.getpid(),
+                  'peak_rss_mb': rss_bytes(self.process) / 1e6}
+        self.open_stages.append(record)
+        if self.sampler is None or not self.sampler.is_alive():
+            self.sampler = threading.Thread(target=self.sample_rss, daemon=True)
+            self.sampler.start()
+
+        hook = self.start_hook(name, target, model) if name == self.hook_stage else None
+        cpu_start = cpu_seconds(self.process)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            record['wall_time'] = time.perf_counter() - start_time
+            record['cpu_time'] = cpu_seconds_since(self.process, cpu_start)
+            record['peak_rss_mb'] = max(record['peak_rss_mb'], rss_bytes(self.process) / 1e6)
+            self.stop_hook(hook)
+            self.open_stages.remove(record)
+            self.stages.append(record)
+
+    def hook_file(self, name, target, model, extension):
+        parts = [part for part in [name, target, model] if part]
+        return os.path.join(self.output_path, "_".join(parts) + extension)
+
+    def start_hook(self, name, target, model):
+        if self.hook == "cprofile":
+            profile = cProfile.Profile()
+            profile.enable()
+            return profile, self.hook_file(name, target, model, ".prof")
+        if self.hook == "py-spy":
+            if shutil.which("py-spy") is None:
+                print("py-spy is not installed, the stage runs without it")
+                return None
+            output_file = self.hook_file(name, target, model, ".svg")
+            command = ["py-spy", "record", "--pid", str(os.getpid()), "--subprocesses", "--output", output_file]
+            return subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL), output_file
+        return None
+
+    def stop_hook(self, hook):
+        if hook is None:
+            return
+        runner, output_file = hook
+        if isinstance(runner, cProfile.Profile):
+            runner.disable()
+            runner.dump_stats(output_file)
+        else:
+            # py-spy writes its flame graph when interrupted
+            runner.send_signal(signal.SIGINT)
+            runner.wait()
+        print(f"--> Profile of the stage written to {output_file}")
+
+    def record_search(self, search, target, model, n_jobs=1):
+        # Per-candidate fit times of a fitted search, its refit and the time the search spent outside fits
+        if not self.enabled:
+            return
+
+        results = pd.DataFrame(search.cv_results_)
+        n_folds = search.cv if isinstance(search.cv, int) else search.cv.get_n_splits()
+        for i, candidate in results.iterrows():
+            self.candidates.append({
+                'target': target,
+                'model': model,
+                'candidate': i,
+                'round': candidate.get('iter', 0),
+                'n_samples': candidate.get('n_resources', None),
+                'mean_fit_time': candidate['mean_fit_time'],
+                'std_fit_time': candidate['std_fit_time'],
+                'mean_score_time': candidate['mean_score_time'],
+                'mean_test_score': candidate['mean_test_score'],
+                'params': json.dumps({key.replace('estimator__', ''): value for key, value in candidate['params'].items()
+                                      if key != 'estimator'}, default=str),
+            })
+
+        search_stage = next(record for record in reversed(self.stages)
+                            if record['stage'] == 'search' and record['target'] == target and record['model'] == model)
+        fits_time = ((results['mean_fit_time'] + results['mean_score_time']) * n_folds).sum()
+        search_stage['candidate_fits_time'] = fits_time
+        search_stage['refit_time'] = search.refit_time_
+        # Wall time of the search not explained by its fits running n_jobs at a time, nor by the refit
+        search_stage['cv_overhead_time'] = max(0, search_stage['wall_time'] - fits_time / n_jobs - search.refit_time_)
+        estimator = search.best_estimator_.named_steps['estimator']
+        if hasattr(estimator, 'n_iter_'):
+            search_stage['refit_solver_iterations'] = int(np.max(estimator.n_iter_))
+
+    def worker_profiler(self):
+        # Same settings and no records, for a worker process of the run
+        return TrainingProfiler(self.enabled, self.hook, self.hook_stage, self.output_path, self.interval)
+
+    def merge(self, other):
+        # Records of a profiler that ran in a worker process
+        self.stages += other.stages
+        self.candidates += other.candidates
+
+    def __getstate__(self):
+        # Only the records travel between processes
+        state = self.__dict__.copy()
+        state.update(process=None, sampler=None, open_stages=[])
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.process = psutil.Process()
+
+    def save(self, file_prefix="dinh_2019_profile"):
+        if not self.enabled:
+            return None
+
+        stages = pd.DataFrame(self.stages)
+        candidates = pd.DataFrame(self.candidates)
+        slowest = stages.loc[stages['wall_time'].idxmax()]
+
+        report_path = os.path.join(self.output_path, file_prefix + ".json")
+        with open(report_path, "w") as file:
+            json.dump({
+                'slowest_stage': {key: slowest[key] for key in ['stage', 'target', 'model', 'wall_time']},
+                'stages': stages.replace({np.nan: None}).to_dict(orient="records"),
+                'candidates': candidates.replace({np.nan: None}).to_dict(orient="records"),
+            }, file, indent=2, default=str)
+        stages.to_csv(os.path.join(self.output_path, file_prefix + "_stages.csv"), index=False)
+        candidates.to_csv(os.path.join(self.output_path, file_prefix + "_candidates.csv"), index=False)
+
+        print(f"--> Profile written to {report_path}, slowest stage: {slowest['stage']} "
+              f"{slowest['target'] or ''} {slowest['model'] or ''} ({slowest['wall_time']:.1f} s)")
+        return report_path
@@ -2,8 +2,14 @@ import pandas as pd
 import numpy as np
 import os
 import re
-from glob import glob
+import pyarrow as pa
+import pyarrow.parquet as pq
+from nhanes_file_index import update_file_index, file_paths_by_name
 from sklearn.base import BaseEstimator, TransformerMixin, ClassifierMixin
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline
+from sklearn.svm import LinearSVC
+from sklearn.linear_model import LogisticRegression
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -11,7 +17,22 @@ load_dotenv()
 RAW_DATA_PATH = os.getenv("RAW_DATA_PATH")
 PROC_DATA_PATH = os.getenv("PROC_DATA_PATH")
 
+# XGBoost classifiers of xgb_classifiers, imported from there on first use so that importing utils doesn't import
+# XGBoost. The models registered or pickled as utils.EarlyStoppingXGBClassifier still load.
+XGB_CLASSIFIERS = {"EarlyStoppingXGBClassifier", "CategoricalXGBClassifier"}
+
+def __getattr__(name):
+    if name in XGB_CLASSIFIERS:
+        import xgb_classifiers
+        return getattr(xgb_classifiers, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 def find_model_name_from_pipeline(input_dict):
+    # Estimators that are a pipeline themselves (e.g. kernel features + linear model) are named after their last step
+    estimator = input_dict.get('estimator', [None])[0] if isinstance(input_dict, dict) else None
+    if isinstance(estimator, Pipeline):
+        return type(estimator.steps[-1][1]).__name__
+
     # Transform dict to string
     dict_string = str(input_dict)
 
@@ -32,54 +53,189 @@ def find_model_name_from_pipeline(input_dict):
 
     return words[-1]
 
+def parquet_bytes_read(parquet_file, columns):
+    # Compressed size of the column chunks that a read of `columns` touches
+    metadata = parquet_file.metadata
+    n_bytes = 0
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            if column.path_in_schema in columns:
+                n_bytes += column.total_compressed_size
+    return n_bytes
+
+def plan_variable_files(variable_list, file_index, file_paths, PROC_DATA_PATH=PROC_DATA_PATH, RAW_DATA_PATH=RAW_DATA_PATH):
+    # Plan: path of the parquet file -> variables to read from it. file_paths: file name -> paths (file_paths_by_name)
+    docs_df = pd.read_csv(PROC_DATA_PATH + "documentation_variables.csv")
+    docs_df = docs_df[docs_df["Use Constraints"] != "RDC Only"]
+
+    variable_docs = docs_df.loc[docs_df["Variable Name"].isin(variable_list), ["Variable Name", "Data File Name"]]
+    compile_plan = {}
+    for var, file in variable_docs.drop_duplicates().itertuples(index=False):
+        for file_path in file_paths.get(file.upper(), []):
+            compile_plan.setdefault(file_path, []).append(var)
+
+    # Variables missing from the docs (e.g. the PAXMIN_FEATURES files derived by paxmin_features.py)
+    # are read from every file whose columns in the manifest have them
+    documented_variables = set(variable_docs["Variable Name"])
+    for var in variable_list:
+        if var in documented_variables:
+            continue
+        for key in sorted(file_index["files"]):
+            entry = file_index["files"][key]
+            if var.upper() in entry["columns"]:
+                compile_plan.setdefault(os.path.join(RAW_DATA_PATH, entry["path"]), []).append(var)
+
+    return compile_plan
+
+# Codebook components whose variables are coded answers (small integer codes), the others are measurements
+CODED_COMPONENTS = {"Demographics", "Questionnaire"}
+
+# Arrow integer types and the nullable pandas dtypes they are read as
+NULLABLE_INTS = {pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype(), pa.int32(): pd.Int32Dtype()}
+
+def smallest_int_type(low, high):
+    for arrow_type in NULLABLE_INTS:
+        info = np.iinfo(arrow_type.to_pandas_dtype())
+        if info.min <= low and high <= info.max:
+            return arrow_type
+    return None
+
+def compact_dtype_plan(compile_plan, PROC_DATA_PATH=PROC_DATA_PATH, keep_float64=()):
+    """
+    Arrow type each variable of a plan (path -> variables) is read as, from the NHANES codebook and the parquet footers:
+    - coded answers (Demographics and Questionnaire variables): the smallest integer type holding the min / max of
+      the column statistics, read as a nullable pandas integer. Non integral values (e.g. income ratios) are read
+      as float32 instead.
+    - measurements (Laboratory, Examination, Dietary) and the variables missing from the codebook: float32.
+    - keep_float64: variables compared with thresholds later on. Glucose 5.6 isn't 5.6 anymore in float32.
+    - SEQN: int32.
+    Without the Component column in the codebook, every variable is read as float64.
+    """
+    docs_file = PROC_DATA_PATH + "documentation_variables.csv"
+    if "Component" not in pd.read_csv(docs_file, nrows=0).columns:
+        # The coded answers can't be told from the measurements
+        return {"SEQN": pa.int32(), **{var.upper(): pa.float64() for variables in compile_plan.values() for var in variables}}
+    docs_df = pd.read_csv(docs_file, usecols=["Variable Name", "Component"])
+    components = dict(zip(docs_df["Variable Name"].str.upper(), docs_df["Component"]))
+    keep_float64 = {var.upper() for var in keep_float64}
+
+    # Range of each column over all the planned files, from the row group statistics
+    ranges = {}
+    for file_path, variables in compile_plan.items():
+        columns = {var.upper() for var in variables}
+        metadata = pq.read_metadata(file_path)
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            for j in range(row_group.num_columns):
+                column = row_group.column(j)
+                if column.path_in_schema not in columns or column.statistics is None or not column.statistics.has_min_max:
+                    continue
+                low, high = ranges.get(column.path_in_schema, (np.inf, -np.inf))
+                ranges[column.path_in_schema] = min(low, column.statistics.min), max(high, column.statistics.max)
+
+    dtypes = {"SEQN": pa.int32()}
+    for var in {var.upper() for variables in compile_plan.values() for var in variables}:
+        if var in keep_float64:
+            dtypes[var] = pa.float64()
+        elif components.get(var) in CODED_COMPONENTS:
+            dtypes[var] = smallest_int_type(*ranges.get(var, (0, 0))) or pa.float32()
+        else:
+            dtypes[var] = pa.float32()
+    return dtypes
+
+def compact_to_pandas(table, dtypes):
+    # Cast the columns of an arrow table to their planned type before converting it
+    for i, field in enumerate(table.schema):
+        target = dtypes.get(field.name)
+        if target is None or field.type == target:
+            continue
+        try:
+            column = table.column(i).cast(target)
+        except pa.ArrowInvalid:
+            # Integer casts are safe: non integral values are kept as float32
+            column = table.column(i).cast(pa.float32())
+        table = table.set_column(i, field.name, column)
+    df = table.to_pandas(types_mapper=NULLABLE_INTS.get)
+    # SEQN is never missing, a plain int32 key
+    if "SEQN" in df:
+        df["SEQN"] = df["SEQN"].astype(np.int32)
+    return df
+
 def compile_data(variable_list,
                 RAW_DATA_PATH=RAW_DATA_PATH,
                 PROC_DATA_PATH=PROC_DATA_PATH,
                 save_file_as=False,
-                print_statemets=True):
+                print_statemets=True,
+                compact_dtypes=False,
+                keep_float64=()):
     """
-    for var in variable_list that you want:
-        - Look in the docs what parquet files contain that variable
-        - Make a list called parquet_files that contains the path of the files.
-        for file in parquet_files:
-            - Read that file specific column variable + SEQN
-            - Concat to the "master" dataframe
-            - Save the file if choosen
-
+    - Map every parquet file name to its path with the raw_data manifest (nhanes_file_index).
+    - Build a plan from the docs, once: parquet file -> variables to read from it.
+    for file in plan:
+        - Open the file once and read SEQN + all its planned variables together
+    - Stack each variable across files and join all of them to the "master"
+      dataframe with a single SEQN-indexed join
+    - Save the file if choosen
+
+    The number of files opened and bytes read are printed and kept in
+    master_df.attrs["compile_stats"].
+
+    compact_dtypes: read the columns with the types of compact_dtype_plan instead of float64 (nullable integers
+    for the coded answers, float32 for the measurements, int32 SEQN) and YEAR as a categorical cycle key.
+    keep_float64: variables kept as float64 anyway.
     """
-    docs_df = pd.read_csv(PROC_DATA_PATH + "documentation_variables.csv")
-    docs_df = docs_df[docs_df["Use Constraints"] != "RDC Only"]
-
-    # Initial dataset just with all the individual indexes and its year
-    master_df = pd.DataFrame()
+    # File name (e.g. "DEMO_D") -> paths, from the raw_data manifest instead of walking the tree
+    file_index = update_file_index(RAW_DATA_PATH)
+    file_paths = file_paths_by_name(file_index, RAW_DATA_PATH)
 
-    file_path = sorted(glob(RAW_DATA_PATH + "**" + "/*DEMO*.parquet", recursive=True))
-    for file in file_path:
-        df = pd.read_parquet(file, columns=["SEQN"])
-        df["YEAR"] = re.search(r"\d{4}-\d{4}", file).group()
-        master_df = pd.concat([master_df, df], ignore_index=True)
-    master_df.sort_values(by=["SEQN", "YEAR"], inplace=True)
+    compile_plan = plan_variable_files(variable_list, file_index, file_paths, PROC_DATA_PATH, RAW_DATA_PATH)
+    dtypes = compact_dtype_plan(compile_plan, PROC_DATA_PATH, keep_float64) if compact_dtypes else {}
 
+    def read_columns(parquet_file, columns):
+        table = parquet_file.read(columns=columns)
+        return compact_to_pandas(table, dtypes) if compact_dtypes else table.to_pandas()
 
-    for var in variable_list:
+    # Initial dataset just with all the individual indexes and its year
+    demo_files = sorted(path for name, paths in file_paths.items() if "DEMO" in name for path in paths)
+    master_df = pd.concat(
+        [read_columns(pq.ParquetFile(file), ["SEQN"]).assign(YEAR=re.search(r"\d{4}-\d{4}", file).group())
+         for file in demo_files],
+        ignore_index=True)
+    master_df.sort_values(by=["SEQN", "YEAR"], inplace=True)
+    if compact_dtypes:
+        master_df["YEAR"] = master_df["YEAR"].astype("category")
+
+    compile_stats = {"files_opened": 0, "bytes_read": 0}
+    variable_columns = {var: [] for var in variable_list}
+    for file_path in sorted(compile_plan):
+        variables = compile_plan[file_path]
+        # Upper case because bad formatting of raw NHANES data for MCQ300c
+        columns = ["SEQN"] + sorted({var.upper() for var in variables})
+
+        parquet_file = pq.ParquetFile(file_path)
+        df = read_columns(parquet_file, columns).set_index("SEQN")
+        compile_stats["files_opened"] += 1
+        compile_stats["bytes_read"] += parquet_bytes_read(parquet_file, columns)
+
+        for var in variables:
+            variable_columns[var].append(df[var.upper()].rename(var))
         if print_statemets:
-            print(f"Searching for variable {var} ...")
-        parquet_files = sorted(docs_df[docs_df["Variable Name"] == var]['Data File Name'].unique())
+            print(f"--> Successfully added: {', '.join(variables)} from {file_path}")
 
-        variable_concat_df = pd.DataFrame()
-        for file in parquet_files:
-            pattern = os.path.join(RAW_DATA_PATH, "**", f"{file.upper()}.parquet")
-            file_path = glob(pattern, recursive=True)
-            file_path = ''.join(file_path)
+    # Variables without files keep the SEQN type for the join
+    empty_index = pd.Index([], dtype=master_df["SEQN"].dtype, name="SEQN")
+    variables_df = pd.concat(
+        [pd.concat(columns) if columns else pd.Series(np.nan, index=empty_index, name=var)
+         for var, columns in variable_columns.items()],
+        axis=1)
+    master_df = master_df.join(variables_df, on="SEQN").reset_index(drop=True)
+    master_df.attrs["compile_stats"] = compile_stats
 
-            if file_path:
-                df = pd.read_parquet(file_path, columns=["SEQN", var.upper()])
-                df = df.rename({df.columns[1]: var}, axis=1) # Because bad formatting of raw NHANES data for MCQ300c
-                variable_concat_df = pd.concat([variable_concat_df, df], ignore_index=True)
-                if print_statemets:
-                    print(f"--> Successfully added: {var} from {file_path}")
-
-        master_df = master_df.merge(variable_concat_df, on = ["SEQN"], how="left")
+    if print_statemets:
+        print(f"--> Compiled {len(variable_columns)} variables opening {compile_stats['files_opened']} files "
+              f"({compile_stats['bytes_read'] / 1e6:.1f} MB read)")
 
     if save_file_as:
         master_df.to_parquet(RAW_DATA_PATH + f"{save_file_as}.parquet", index=False)
@@ -93,6 +249,59 @@ def create_intake_new_column(df, day0_col, day1_col, day2_col):
                     df[[day1_col, day2_col]].mean(axis=1, skipna=True),
                     df[day0_col])
 
+def harmonise(df, harmonisation_spec, sentinel_codes=None):
+    """
+    Build the harmonised columns of `harmonisation_spec`, a list of (new column, source columns, rule):
+        - "coalesce": first non-missing value of the source columns, in order.
+        - "mean_of_days": the first source column, or the mean of the other ones (the two dietary
+          recall days) when it's missing.
+    `sentinel_codes` maps a column to the coded answers ("Don't know", "Refused") to set as missing.
+
+    All the source columns are read into a single 2-D float block, and the new columns sharing a rule
+    and number of sources are computed together with one NumPy operation over a 3-D view of it.
+    Returns a dict new column -> array, with the cleaned sentinel columns first.
+    """
+    sentinel_codes = sentinel_codes or {}
+    source_cols = list(dict.fromkeys(col for _, cols, _ in harmonisation_spec for col in cols))
+    source_cols += [col for col in sentinel_codes if col not in source_cols]
+    position = {col: i for i, col in enumerate(source_cols)}
+    # Own copy: for a single float64 block, to_numpy is a view of df (read-only with copy-on-write)
+    block = np.array(df[source_cols].to_numpy(dtype=np.float64, na_value=np.nan), copy=True)
+
+    for col, codes in sentinel_codes.items():
+        values = block[:, position[col]]
+        values[np.isin(values, codes)] = np.nan
+
+    harmonised = {col: block[:, position[col]] for col in sentinel_codes}
+
+    groups = {}
+    for new_col, cols, rule in harmonisation_spec:
+        groups.setdefault((rule, len(cols)), []).append((new_col, [position[col] for col in cols]))
+
+    results = {}
+    for (rule, _), group in groups.items():
+        # n_rows x n_new_columns x n_sources
+        values = block[:, np.array([positions for _, positions in group])]
+        missing = np.isnan(values)
+
+        if rule == "coalesce":
+            first = np.argmax(~missing, axis=2)[..., np.newaxis]
+            new_values = np.take_along_axis(values, first, axis=2)[..., 0]
+        elif rule == "mean_of_days":
+            days = np.where(missing[..., 1:], 0, values[..., 1:])
+            n_days = (~missing[..., 1:]).sum(axis=2)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                days_mean = days.sum(axis=2) / n_days
+            new_values = np.where(missing[..., 0], days_mean, values[..., 0])
+        else:
+            raise ValueError(f"Unknown harmonisation rule: {rule}")
+
+        for i, (new_col, _) in enumerate(group):
+            results[new_col] = new_values[:, i]
+
+    harmonised.update((new_col, results[new_col]) for new_col, _, _ in harmonisation_spec)
+    return harmonised
+
 class ConvertToCategory(BaseEstimator, TransformerMixin):
     def __init__(self, columns):
         self.columns = columns
@@ -100,6 +309,10 @@ class ConvertToCategory(BaseEstimator, TransformerMixin):
     def fit(self, X, y=None):
         return self
 
+    def __sklearn_is_fitted__(self):
+        # Stateless, nothing to fit
+        return True
+
     def transform(self, X):
         X = X.copy()
         for col in self.columns:
@@ -113,6 +326,10 @@ class MissingValueCategoryAs999(BaseEstimator, TransformerMixin):
     def fit(self, X, y=None):
         return self
 
+    def __sklearn_is_fitted__(self):
+        # Stateless, nothing to fit
+        return True
+
     def transform(self, X):
         X = X.copy()
         for col in self.columns:
@@ -120,6 +337,26 @@ class MissingValueCategoryAs999(BaseEstimator, TransformerMixin):
         return X
 
 
+class CalibratedLinearSVC(LinearSVC):
+    """
+    LinearSVC with probabilities: a sigmoid (Platt scaling) of its decision function, fitted once on a stratified
+    held-out fold of the data it's fitted on. SVC(probability=True) runs an internal 5-fold cross validation for it.
+    """
+    validation_fraction = 0.1
+
+    def fit(self, X, y):
+        X_fit, X_val, y_fit, y_val = train_test_split(X, y,
+                                                      test_size=self.validation_fraction,
+                                                      random_state=self.random_state,
+                                                      stratify=y)
+        super().fit(X_fit, y_fit)
+        self.calibrator_ = LogisticRegression(C=1e4).fit(self.decision_function(X_val).reshape(-1, 1), y_val)
+        return self
+
+    def predict_proba(self, X):
+        return self.calibrator_.predict_proba(self.decision_function(X).reshape(-1, 1))
+
+
 class WeightedEnsemble(BaseEstimator, ClassifierMixin):
     def __init__(self, models, weights):
         self.models = models
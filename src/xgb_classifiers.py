@@ -0,0 +1,49 @@
+"""
+XGBoost classifiers of the training searches, apart from utils so that only the code using them imports XGBoost.
+"""
+
+import numpy as np
+import xgboost as xgb
+from sklearn.model_selection import train_test_split
+
+
+class EarlyStoppingXGBClassifier(xgb.XGBClassifier):
+    """
+    XGBClassifier that holds out a stratified validation fold of the data it's fitted on, and stops adding
+    trees once the validation loss hasn't improved for `early_stopping_rounds` rounds. n_estimators is
+    then just the maximum number of trees.
+    """
+    validation_fraction = 0.1
+
+    def fit(self, X, y, **kwargs):
+        X_fit, X_val, y_fit, y_val = train_test_split(X, y,
+                                                      test_size=self.validation_fraction,
+                                                      random_state=self.random_state,
+                                                      stratify=y)
+        return super().fit(X_fit, y_fit, eval_set=[(X_val, y_val)], verbose=False, **kwargs)
+
+
+class CategoricalXGBClassifier(xgb.XGBClassifier):
+    """
+    XGBClassifier that splits the categorical columns of the preprocessed matrix (feature_types 'c') on their
+    categories. Their missing category (999) is given to XGBoost as a missing value, which learns where it goes:
+    the histogram of a categorical feature is as wide as its largest value.
+    """
+    missing_category = 999
+
+    def categorical_matrix(self, X):
+        X = np.array(X)
+        categorical = np.array(self.feature_types) == 'c'
+        block = X[:, categorical]
+        block[block == self.missing_category] = np.nan
+        X[:, categorical] = block
+        return X
+
+    def fit(self, X, y, **kwargs):
+        return super().fit(self.categorical_matrix(X), y, **kwargs)
+
+    def predict_proba(self, X, **kwargs):
+        return super().predict_proba(self.categorical_matrix(X), **kwargs)
+
+    def predict(self, X, **kwargs):
+        return super().predict(self.categorical_matrix(X), **kwargs)
@@ -0,0 +1,20 @@
+"""
+The scripts of src/ are imported as top-level modules, like when they are run from src/. They read their data
+folders and seed from the environment (.env) when imported, so the tests point them to a temporary folder first.
+"""
+
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+TEST_DATA_PATH = tempfile.mkdtemp(prefix="ml_diabetes_tests_")
+atexit.register(shutil.rmtree, TEST_DATA_PATH, ignore_errors=True)
+
+os.environ.setdefault("SEED", "42")
+for name, folder in [("RAW_DATA_PATH", "raw"), ("PROC_DATA_PATH", "proc"), ("MODEL_RESULTS_PATH", "models")]:
+    os.environ[name] = os.path.join(TEST_DATA_PATH, folder, "")
+    os.makedirs(os.environ[name], exist_ok=True)
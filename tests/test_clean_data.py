@@ -0,0 +1,59 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from utils import compile_data
+from dinh_2019_create_clean_data_file import preprocessing_nhanes, create_targets, rename_columns, FLOAT64_VARIABLES
+from reference_pipeline import reference_preprocessing_nhanes, reference_create_targets, reference_rename_columns
+from synthetic_data import synthetic_raw_data
+
+
+@pytest.fixture(scope="module")
+def raw_tree(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("raw_tree")
+    raw_path, proc_path = os.path.join(directory, "raw", ""), os.path.join(directory, "proc", "")
+    variables = synthetic_raw_data(4000, raw_path, proc_path)
+    return variables, raw_path, proc_path
+
+
+def compile_raw(raw_tree, **kwargs):
+    variables, raw_path, proc_path = raw_tree
+    return compile_data(variables, raw_path, proc_path, print_statemets=False, **kwargs)
+
+
+def test_preprocessing_matches_reference(raw_tree):
+    raw_df = compile_raw(raw_tree)
+
+    reference_df = raw_df.pipe(reference_preprocessing_nhanes).pipe(reference_create_targets).pipe(reference_rename_columns)
+    clean_df = raw_df.pipe(preprocessing_nhanes).pipe(create_targets).pipe(rename_columns)
+
+    pd.testing.assert_frame_equal(reference_df, clean_df)
+    # The sentinel codes are in the synthetic data, and gone after the preprocessing
+    assert raw_df['ALQ130'].isin([77, 99, 777, 999]).any()
+    assert not clean_df['Alcohol_consumption'].isin([77, 99, 777, 999]).any()
+
+
+def test_compact_dtypes_keep_the_values(raw_tree):
+    float64_df = compile_raw(raw_tree)
+    compact_df = compile_raw(raw_tree, compact_dtypes=True, keep_float64=FLOAT64_VARIABLES)
+
+    assert list(compact_df.columns) == list(float64_df.columns)
+    assert (compact_df['SEQN'].to_numpy() == float64_df['SEQN'].to_numpy()).all()
+    assert str(compact_df['RIDRETH1'].dtype) == 'Int8'
+    for col in FLOAT64_VARIABLES:
+        assert compact_df[col].dtype == np.float64
+        np.testing.assert_array_equal(compact_df[col].to_numpy(), float64_df[col].to_numpy())
+    for col in compact_df.columns.drop(['SEQN', 'YEAR']):
+        # float32 measurements are rounded, the coded answers are exact
+        np.testing.assert_allclose(compact_df[col].to_numpy(dtype=np.float64, na_value=np.nan),
+                                   float64_df[col].to_numpy(), rtol=1e-6, err_msg=col)
+
+
+def test_compact_dtypes_without_components_fall_back_to_float64(raw_tree, tmp_path):
+    variables, raw_path, proc_path = raw_tree
+    docs = pd.read_csv(os.path.join(proc_path, "documentation_variables.csv"))
+    docs.drop(columns="Component").to_csv(tmp_path / "documentation_variables.csv", index=False)
+
+    df = compile_data(variables, raw_path, str(tmp_path) + os.sep, print_statemets=False, compact_dtypes=True)
+
+    assert (df.drop(columns=['SEQN', 'YEAR']).dtypes == np.float64).all()
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from sklearn.pipeline import Pipeline
+from sklearn.linear_model import LogisticRegression
+from sklearn.ensemble import RandomForestClassifier
+from dinh_2019_train_models import create_preprocessor, categorical_vars, numerical_vars
+from xgb_classifiers import EarlyStoppingXGBClassifier
+from model_registry import save_model, load_model, load_target, list_models, data_hash
+from ensemble_inference import BatchEnsemble, load_ensemble
+from utils import WeightedEnsemble
+from synthetic_data import synthetic_clean_data
+
+
+@pytest.fixture(scope="module")
+def fitted_pipelines():
+    df = synthetic_clean_data(3000, seed=0)
+    X, y = df[categorical_vars + numerical_vars], df['Diabetes_Case_I']
+    estimators = [LogisticRegression(max_iter=1000),
+                  RandomForestClassifier(n_estimators=20, max_depth=6, random_state=0, n_jobs=1),
+                  EarlyStoppingXGBClassifier(n_estimators=50, early_stopping_rounds=5, max_depth=3, random_state=0, n_jobs=1)]
+    pipelines = [Pipeline([('preprocessor', create_preprocessor()), ('estimator', estimator)]).fit(X, y)
+                 for estimator in estimators]
+    return pipelines, X, y
+
+
+def test_registry_round_trip(fitted_pipelines, tmp_path):
+    pipelines, X, y = fitted_pipelines
+    for pipeline in pipelines:
+        save_model(pipeline, 'Diabetes_Case_I', {'AUC': 0.8}, data_hash(X, y), 1.0, registry_path=str(tmp_path))
+
+    saved = list_models('Diabetes_Case_I', str(tmp_path))
+    assert sorted(metadata['model'] for metadata in saved) == sorted(type(p.named_steps['estimator']).__name__ for p in pipelines)
+    assert {metadata['estimator_format'] for metadata in saved} == {'joblib', 'xgboost_ubj'}
+    assert not list(tmp_path.glob("*/*.part"))
+
+    loaded = load_target('Diabetes_Case_I', str(tmp_path))
+    for pipeline in pipelines:
+        model_name = type(pipeline.named_steps['estimator']).__name__
+        assert type(loaded[model_name].named_steps['estimator']) is type(pipeline.named_steps['estimator'])
+        np.testing.assert_allclose(loaded[model_name].predict_proba(X), pipeline.predict_proba(X), rtol=1e-6)
+
+
+def test_registry_replaces_a_saved_model(fitted_pipelines, tmp_path):
+    pipelines, X, y = fitted_pipelines
+    save_model(pipelines[0], 'CVD', {'AUC': 0.7}, registry_path=str(tmp_path))
+    save_model(pipelines[0], 'CVD', {'AUC': 0.9}, registry_path=str(tmp_path))
+
+    saved = list_models('CVD', str(tmp_path))
+    assert len(saved) == 1 and saved[0]['metrics'] == {'AUC': 0.9}
+    np.testing.assert_allclose(load_model('CVD', 'LogisticRegression', str(tmp_path)).predict_proba(X),
+                               pipelines[0].predict_proba(X), rtol=1e-6)
+
+
+def test_batch_ensemble_matches_weighted_ensemble(fitted_pipelines, tmp_path):
+    pipelines, X, _ = fitted_pipelines
+    weights = np.array([0.85, 0.88, 0.9])
+
+    reference = WeightedEnsemble(pipelines, weights / weights.sum()).predict_proba(X)
+    ensemble = BatchEnsemble.from_models(pipelines, weights, chunk_size=1000)
+    # The models score float32 instead of float64 values
+    np.testing.assert_allclose(ensemble.predict_proba(X), reference, atol=1e-5)
+
+    loaded = load_ensemble(ensemble.save(str(tmp_path / "ensemble.pkl")))
+    np.testing.assert_array_equal(loaded.predict_proba(X), ensemble.predict_proba(X))
@@ -0,0 +1,127 @@
+import os
+import numpy as np
+import pandas as pd
+import pyreadstat
+import pytest
+import nhanes_data_backfill
+from nhanes_data_backfill import scrape_nhanes_xpt_files, download_xpt_file, create_session, RateLimiter
+from nhanes_file_index import update_file_index
+from synthetic_data import CDCStandIn
+
+YEAR = "2005-2006"
+FILES = {"Demographics": ["DEMO_D"], "Dietary": ["DSBI", "DR1TOT_D"], "Examination": ["BMX_D", "BPX_D"],
+         "Laboratory": ["GLU_D"], "Questionnaire": ["DIQ_D", "MCQ_D"]}
+REQUESTS_PER_SECOND = 20
+
+
+@pytest.fixture
+def xpt_path(tmp_path):
+    # One small XPT file per NHANES file of FILES, and a file that isn't XPT at all
+    path = tmp_path / "xpt"
+    path.mkdir()
+    rng = np.random.default_rng(0)
+    for name in sum(FILES.values(), []):
+        pyreadstat.write_xport(pd.DataFrame({'SEQN': np.arange(100.0), 'VALUE': rng.random(100)}),
+                               str(path / f"{name}.XPT"), table_name=name[:8])
+    (path / "BAD_D.XPT").write_bytes(b"not an XPT file" * 100)
+    return path
+
+
+def stand_in_for(xpt_path, files=FILES, **kwargs):
+    return CDCStandIn(str(xpt_path), YEAR, files, **kwargs)
+
+
+def scrape(stand_in, raw_path, workers=4):
+    scrape_nhanes_xpt_files(YEAR, str(raw_path), workers, REQUESTS_PER_SECOND, stand_in.url, retries=3, backoff_factor=0.01)
+
+
+def files_on_disk(raw_path, suffix=".parquet"):
+    return {file for _, _, names in os.walk(raw_path) for file in names if file.endswith(suffix)}
+
+
+def test_retries_skipped_page_and_rate_limit(xpt_path, tmp_path):
+    flaky = {f"/Nchs/Nhanes/{YEAR}/BMX_D.XPT": 2,
+             f"/nchs/nhanes/search/datapage.aspx?Component=Examination&CycleBeginYear={YEAR[:4]}": 1}
+    stand_in = stand_in_for(xpt_path, flaky=flaky, failing=["Laboratory"])
+    try:
+        scrape(stand_in, tmp_path / "raw")
+    finally:
+        stand_in.close()
+
+    # The failing page is retried then skipped, the other pages and downloads go on
+    expected = {f"{name}.parquet" for name in sum(FILES.values(), []) if name not in FILES["Laboratory"]}
+    assert files_on_disk(tmp_path / "raw") == expected
+    assert sum("Component=Laboratory" in query for _, _, query in stand_in.requests) == 4
+    assert sum(path.endswith("BMX_D.XPT") for _, path, _ in stand_in.requests) == 3
+
+    # The retries wait for the rate limit too. The times are taken by the server threads, a few ms late at times
+    times = np.sort([request_time for request_time, _, _ in stand_in.requests])
+    assert times[-1] - times[0] >= 0.95 * (len(times) - 1) / REQUESTS_PER_SECOND
+    assert np.diff(times).min() >= 0.5 / REQUESTS_PER_SECOND
+
+
+def test_resume_skips_the_files_of_the_manifest(xpt_path, tmp_path):
+    raw_path = tmp_path / "raw"
+    # The same file name in another cycle isn't a downloaded file of this one
+    os.makedirs(raw_path / "2003-2004" / "Dietary")
+    pd.DataFrame({'SEQN': [1.0]}).to_parquet(raw_path / "2003-2004" / "Dietary" / "DSBI.parquet")
+
+    stand_in = stand_in_for(xpt_path)
+    try:
+        scrape(stand_in, raw_path)
+        first_run = len(stand_in.requests)
+        scrape(stand_in, raw_path)
+        second_downloads = [path for _, path, _ in stand_in.requests[first_run:] if path.endswith(".XPT")]
+    finally:
+        stand_in.close()
+
+    assert os.path.exists(raw_path / YEAR / "Dietary" / "DSBI.parquet")
+    assert second_downloads == []
+    cycle_files = {entry["name"] for entry in update_file_index(str(raw_path))["files"].values() if entry["cycle"] == YEAR}
+    assert cycle_files == set(sum(FILES.values(), []))
+
+
+def test_interrupted_and_failed_downloads_leave_no_files(xpt_path, tmp_path):
+    raw_path = tmp_path / "raw"
+    files = {**FILES, "Laboratory": ["GLU_D", "BAD_D", "MISSING_D"]}
+    stand_in = stand_in_for(xpt_path, files, truncated={f"/Nchs/Nhanes/{YEAR}/DIQ_D.XPT": 1})
+    try:
+        scrape(stand_in, raw_path)
+        # Truncated transfer, file that isn't XPT and 404: no parquet, no .part file, nothing in the manifest
+        assert {"DIQ_D.parquet", "BAD_D.parquet", "MISSING_D.parquet"}.isdisjoint(files_on_disk(raw_path))
+        assert files_on_disk(raw_path, ".part") == set()
+        names = {entry["name"] for entry in update_file_index(str(raw_path))["files"].values()}
+        assert names == set(sum(FILES.values(), [])) - {"DIQ_D"}
+
+        # The next run downloads the interrupted file again
+        scrape(stand_in, raw_path)
+    finally:
+        stand_in.close()
+    assert "DIQ_D.parquet" in files_on_disk(raw_path)
+    pd.testing.assert_frame_equal(pd.read_parquet(raw_path / YEAR / "Questionnaire" / "DIQ_D.parquet"),
+                                  pyreadstat.read_xport(str(xpt_path / "DIQ_D.XPT"))[0])
+
+
+def test_conversion_failure_keeps_no_partial_parquet(xpt_path, tmp_path, monkeypatch):
+    # The conversion fails after a first row group was written to the .part parquet file
+    read_file_in_chunks = nhanes_data_backfill.pyreadstat.read_file_in_chunks
+
+    def failing_chunks(*args, **kwargs):
+        chunks = read_file_in_chunks(*args, **kwargs)
+        yield next(chunks)
+        assert os.path.exists(parquet_path + ".part")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(nhanes_data_backfill.pyreadstat, "read_file_in_chunks", failing_chunks)
+    parquet_path = str(tmp_path / "DEMO_D.parquet")
+    stand_in = stand_in_for(xpt_path)
+    session = create_session(1, retries=0)
+    try:
+        with pytest.raises(OSError, match="disk full"):
+            download_xpt_file(session, RateLimiter(None), f"{stand_in.url}/Nchs/Nhanes/{YEAR}/DEMO_D.XPT", parquet_path,
+                              chunksize=10)
+    finally:
+        session.close()
+        stand_in.close()
+
+    assert os.listdir(tmp_path) == ["xpt"]
@@ -0,0 +1,16 @@
+from dinh_2019_train_models import downsample, stratified_split
+from synthetic_data import synthetic_clean_data
+
+
+def test_seed_decides_the_downsampling_and_the_split():
+    df = synthetic_clean_data(5000)
+
+    def test_rows(seed):
+        _, X_test, _, _ = stratified_split(downsample(df, seed), 'CVD', seed)
+        return X_test.index.tolist()
+
+    assert test_rows(7) == test_rows(7)
+    # Same downsampled rows, another split
+    _, X_test_7, _, _ = stratified_split(downsample(df, 7), 'CVD', 7)
+    _, X_test_11, _, _ = stratified_split(downsample(df, 7), 'CVD', 11)
+    assert X_test_7.index.tolist() != X_test_11.index.tolist()